@@ -1,23 +1,106 @@
 import time
 import boto3
+import pickle
 import argparse
 import asyncio
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import datetime as dt
-from scripts.load_markets import PerpMarket, SpotMarket, initialize_state
-from scripts.event_parser import parse_event
-from scripts.log_parser import get_logs_from_topledger
+from scripts.load_markets import PerpMarket, SpotMarket, initialize_state, set_markets
+from scripts.event_parser import LIQUIDATION_LAYOUTS, parse_event
+from scripts.log_parser import (
+    RAW_LOGS_SCHEMA,
+    BatchedEvents,
+    fetch_raw_logs,
+    decode_events,
+)
+from scripts.ipc import SHARED_MEMORY_DIR, ipc_dir, write_ipc, read_ipc, filter_isin
+from scripts.sharding import LeaseManifest, build_units, parse_shard
+from scripts.planner import format_plan, plan_backfill
+from scripts.memory import (
+    MemoryBudgetExceeded,
+    MemoryGovernor,
+    decoded_estimate,
+    default_memory_budget,
+    format_memory_report,
+)
+from scripts.follow import FollowState, OutputMerger
+from scripts.aio import S3IO, MAX_S3_CONCURRENCY, MULTIPART_PART_SIZE, PartWriter
+from scripts.sinks import MemorySink, make_sink, parse_sink
+from scripts.sources import make_source, parse_source
+from scripts.slot_index import SlotIndex
+from scripts.rpc import RPC_BATCH_SIZE, RPC_CONCURRENCY, RpcLogCache, RpcLogFetcher
+from scripts.tables import (
+    EXPONENTS_METADATA_KEY,
+    KeyedEvents,
+    column_exponents,
+    format_exponents,
+    iter_transactions,
+    pubkey_str,
+)
+from scripts.rollups import ROLLUP_COLUMNS, market_rollups, merge_rollups
+from scripts.merge import merged_frames
+from scripts.activity import (
+    ACTIVITY_INDEX_PREFIX,
+    ACTIVITY_INDEX_SHARDS,
+    ACTIVITY_PARTS_PREFIX,
+    activity_shard,
+    collect_activity,
+    merge_activity,
+    record_activity,
+    split_activity,
+)
+from scripts.signatures import (
+    SIGNATURE_FILTERS_PREFIX,
+    SIGNATURE_INDEX_PREFIX,
+    SIGNATURE_INDEX_SHARDS,
+    SIGNATURE_PARTS_PREFIX,
+    build_segments,
+    collect_signatures,
+    day_filter,
+    filter_may_contain,
+    find_in_segment,
+    merge_filters,
+    record_signatures,
+    signature_shard,
+)
+from scripts.compression import (
+    DEFAULT_CODEC,
+    BufferedCompressor,
+    Codec,
+    compress_on_pool,
+    decompress,
+    parse_codec,
+)
+from scripts.uploads import (
+    CONTENT_HASH_METADATA_KEY,
+    UploadManifest,
+    content_hash_frames,
+    format_counts,
+)
 import io
 import gc
-from scripts.utils import chunks
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import shutil
+import tempfile
+from scripts.utils import chunks, in_shard, sub_shard
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    as_completed,
+)
 import awswrangler as wr
 from scripts.utils import snake_to_camel_df
 
 PROFILE_NAME = "" # aws profile name with permissions to access destination bucket
 DESTINATION_BUCKET_NAME = "" # destination bucket name
+DESTINATION_ENDPOINT_URL = None # set to a local S3 stand-in (e.g. minio) for testing
 RPC_URL = "" # rpc url
 
+SOURCE_BUCKET_NAME = "drift-topledger"
 PROGRAM_ID = "dRiftyHA39MWEi3m9aunc5MzRF1JYuBsbn6VPcn33UH"
 EVENT_TYPES = [
     "OrderActionRecord",
@@ -30,9 +113,25 @@ EVENT_TYPES = [
     "FundingRateRecord",
     "FundingPaymentRecord",
 ]
+TRADE_DEDUP_COLUMNS = [
+    "txSig",
+    "taker",
+    "maker",
+    "takerOrderId",
+    "makerOrderId",
+    "marketIndex",
+    "marketType",
+    "action",
+    "fillRecordId",
+    "baseAssetAmountFilled",
+]
+# How long after midnight UTC a followed day keeps receiving source files
+FOLLOW_GRACE = dt.timedelta(hours=2)
+# Columns of the events partitions that the processors read
+PARTITION_COLUMNS = ["tx_id", "block_slot", "block_time"]
 
 session_default = boto3.Session(PROFILE_NAME)  # Change here to profile name
-s3_resource = session_default.resource("s3")
+s3_resource = session_default.resource("s3", endpoint_url=DESTINATION_ENDPOINT_URL)
 DESTINATION_BUCKET = s3_resource.Bucket(DESTINATION_BUCKET_NAME) # Change here to destination bucket name 
 
 def assume_role(arn, session_name):
@@ -44,15 +143,9 @@ def assume_role(arn, session_name):
 
 
 def filter_df(df, event_type):
+    # OrderActionRecord fills are filtered at read time, see build_read_filter
     rez = df[df["event_type"] == event_type]
-    if event_type == "OrderActionRecord":
-        rez = rez[
-            rez["args"].apply(
-                lambda x: x.get("action") if isinstance(x, dict) else None
-            )
-            == "Fill"
-        ]
-    elif event_type == "SettlePnlRecord":
+    if event_type == "SettlePnlRecord":
         rez["authority"] = rez["args"].apply(lambda x: x["userAuthority"])
         rez = rez[
             ~rez["authority"].isin(
@@ -75,8 +168,13 @@ def filter_df(df, event_type):
     return rez
 
 
-def sanity_check(trades: pd.DataFrame):
-    block_times = pd.to_datetime(trades["block_time"], format="%m/%d/%y %H:%M")
+def sanity_check(trades: pa.Table):
+    if trades.num_rows == 0:
+        print("No trades to check")
+        return False
+    block_times = pd.to_datetime(
+        trades["block_time"].to_pandas(), format="%m/%d/%y %H:%M"
+    )
     date = block_times.iloc[0].date()
 
     after_midnight = dt.datetime.combine(date, dt.time(minute=1))
@@ -98,103 +196,338 @@ def sanity_check(trades: pd.DataFrame):
     return after_midnight_check and noon_check and before_midnight_check
 
 
-def process_trades(trades: pd.DataFrame, date, logs):
-    from scripts.load_markets import PERP_MARKETS, SPOT_MARKETS
+# Codec per record type, e.g. {"tradeRecords": Codec("zstd", 3)}, anything
+# not listed is written with DEFAULT_CODEC
+OUTPUT_CODECS: dict[str, Codec] = {}
 
-    userTradesMap = {}
-    marketTradesMap = {}
 
-    trades["logs"] = trades["tx_id"].apply(
-        lambda x: list(
-            filter(lambda event: event.name == "OrderActionRecord", logs.get(x, []))
-        )
+def codec_for(object_path):
+    # Object paths end in <recordType>/<year>/<yyyymmdd>
+    return OUTPUT_CODECS.get(object_path.split("/")[-3], DEFAULT_CODEC)
+
+
+# Objects whose content hash matches the last upload are not uploaded again
+SKIP_UNCHANGED = True
+UPLOAD_MANIFEST: UploadManifest | None = None
+
+
+def get_upload_manifest():
+    global UPLOAD_MANIFEST
+    if UPLOAD_MANIFEST is None:
+        UPLOAD_MANIFEST = UploadManifest(get_sink().manifest_path)
+    return UPLOAD_MANIFEST
+
+
+def _reset_upload_manifest():
+    # sqlite connections must not be shared with a forked child
+    global UPLOAD_MANIFEST
+    UPLOAD_MANIFEST = None
+
+
+os.register_at_fork(after_in_child=_reset_upload_manifest)
+
+
+def put_csv(object_path, df_to_write):
+    put_csv_frames(
+        object_path,
+        df_to_write.columns,
+        lambda: [df_to_write],
+        df_to_write.attrs.get("exponents"),
     )
 
-    if not sanity_check(trades):
-        print("Potentially missing data around 0:01, 12:00, or 23:59")
 
-    for _, row in trades.iterrows():
-        logs = row["logs"]
-        for log in logs:
-            parsed = parse_event(
-                log, {"slot": row["block_slot"], "tx_sig": row["tx_id"]}
+def put_csv_frames(object_path, columns, frames, exponents=None, on_frame=None):
+    """Write the frames of frames(), which have the given columns, as one object
+
+    frames() is read once, every frame is hashed while it is serialized, so the
+    frames need not be held together. Objects smaller than a compression block
+    are kept uncompressed and compressed on the compression pool while this
+    thread moves on, larger ones are compressed into a spooled temporary file as
+    they are serialized. Nothing is compressed or uploaded when the object is
+    unchanged. on_frame is called with every frame.
+    """
+    manifest = get_upload_manifest()
+    codec = codec_for(object_path)
+    salt = ["csv", codec.name, codec.level]
+    metadata = {}
+    if exponents:
+        metadata[EXPONENTS_METADATA_KEY] = format_exponents(exponents)
+        salt.append(metadata[EXPONENTS_METADATA_KEY])
+
+    # Objects up to one upload part stay in memory
+    with tempfile.SpooledTemporaryFile(max_size=MULTIPART_PART_SIZE) as spool:
+        with BufferedCompressor(codec, spool) as compressed:
+
+            def serialized():
+                header = True
+                for df in frames():
+                    if on_frame is not None:
+                        on_frame(df)
+                    df.to_csv(compressed, index=False, header=header)
+                    header = False
+                    yield df
+                if header:
+                    pd.DataFrame(columns=columns).to_csv(compressed, index=False)
+
+            digest = content_hash_frames(columns, serialized(), *salt)
+        previous = manifest.get(object_path)
+        if SKIP_UNCHANGED and previous == digest:
+            manifest.record(object_path, digest, "skipped", remember=False)
+            return
+
+        s3_io = get_s3_io()
+        if compressed.small:
+            s3_io.submit(
+                upload_if_changed(
+                    get_sink(),
+                    manifest,
+                    object_path,
+                    compress_on_pool(codec, bytes(compressed.buffer)),
+                    codec,
+                    digest,
+                    previous,
+                    metadata,
+                )
+            )
+            return
+
+        # Large objects are uploading while the rest is still being copied
+        parts = s3_io.open_stream()
+        s3_io.submit(
+            upload_if_changed(
+                get_sink(),
+                manifest,
+                object_path,
+                parts,
+                codec,
+                digest,
+                previous,
+                metadata,
             )
+        )
+        spool.seek(0)
+        with parts:
+            shutil.copyfileobj(spool, parts, MULTIPART_PART_SIZE)
+
+
+async def upload_if_changed(
+    sink, manifest, object_path, body, codec, digest, previous, metadata=None
+):
+    """Upload body unless the object already holds it
+
+    body is the PartWriter the object is being written to, or a coroutine
+    returning the compressed object, which runs while the object is checked.
+    Objects missing from the local manifest are checked against the content hash
+    stored in their metadata. metadata is stored along with the hash.
+    """
+    streamed = isinstance(body, PartWriter)
+    if not streamed:
+        body = asyncio.ensure_future(body)
+
+    async def discard():
+        if streamed:
+            await body.discard()
+        else:
+            body.cancel()
+
+    exists = previous is not None
+    if not exists:
+        try:
+            head = await sink.head(object_path)
+        except BaseException:
+            await discard()
+            raise
+        exists = head is not None
+        if exists and head.get(CONTENT_HASH_METADATA_KEY) == digest:
+            if SKIP_UNCHANGED:
+                await discard()
+                manifest.record(object_path, digest, "skipped")
+                return
+
+    kwargs = {
+        "content_type": "text/csv",
+        "content_encoding": codec.content_encoding,
+        "metadata": {**(metadata or {}), CONTENT_HASH_METADATA_KEY: digest},
+    }
+    if streamed:
+        await sink.put_stream(object_path, body, **kwargs)
+    else:
+        await sink.put(object_path, await body, **kwargs)
+    manifest.record(object_path, digest, "changed" if exists else "written")
+
+
+def read_existing_csv(object_path, **kwargs):
+    body = get_s3_io().run(get_sink().get(object_path))
+    if body is None:
+        return None
+    return pd.read_csv(io.BytesIO(decompress(body)), **kwargs)
+
+
+# Set while following, writes are then merged into the day's existing objects
+OUTPUT_MERGER: OutputMerger | None = None
+
+
+def write_csv(object_path, df_to_write, dedup_subset, sort_by=None):
+    """De-duplicate and write one gzipped csv object"""
+    if OUTPUT_MERGER is not None:
+        OUTPUT_MERGER.add(object_path, df_to_write, dedup_subset, sort_by)
+        return
+
+    df_to_write = df_to_write.drop_duplicates(subset=dedup_subset)
+    if sort_by is not None:
+        df_to_write = df_to_write.sort_values(sort_by, kind="stable")
+    record_activity(object_path, df_to_write)
+    record_signatures(object_path, df_to_write)
+    put_csv(object_path, df_to_write)
+
+
+def write_merged_csv(object_path, runs, key, dedup_subset, on_frame=None):
+    """write_csv of the rows of runs, each sorted by key, through a k-way merge
+
+    The runs are merged, converted, de-duplicated and serialized one batch at a
+    time, see scripts/merge.py. on_frame is called with every batch. Not for user
+    objects, whose activity is summarized from the whole frame.
+    """
+    frames = merged_frames(runs, key, dedup_subset)
+    exponents = column_exponents(runs[0].schema)
+    if OUTPUT_MERGER is not None:
+        df = pd.concat(list(frames()), ignore_index=True)
+        if exponents:
+            df.attrs["exponents"] = exponents
+        if on_frame is not None:
+            on_frame(df)
+        OUTPUT_MERGER.add(object_path, df, dedup_subset, key)
+        return
+
+    def recorded(df):
+        record_signatures(object_path, df)
+        if on_frame is not None:
+            on_frame(df)
+
+    put_csv_frames(object_path, runs[0].column_names, frames, exponents, recorded)
+
+
+# "compact" writes only the columns of each record's liquidation type, "wide"
+# every sub-struct's columns
+LIQUIDATION_LAYOUT = "compact"
+# Amounts are written as exact integers, with the decimal exponent of every
+# such column in the object metadata, rather than divided into floats
+FIXED_POINT = False
+
+
+def parse_log_event(log, block_slot, tx_id):
+    """parse_event with the run's output options"""
+    return parse_event(
+        log,
+        {"slot": block_slot, "tx_sig": tx_id},
+        liquidation_layout=LIQUIDATION_LAYOUT,
+        fixed_point=FIXED_POINT,
+    )
+
+
+def parse_trades(trades: pa.Table, events):
+    """Parsed OrderActionRecords of the partition's transactions, in row order"""
+    for tx_id, block_slot in iter_transactions(trades):
+        for log in events.get(tx_id, []):
+            parsed = parse_log_event(log, block_slot, tx_id)
             parsed["programId"] = PROGRAM_ID
+            yield parsed
 
-            marketType = "perp" if parsed["marketType"] == "perp" else "spot"
-            market: PerpMarket | SpotMarket = next(
-                filter(
-                    lambda m: m.marketIndex == parsed["marketIndex"],
-                    PERP_MARKETS if marketType == "perp" else SPOT_MARKETS,
-                ),
-                None,
-            )
-            marketSymbol = market.symbol
 
-            ## Log for maker
-            if parsed["maker"] is not None:
-                userPrefix = (
-                    "program/"
-                    + PROGRAM_ID
-                    + "/user/{}/tradeRecords/{}".format(parsed["maker"], date.year)
-                )
-                if userPrefix not in userTradesMap:
-                    userTradesMap[userPrefix] = []
-                userTradesMap[userPrefix].append(parsed)
+def trade_prefixes(parsed, year):
+    """(user prefixes, market prefix) of the objects a parsed trade is written to"""
+    from scripts.load_markets import PERP_MARKETS, SPOT_MARKETS
 
-            ## Log for taker
-            if parsed["taker"] is not None:
-                userPrefix = (
-                    "program/"
-                    + PROGRAM_ID
-                    + "/user/{}/tradeRecords/{}".format(parsed["taker"], date.year)
-                )
-                if userPrefix not in userTradesMap:
-                    userTradesMap[userPrefix] = []
-                userTradesMap[userPrefix].append(parsed)
+    marketType = "perp" if parsed["marketType"] == "perp" else "spot"
+    market: PerpMarket | SpotMarket = next(
+        filter(
+            lambda m: m.marketIndex == parsed["marketIndex"],
+            PERP_MARKETS if marketType == "perp" else SPOT_MARKETS,
+        ),
+        None,
+    )
+    marketSymbol = market.symbol
+
+    ## Maker first, then taker
+    userPrefixes = [
+        "program/"
+        + PROGRAM_ID
+        + "/user/{}/tradeRecords/{}".format(pubkey_str(parsed[side]), year)
+        for side in ("maker", "taker")
+        if parsed[side] is not None
+    ]
+    marketPrefix = (
+        "program/"
+        + PROGRAM_ID
+        + "/market/{}/tradeRecords/{}".format(marketSymbol, year)
+    )
+    return userPrefixes, marketPrefix
+
+
+def process_trades(trades: pa.Table, date, events, shard=None, parsed_trades=None):
+    """Write per-user and per-market trade records, and per-market rollups
+
+    shard is an optional (index, count) pair, when set only the user and market
+    objects whose key hashes into that shard are written. parsed_trades, the
+    trades already parsed by parse_trades() as one iterable per source, replaces
+    decoding events.
+    """
+    with ipc_dir(keyed_spill_dir()) as spill_dir:
+        write_trades(trades, date, events, shard, parsed_trades, spill_dir)
+
+
+def keyed_spill_dir():
+    """Where KeyedEvents runs are spilled, see MemoryGovernor.spill_dir"""
+    spill_dir = get_memory_governor().spill_dir
+    os.makedirs(spill_dir, exist_ok=True)
+    return spill_dir
 
-            # Log for market
-            marketPrefix = (
-                "program/"
-                + PROGRAM_ID
-                + "/market/{}/tradeRecords/{}".format(marketSymbol, date.year)
-            )
-            if marketPrefix not in marketTradesMap:
-                marketTradesMap[marketPrefix] = []
-            marketTradesMap[marketPrefix].append(parsed)
-
-    for marketPrefix in marketTradesMap.keys():
-        df_to_write = pd.DataFrame(marketTradesMap[marketPrefix])
-        ## De-duplicate
-        df_to_write = df_to_write.drop_duplicates(
-            subset=[
-                "txSig",
-                "taker",
-                "maker",
-                "takerOrderId",
-                "makerOrderId",
-                "marketIndex",
-                "marketType",
-                "action",
-                "fillRecordId",
-                "baseAssetAmountFilled",
-            ]
-        )
 
+def write_trades(trades, date, events, shard, parsed_trades, spill_dir):
+    # Parsed trades are kept as sorted runs spilled to spill_dir, cut at the end
+    # of every source, so neither the parsed dicts nor a market's day of fills
+    # are ever held in memory whole
+    userTradesMap = KeyedEvents(spill_dir=spill_dir)
+    marketTradesMap = KeyedEvents(sort_key="fillRecordId", spill_dir=spill_dir)
+
+    if (shard is None or shard[0] == 0) and not sanity_check(trades):
+        print("Potentially missing data around 0:01, 12:00, or 23:59")
+
+    if parsed_trades is None:
+        parsed_trades = [parse_trades(trades, events)]
+    for source in parsed_trades:
+        for parsed in source:
+            userPrefixes, marketPrefix = trade_prefixes(parsed, date.year)
+            for userPrefix in userPrefixes:
+                if in_shard(userPrefix, shard):
+                    userTradesMap.add(userPrefix, parsed)
+            if in_shard(marketPrefix, shard):
+                marketTradesMap.add(marketPrefix, parsed)
+        userTradesMap.cut_run()
+        marketTradesMap.cut_run()
+
+    # Market objects are the largest, they are sorted and de-duplicated by a
+    # streaming merge of their runs rather than as whole frames
+    for marketPrefix, runs in marketTradesMap.runs():
         ## Spot check missing fills before writing
-        df_to_write = df_to_write[df_to_write["baseAssetAmountFilled"] != 0]
-        df_to_write.dropna(subset=["fillRecordId"], inplace=True)
-        if len(df_to_write) == 0:
+        fills = [
+            run.filter(
+                pc.and_(
+                    pc.fill_null(pc.not_equal(run["baseAssetAmountFilled"], 0), True),
+                    pc.is_valid(run["fillRecordId"]),
+                )
+            )
+            for run in runs
+        ]
+        if sum(run.num_rows for run in fills) == 0:
             print(f"No fills for {marketPrefix} on {date}")
             continue
-        df_to_write = df_to_write.sort_values("fillRecordId")
-        full_range = pd.Series(
-            range(
-                int(df_to_write["fillRecordId"].min()),
-                int(df_to_write["fillRecordId"].max()) + 1,
-            )
+        fill_ids = np.unique(
+            np.concatenate([run["fillRecordId"].to_numpy() for run in fills])
+        )
+        missing_values = set(
+            np.setdiff1d(np.arange(fill_ids[0], fill_ids[-1] + 1), fill_ids).tolist()
         )
-        missing_values = set(full_range) - set(df_to_write["fillRecordId"])
         if len(missing_values) > 0:
             print(
                 f"Missing values for market {marketPrefix}, length: ",
@@ -204,74 +537,48 @@ def process_trades(trades: pd.DataFrame, date, logs):
         else:
             print(f"No missing fill record ids for {marketPrefix} on {date}")
 
-        csv_buffer = io.BytesIO()
-        df_to_write = df_to_write.drop_duplicates(
-            subset=[
-                "txSig",
-                "taker",
-                "maker",
-                "takerOrderId",
-                "makerOrderId",
-                "marketIndex",
-                "marketType",
-                "action",
-                "fillRecordId",
-                "baseAssetAmountFilled",
-            ]
-        )
-        df_to_write.to_csv(csv_buffer, index=False, compression="gzip")
         object_path = "{}/{}".format(marketPrefix, date.strftime("%Y%m%d"))
-        DESTINATION_BUCKET.put_object(
-            Key=object_path,
-            Body=csv_buffer.getvalue(),
-            ContentType="text/csv",
-            ContentEncoding="gzip",
+        # Rollups of a partial day cannot be merged, while following they are
+        # only written when the day is finalized. Otherwise every merged batch
+        # is rolled up as it is written and the batches' rollups combined
+        rollup_parts = []
+        exponents = column_exponents(fills[0].schema)
+
+        def roll_up(df):
+            if OUTPUT_MERGER is None:
+                batch = df[ROLLUP_COLUMNS]
+                batch.attrs["exponents"] = exponents
+                rollup_parts.append(market_rollups(batch))
+
+        write_merged_csv(
+            object_path, fills, "fillRecordId", TRADE_DEDUP_COLUMNS, on_frame=roll_up
         )
 
-    for userPrefix in userTradesMap.keys():
-        df_to_write = pd.DataFrame(userTradesMap[userPrefix])
-        ## De-duplicate
-        df_to_write = df_to_write.drop_duplicates(
-            subset=[
-                "txSig",
-                "taker",
-                "maker",
-                "takerOrderId",
-                "makerOrderId",
-                "marketIndex",
-                "marketType",
-                "action",
-                "fillRecordId",
-                "baseAssetAmountFilled",
-            ]
-        )
+        if OUTPUT_MERGER is None:
+            for record_type, rollup in merge_rollups(rollup_parts).items():
+                write_csv(
+                    "{}/{}/{}/{}".format(
+                        marketPrefix.rsplit("/", 2)[0],
+                        record_type,
+                        date.year,
+                        date.strftime("%Y%m%d"),
+                    ),
+                    rollup,
+                    dedup_subset=["ts"],
+                )
 
-        csv_buffer = io.BytesIO()
-        df_to_write.to_csv(csv_buffer, index=False, compression="gzip")
+    for userPrefix, df_to_write in userTradesMap.frames():
         object_path = "{}/{}".format(userPrefix, date.strftime("%Y%m%d"))
-        DESTINATION_BUCKET.put_object(
-            Key=object_path,
-            Body=csv_buffer.getvalue(),
-            ContentType="text/csv",
-            ContentEncoding="gzip",
-        )
+        ## De-duplicate and write
+        write_csv(object_path, df_to_write, dedup_subset=TRADE_DEDUP_COLUMNS)
 
 
-def process_settle_pnl(records, date, logs):
-    userMap = {}
+def process_settle_pnl(records, date, events, shard=None):
+    userMap = KeyedEvents()
 
-    records["logs"] = records["tx_id"].apply(
-        lambda x: list(
-            filter(lambda event: event.name == "SettlePnlRecord", logs.get(x, []))
-        )
-    )
-
-    for _, row in records.iterrows():
-        logs = row["logs"]
-        for log in logs:
-            parsed = parse_event(
-                log, {"slot": row["block_slot"], "tx_sig": row["tx_id"]}
-            )
+    for tx_id, block_slot in iter_transactions(records):
+        for log in events.get(tx_id, []):
+            parsed = parse_log_event(log, block_slot, tx_id)
             parsed["programId"] = PROGRAM_ID
 
             ## Log for taker
@@ -279,45 +586,27 @@ def process_settle_pnl(records, date, logs):
                 userPrefix = (
                     "program/"
                     + PROGRAM_ID
-                    + "/user/{}/settlePnlRecords/{}".format(parsed["user"], date.year)
+                    + "/user/{}/settlePnlRecords/{}".format(
+                        pubkey_str(parsed["user"]), date.year
+                    )
                 )
-                if userPrefix not in userMap:
-                    userMap[userPrefix] = []
-                userMap[userPrefix].append(parsed)
-
-    for userPrefix in userMap.keys():
-        df_to_write = pd.DataFrame(userMap[userPrefix])
-        ## De-duplicate
-        df_to_write = df_to_write.drop_duplicates(
-            subset=["txSig", "marketIndex", "user"]
-        )
+                if in_shard(userPrefix, shard):
+                    userMap.add(userPrefix, parsed)
 
-        csv_buffer = io.BytesIO()
-        df_to_write.to_csv(csv_buffer, index=False, compression="gzip")
+    for userPrefix, df_to_write in userMap.frames():
         object_path = "{}/{}".format(userPrefix, date.strftime("%Y%m%d"))
-        DESTINATION_BUCKET.put_object(
-            Key=object_path,
-            Body=csv_buffer.getvalue(),
-            ContentType="text/csv",
-            ContentEncoding="gzip",
+        ## De-duplicate and write
+        write_csv(
+            object_path, df_to_write, dedup_subset=["txSig", "marketIndex", "user"]
         )
 
 
-def process_deposit(records, date, logs):
-    userMap = {}
+def process_deposit(records, date, events, shard=None):
+    userMap = KeyedEvents()
 
-    records["logs"] = records["tx_id"].apply(
-        lambda x: list(
-            filter(lambda event: event.name == "DepositRecord", logs.get(x, []))
-        )
-    )
-
-    for _, row in records.iterrows():
-        logs = row["logs"]
-        for log in logs:
-            parsed = parse_event(
-                log, {"slot": row["block_slot"], "tx_sig": row["tx_id"]}
-            )
+    for tx_id, block_slot in iter_transactions(records):
+        for log in events.get(tx_id, []):
+            parsed = parse_log_event(log, block_slot, tx_id)
             parsed["programId"] = PROGRAM_ID
 
             ## Log for taker
@@ -325,51 +614,35 @@ def process_deposit(records, date, logs):
                 userPrefix = (
                     "program/"
                     + PROGRAM_ID
-                    + "/user/{}/depositRecords/{}".format(parsed["user"], date.year)
+                    + "/user/{}/depositRecords/{}".format(
+                        pubkey_str(parsed["user"]), date.year
+                    )
                 )
-                if userPrefix not in userMap:
-                    userMap[userPrefix] = []
-                userMap[userPrefix].append(parsed)
-
-    for userPrefix in userMap.keys():
-        df_to_write = pd.DataFrame(userMap[userPrefix])
-        ## De-duplicate
-        df_to_write = df_to_write.drop_duplicates(
-            subset=[
+                if in_shard(userPrefix, shard):
+                    userMap.add(userPrefix, parsed)
+
+    for userPrefix, df_to_write in userMap.frames():
+        object_path = "{}/{}".format(userPrefix, date.strftime("%Y%m%d"))
+        ## De-duplicate and write
+        write_csv(
+            object_path,
+            df_to_write,
+            dedup_subset=[
                 "txSig",
                 "marketIndex",
                 "depositRecordId",
-            ]
-        )
-
-        csv_buffer = io.BytesIO()
-        df_to_write.to_csv(csv_buffer, index=False, compression="gzip")
-        object_path = "{}/{}".format(userPrefix, date.strftime("%Y%m%d"))
-        DESTINATION_BUCKET.put_object(
-            Key=object_path,
-            Body=csv_buffer.getvalue(),
-            ContentType="text/csv",
-            ContentEncoding="gzip",
+            ],
         )
 
 
-def process_insurance_fund(records, date, logs):
+def process_insurance_fund(records, date, events, shard=None):
     from scripts.load_markets import SPOT_MARKETS
 
-    marketMap = {}
+    marketMap = KeyedEvents()
 
-    records["logs"] = records["tx_id"].apply(
-        lambda x: list(
-            filter(lambda event: event.name == "InsuranceFundRecord", logs.get(x, []))
-        )
-    )
-
-    for _, row in records.iterrows():
-        logs = row["logs"]
-        for log in logs:
-            parsed = parse_event(
-                log, {"slot": row["block_slot"], "tx_sig": row["tx_id"]}
-            )
+    for tx_id, block_slot in iter_transactions(records):
+        for log in events.get(tx_id, []):
+            parsed = parse_log_event(log, block_slot, tx_id)
             parsed["programId"] = PROGRAM_ID
 
             ## Log for market
@@ -386,46 +659,25 @@ def process_insurance_fund(records, date, logs):
                 + PROGRAM_ID
                 + "/market/{}/insuranceFundRecords/{}".format(market.symbol, date.year)
             )
-            if marketPrefix not in marketMap:
-                marketMap[marketPrefix] = []
-            marketMap[marketPrefix].append(parsed)
-
-    for marketPrefix in marketMap.keys():
-        df_to_write = pd.DataFrame(marketMap[marketPrefix])
-        ## De-duplicate
-        df_to_write = df_to_write.drop_duplicates(
-            subset=["txSig", "ts", "perpMarketIndex", "spotMarketIndex"]
-        )
+            if in_shard(marketPrefix, shard):
+                marketMap.add(marketPrefix, parsed)
 
-        csv_buffer = io.BytesIO()
-        df_to_write.to_csv(csv_buffer, index=False, compression="gzip")
+    for marketPrefix, df_to_write in marketMap.frames():
         object_path = "{}/{}".format(marketPrefix, date.strftime("%Y%m%d"))
-        DESTINATION_BUCKET.put_object(
-            Key=object_path,
-            Body=csv_buffer.getvalue(),
-            ContentType="text/csv",
-            ContentEncoding="gzip",
+        ## De-duplicate and write
+        write_csv(
+            object_path,
+            df_to_write,
+            dedup_subset=["txSig", "ts", "perpMarketIndex", "spotMarketIndex"],
         )
 
 
-def process_insurance_fund_stake(records, date, logs):
-    userMap = {}
-
-    records["logs"] = records["tx_id"].apply(
-        lambda x: list(
-            filter(
-                lambda event: event.name == "InsuranceFundStakeRecord",
-                logs.get(x, []),
-            )
-        )
-    )
+def process_insurance_fund_stake(records, date, events, shard=None):
+    userMap = KeyedEvents()
 
-    for _, row in records.iterrows():
-        logs = row["logs"]
-        for log in logs:
-            parsed = parse_event(
-                log, {"slot": row["block_slot"], "tx_sig": row["tx_id"]}
-            )
+    for tx_id, block_slot in iter_transactions(records):
+        for log in events.get(tx_id, []):
+            parsed = parse_log_event(log, block_slot, tx_id)
             parsed["programId"] = PROGRAM_ID
 
             ## Log for taker
@@ -434,46 +686,28 @@ def process_insurance_fund_stake(records, date, logs):
                     "program/"
                     + PROGRAM_ID
                     + "/authority/{}/insuranceFundStakeRecords/{}".format(
-                        parsed["userAuthority"], date.year
+                        pubkey_str(parsed["userAuthority"]), date.year
                     )
                 )
-                if userPrefix not in userMap:
-                    userMap[userPrefix] = []
-                userMap[userPrefix].append(parsed)
-
-    for userPrefix in userMap.keys():
-        df_to_write = pd.DataFrame(userMap[userPrefix])
-        ## De-duplicate
-        df_to_write = df_to_write.drop_duplicates(
-            subset=["txSig", "ts", "marketIndex", "userAuthority"]
-        )
+                if in_shard(userPrefix, shard):
+                    userMap.add(userPrefix, parsed)
 
-        csv_buffer = io.BytesIO()
-        df_to_write.to_csv(csv_buffer, index=False, compression="gzip")
+    for userPrefix, df_to_write in userMap.frames():
         object_path = "{}/{}".format(userPrefix, date.strftime("%Y%m%d"))
-        DESTINATION_BUCKET.put_object(
-            Key=object_path,
-            Body=csv_buffer.getvalue(),
-            ContentType="text/csv",
-            ContentEncoding="gzip",
+        ## De-duplicate and write
+        write_csv(
+            object_path,
+            df_to_write,
+            dedup_subset=["txSig", "ts", "marketIndex", "userAuthority"],
         )
 
 
-def process_liquidation(records, date, logs):
-    userMap = {}
-
-    records["logs"] = records["tx_id"].apply(
-        lambda x: list(
-            filter(lambda event: event.name == "LiquidationRecord", logs.get(x, []))
-        )
-    )
+def process_liquidation(records, date, events, shard=None):
+    userMap = KeyedEvents()
 
-    for _, row in records.iterrows():
-        logs = row["logs"]
-        for log in logs:
-            parsed = parse_event(
-                log, {"slot": row["block_slot"], "tx_sig": row["tx_id"]}
-            )
+    for tx_id, block_slot in iter_transactions(records):
+        for log in events.get(tx_id, []):
+            parsed = parse_log_event(log, block_slot, tx_id)
             parsed["programId"] = PROGRAM_ID
 
             ## Log for taker
@@ -481,48 +715,34 @@ def process_liquidation(records, date, logs):
                 userPrefix = (
                     "program/"
                     + PROGRAM_ID
-                    + "/user/{}/liquidationRecords/{}".format(parsed["user"], date.year)
+                    + "/user/{}/liquidationRecords/{}".format(
+                        pubkey_str(parsed["user"]), date.year
+                    )
                 )
-                if userPrefix not in userMap:
-                    userMap[userPrefix] = []
-                userMap[userPrefix].append(parsed)
-
-    for userPrefix in userMap.keys():
-        df_to_write = pd.DataFrame(userMap[userPrefix])
-        ## De-duplicate
-        df_to_write = df_to_write.drop_duplicates(
-            subset=[
+                if in_shard(userPrefix, shard):
+                    userMap.add(userPrefix, parsed)
+
+    for userPrefix, df_to_write in userMap.frames():
+        object_path = "{}/{}".format(userPrefix, date.strftime("%Y%m%d"))
+        ## De-duplicate and write
+        write_csv(
+            object_path,
+            df_to_write,
+            dedup_subset=[
                 "txSig",
                 "user",
                 "liquidationId",
                 "marginRequirement",
-            ]
-        )
-
-        csv_buffer = io.BytesIO()
-        df_to_write.to_csv(csv_buffer, index=False, compression="gzip")
-        object_path = "{}/{}".format(userPrefix, date.strftime("%Y%m%d"))
-        DESTINATION_BUCKET.put_object(
-            Key=object_path,
-            Body=csv_buffer.getvalue(),
-            ContentType="text/csv",
-            ContentEncoding="gzip",
+            ],
         )
 
 
-def process_lp(records, date, logs):
-    userMap = {}
+def process_lp(records, date, events, shard=None):
+    userMap = KeyedEvents()
 
-    records["logs"] = records["tx_id"].apply(
-        lambda x: list(filter(lambda event: event.name == "LPRecord", logs.get(x, [])))
-    )
-
-    for _, row in records.iterrows():
-        logs = row["logs"]
-        for log in logs:
-            parsed = parse_event(
-                log, {"slot": row["block_slot"], "tx_sig": row["tx_id"]}
-            )
+    for tx_id, block_slot in iter_transactions(records):
+        for log in events.get(tx_id, []):
+            parsed = parse_log_event(log, block_slot, tx_id)
             parsed["programId"] = PROGRAM_ID
 
             ## Log for taker
@@ -530,47 +750,29 @@ def process_lp(records, date, logs):
                 userPrefix = (
                     "program/"
                     + PROGRAM_ID
-                    + "/user/{}/lpRecord/{}".format(parsed["user"], date.year)
+                    + "/user/{}/lpRecord/{}".format(
+                        pubkey_str(parsed["user"]), date.year
+                    )
                 )
-                if userPrefix not in userMap:
-                    userMap[userPrefix] = []
-                userMap[userPrefix].append(parsed)
-
-    for userPrefix in userMap.keys():
-        df_to_write = pd.DataFrame(userMap[userPrefix])
-        ## De-duplicate
-        df_to_write = df_to_write.drop_duplicates(
-            subset=["txSig", "user", "marketIndex"]
-        )
+                if in_shard(userPrefix, shard):
+                    userMap.add(userPrefix, parsed)
 
-        csv_buffer = io.BytesIO()
-        df_to_write.to_csv(csv_buffer, index=False, compression="gzip")
+    for userPrefix, df_to_write in userMap.frames():
         object_path = "{}/{}".format(userPrefix, date.strftime("%Y%m%d"))
-        DESTINATION_BUCKET.put_object(
-            Key=object_path,
-            Body=csv_buffer.getvalue(),
-            ContentType="text/csv",
-            ContentEncoding="gzip",
+        ## De-duplicate and write
+        write_csv(
+            object_path, df_to_write, dedup_subset=["txSig", "user", "marketIndex"]
         )
 
 
-def process_funding_rate(records, date, logs):
+def process_funding_rate(records, date, events, shard=None):
     from scripts.load_markets import PERP_MARKETS
 
-    marketMap = {}
-
-    records["logs"] = records["tx_id"].apply(
-        lambda x: list(
-            filter(lambda event: event.name == "FundingRateRecord", logs.get(x, []))
-        )
-    )
+    marketMap = KeyedEvents()
 
-    for _, row in records.iterrows():
-        logs = row["logs"]
-        for log in logs:
-            parsed = parse_event(
-                log, {"slot": row["block_slot"], "tx_sig": row["tx_id"]}
-            )
+    for tx_id, block_slot in iter_transactions(records):
+        for log in events.get(tx_id, []):
+            parsed = parse_log_event(log, block_slot, tx_id)
             parsed["programId"] = PROGRAM_ID
 
             ## Log for market
@@ -584,47 +786,29 @@ def process_funding_rate(records, date, logs):
                 + PROGRAM_ID
                 + "/market/{}/fundingRateRecords/{}".format(market.symbol, date.year)
             )
-            if marketPrefix not in marketMap:
-                marketMap[marketPrefix] = []
-            marketMap[marketPrefix].append(parsed)
-
-    for marketPrefix in marketMap.keys():
-        df_to_write = pd.DataFrame(marketMap[marketPrefix])
-        ## De-duplicate
-        df_to_write = df_to_write.drop_duplicates(
-            subset=[
+            if in_shard(marketPrefix, shard):
+                marketMap.add(marketPrefix, parsed)
+
+    for marketPrefix, df_to_write in marketMap.frames():
+        object_path = "{}/{}".format(marketPrefix, date.strftime("%Y%m%d"))
+        ## De-duplicate and write
+        write_csv(
+            object_path,
+            df_to_write,
+            dedup_subset=[
                 "txSig",
                 "marketIndex",
                 "recordId",
-            ]
-        )
-
-        csv_buffer = io.BytesIO()
-        df_to_write.to_csv(csv_buffer, index=False, compression="gzip")
-        object_path = "{}/{}".format(marketPrefix, date.strftime("%Y%m%d"))
-        DESTINATION_BUCKET.put_object(
-            Key=object_path,
-            Body=csv_buffer.getvalue(),
-            ContentType="text/csv",
-            ContentEncoding="gzip",
+            ],
         )
 
 
-def process_funding_payment(records, date, logs):
-    userMap = {}
+def process_funding_payment(records, date, events, shard=None):
+    userMap = KeyedEvents()
 
-    records["logs"] = records["tx_id"].apply(
-        lambda x: list(
-            filter(lambda event: event.name == "FundingPaymentRecord", logs.get(x, []))
-        )
-    )
-
-    for _, row in records.iterrows():
-        logs = row["logs"]
-        for log in logs:
-            parsed = parse_event(
-                log, {"slot": row["block_slot"], "tx_sig": row["tx_id"]}
-            )
+    for tx_id, block_slot in iter_transactions(records):
+        for log in events.get(tx_id, []):
+            parsed = parse_log_event(log, block_slot, tx_id)
             parsed["programId"] = PROGRAM_ID
 
             ## Log for taker
@@ -633,245 +817,1188 @@ def process_funding_payment(records, date, logs):
                     "program/"
                     + PROGRAM_ID
                     + "/user/{}/fundingPaymentRecords/{}".format(
-                        parsed["user"], date.year
+                        pubkey_str(parsed["user"]), date.year
                     )
                 )
-                if userPrefix not in userMap:
-                    userMap[userPrefix] = []
-                userMap[userPrefix].append(parsed)
-
-    for userPrefix in userMap.keys():
-        df_to_write = pd.DataFrame(userMap[userPrefix])
+                if in_shard(userPrefix, shard):
+                    userMap.add(userPrefix, parsed)
 
-        ## De-duplicate
-        df_to_write = df_to_write.drop_duplicates(
-            subset=["txSig", "user", "marketIndex", "userLastCumulativeFunding"]
-        )
+    for userPrefix, df_to_write in userMap.frames():
 
-        csv_buffer = io.BytesIO()
-        df_to_write.to_csv(csv_buffer, index=False, compression="gzip")
         object_path = "{}/{}".format(userPrefix, date.strftime("%Y%m%d"))
-        DESTINATION_BUCKET.put_object(
-            Key=object_path,
-            Body=csv_buffer.getvalue(),
-            ContentType="text/csv",
-            ContentEncoding="gzip",
+        ## De-duplicate and write
+        write_csv(
+            object_path,
+            df_to_write,
+            dedup_subset=["txSig", "user", "marketIndex", "userLastCumulativeFunding"],
         )
 
 
-def read_and_filter_file(file_key, read_credentials, file_date):
-    event_types_to_read = []
-    for event_type in EVENT_TYPES:
-        try:
-            with open("./out/{}.txt".format(event_type), "r") as file:
-                last_processed_date = pd.to_datetime(file.read()).date()
-                if file_date > last_processed_date:
-                    event_types_to_read.append(event_type)
-                else:
-                    print("Date already processed for event {}".format(event_type))
-        except:
-            event_types_to_read.append(event_type)
+def build_read_filter(event_types):
+    """Arrow predicate selecting the given event types, keeping only Fill order actions"""
+    event_type = pc.field("event_type")
+    return event_type.isin(event_types) & (
+        (event_type != "OrderActionRecord") | (pc.field("args", "action") == "Fill")
+    )
 
-    attempts = 0
-    while attempts < 3:
-        try:
-            return pd.read_parquet(
-                f"s3://drift-topledger/{file_key}",
-                filters=[[("event_type", "=", y)] for y in event_types_to_read],
-                storage_options={
-                    "key": read_credentials["access_key"],
-                    "secret": read_credentials["secret_key"],
-                },
-            )
-        except Exception as e:
-            attempts += 1
-            if attempts < 3:
-                print(f"Retrying file {file_key}...")
-                time.sleep(3)
-                continue
-            else:
-                print(f"Failed to read file {file_key}. Error: {e}")
-                return pd.DataFrame()  # Return empty DataFrame in case of failure
+
+async def read_and_filter_file(file_key, event_types, holding=None):
+    """Read one events file from the source, S3 errors are retried and then raised
+
+    Only the partition columns are materialized, args and logs never leave the file.
+    With a memory Holding, the read waits while the budget is exhausted.
+    """
+    if holding is not None:
+        await holding.governor.wait_for_room()
+    return await get_source().read_table(
+        file_key,
+        columns=[*PARTITION_COLUMNS, "event_type"],
+        filters=build_read_filter(event_types),
+    )
+
+
+async def read_event_files(files, event_types, holding=None):
+    return await asyncio.gather(
+        *(read_and_filter_file(file, event_types, holding) for file in files)
+    )
+
+
+EVENT_PROCESSORS = {
+    "OrderActionRecord": process_trades,
+    "SettlePnlRecord": process_settle_pnl,
+    "DepositRecord": process_deposit,
+    "InsuranceFundRecord": process_insurance_fund,
+    "InsuranceFundStakeRecord": process_insurance_fund_stake,
+    "LiquidationRecord": process_liquidation,
+    "LPRecord": process_lp,
+    "FundingRateRecord": process_funding_rate,
+    "FundingPaymentRecord": process_funding_payment,
+}
+
+
+def partition_by_event_type(table: pa.Table):
+    """Split the day's events into one table per event type
+
+    The rows are sorted by event type once (stable, so rows keep their file
+    order) and every partition is taken from its range of the order. Partitions
+    own their buffers, spilling one frees its memory.
+    """
+    order = pc.sort_indices(table["event_type"])
+    counts = pc.value_counts(table["event_type"].take(order))
+    partitions = {}
+    offset = 0
+    for event_type, count in zip(
+        counts.field("values").to_pylist(), counts.field("counts").to_pylist()
+    ):
+        partitions[event_type] = table.take(order.slice(offset, count))
+        offset += count
+    return partitions
 
 
-def process_event_type(event, df_filtered, date, logs):
+def read_checkpoint(event):
+    """The last date event was processed for, None if it never was"""
     try:
         with open("./out/{}.txt".format(event), "r") as file:
-            last_processed_date = pd.to_datetime(file.read()).date()
-            if date <= last_processed_date:
-                print("Date already processed for event {}".format(event))
-                return
+            return pd.to_datetime(file.read()).date()
     except:
-        pass
+        return None
 
-    print(f"Processing event {event}")
-    if event == "OrderActionRecord":
-        process_trades(
-            df_filtered[(df_filtered["event_type"] == "OrderActionRecord")], date, logs
-        )
-    elif event == "SettlePnlRecord":
-        process_settle_pnl(
-            df_filtered[df_filtered["event_type"] == "SettlePnlRecord"], date, logs
+
+def is_processed(event, date):
+    last_processed_date = read_checkpoint(event)
+    return last_processed_date is not None and date <= last_processed_date
+
+
+def mark_processed(event, date):
+    # A forced rerun of earlier dates leaves the checkpoint where it was
+    if is_processed(event, date):
+        return
+    with open(f"./out/{event}.txt", "w") as file:
+        file.write(date.strftime("%Y%m%d"))
+
+
+def process_event_type(event, records, date, events, shard=None, parsed_trades=None):
+    """Run the processor for one event type
+
+    records is this event type's partition and must not be mutated, events maps
+    tx signature to the decoded events of this type only. OrderActionRecord jobs
+    of the process pool pass the trades they were routed as parsed_trades.
+    """
+    print(f"Processing event {event}" + (f" shard {shard}" if shard else ""))
+    with collect_activity() as activity, collect_signatures() as signatures:
+        if parsed_trades is not None:
+            process_trades(records, date, None, shard, parsed_trades)
+        else:
+            EVENT_PROCESSORS[event](records, date, events, shard)
+    # A partial day's indexes cannot be merged, while following they are written
+    # when the day is finalized
+    if OUTPUT_MERGER is not None:
+        return
+    part = event if shard is None else "{}-{}-of-{}".format(event, *shard)
+    if len(activity) > 0:
+        write_csv(
+            "{}/{}".format(parts_prefix(ACTIVITY_PARTS_PREFIX, date), part),
+            pd.DataFrame(activity),
+            dedup_subset=["user", "recordType"],
         )
-    elif event == "DepositRecord":
-        process_deposit(
-            df_filtered[df_filtered["event_type"] == "DepositRecord"], date, logs
+    if len(signatures) > 0:
+        write_csv(
+            "{}/{}".format(parts_prefix(SIGNATURE_PARTS_PREFIX, date), part),
+            pd.concat(signatures, ignore_index=True),
+            dedup_subset=["signature", "prefix"],
         )
-    elif event == "InsuranceFundRecord":
-        process_insurance_fund(
-            df_filtered[df_filtered["event_type"] == "InsuranceFundRecord"], date, logs
+
+
+def parts_prefix(index_prefix, date):
+    """Where processor jobs leave their part of an index for date"""
+    return "program/{}/{}/{}/{}".format(
+        PROGRAM_ID, index_prefix, date.year, date.strftime("%Y%m%d")
+    )
+
+
+def list_parts(index_prefix, dates):
+    """The index parts of dates, oldest first"""
+    sink = get_sink()
+
+    async def list_all():
+        listed = await asyncio.gather(
+            *(sink.list(parts_prefix(index_prefix, date) + "/") for date in dates)
         )
-    elif event == "InsuranceFundStakeRecord":
-        process_insurance_fund_stake(
-            df_filtered[df_filtered["event_type"] == "InsuranceFundStakeRecord"],
-            date,
-            logs,
+        return [obj for objects in listed for obj in objects]
+
+    return sorted(get_s3_io().run(list_all()), key=lambda obj: obj["LastModified"])
+
+
+def month_is_over(month):
+    """Whether every day of month, yyyymm, has passed"""
+    first = dt.datetime.strptime(month, "%Y%m").date()
+    next_month = (first + dt.timedelta(days=31)).replace(day=1)
+    return next_month <= dt.datetime.now(dt.timezone.utc).date()
+
+
+def delete_object(object_path):
+    get_upload_manifest().forget(object_path)
+    get_s3_io().run(get_sink().delete(object_path))
+
+
+def update_tiered_index(prefix, month, parts, dates, merge):
+    """Replace the rows of dates, days of month, in the index objects under prefix
+
+    A running month's rows are kept in the month object <prefix>/<yyyymm>, so a
+    day's merge rewrites at most a month of rows. Once the month is over they are
+    folded into the year object <prefix>/<yyyy>, which is rewritten once more.
+    merge(index, parts, dates) returns index with the rows of dates replaced.
+    """
+    year_path = "{}/{}".format(prefix, month[:4])
+    month_path = "{}/{}".format(prefix, month)
+    month_rows = read_existing_csv(month_path, dtype={"date": str})
+    fold = month_is_over(month)
+    if fold:
+        index = read_existing_csv(year_path, dtype={"date": str})
+        if month_rows is not None:
+            index = pd.concat([index, month_rows], ignore_index=True)
+        path = year_path
+    else:
+        index, path = month_rows, month_path
+    stale = index is not None and index["date"].isin(dates).any()
+    if len(parts) > 0 or stale or (fold and month_rows is not None):
+        put_csv(path, merge(index, parts, dates))
+    if fold and month_rows is not None:
+        delete_object(month_path)
+
+
+def activity_index_prefix(shard):
+    return "program/{}/{}/{:03d}".format(PROGRAM_ID, ACTIVITY_INDEX_PREFIX, shard)
+
+
+def merge_activity_index(dates):
+    """Fold the activity parts of dates into the user activity index
+
+    Every processor job writes one part per day. The index holds one row per
+    user, day and record type, in one object per user-hash shard and year, see
+    update_tiered_index(), so a user's year is a couple of small reads.
+    """
+    months = {}
+    for date in dates:
+        months.setdefault(date.strftime("%Y%m"), []).append(date)
+    for month, month_dates in sorted(months.items()):
+        objects = list_parts(ACTIVITY_PARTS_PREFIX, month_dates)
+        parts = [read_existing_csv(obj["Key"], dtype={"date": str}) for obj in objects]
+        shard_parts = split_activity(parts)
+        days = {date.strftime("%Y%m%d") for date in month_dates}
+        # Every shard is visited, one may hold rows of these days from an earlier
+        # run that this one has none for
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(
+                pool.map(
+                    lambda shard: update_tiered_index(
+                        activity_index_prefix(shard),
+                        month,
+                        shard_parts.get(shard, []),
+                        days,
+                        merge_activity,
+                    ),
+                    range(ACTIVITY_INDEX_SHARDS),
+                )
+            )
+    drain_writes()
+
+
+def lookup_activity(user, year):
+    """The activity index rows of user in year, from the user's shard only"""
+    s3_io = get_s3_io()
+    sink = get_sink()
+    prefix = "{}/{}".format(activity_index_prefix(activity_shard(user)), year)
+    # The year object and the month objects of months still running
+    keys = sorted(obj["Key"] for obj in s3_io.run(sink.list(prefix)))
+    frames = [read_existing_csv(key, dtype={"date": str}) for key in keys]
+    rows = merge_activity(None, [df for df in frames if df is not None], set())
+    return rows[rows["user"] == user].reset_index(drop=True)
+
+
+def signature_segment_path(shard, date):
+    return "program/{}/{}/{:03d}/{}".format(
+        PROGRAM_ID, SIGNATURE_INDEX_PREFIX, shard, date.strftime("%Y%m%d")
+    )
+
+
+def signature_filters_prefix(shard):
+    return "program/{}/{}/{:03d}".format(PROGRAM_ID, SIGNATURE_FILTERS_PREFIX, shard)
+
+
+def merge_signature_index(dates):
+    """Rebuild the signature index segments of dates from their parts
+
+    Next to the day segments every shard keeps the Bloom filters of its segments,
+    one row per day in tiered objects, see update_tiered_index(), so a lookup
+    reads the shard's filters and then only the segments that may match.
+    """
+    months = {}
+    for date in dates:
+        months.setdefault(date.strftime("%Y%m"), []).append(date)
+    for month, month_dates in sorted(months.items()):
+        filters = {}
+        for date in month_dates:
+            parts = [
+                read_existing_csv(obj["Key"])
+                for obj in list_parts(SIGNATURE_PARTS_PREFIX, [date])
+            ]
+            for shard, segment in build_segments(parts, date).items():
+                put_csv(signature_segment_path(shard, date), segment)
+                filters.setdefault(shard, []).append(day_filter(segment))
+        days = {date.strftime("%Y%m%d") for date in month_dates}
+        # Every shard is visited, one may hold filters of these days from an
+        # earlier run that this one has no segment for
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(
+                pool.map(
+                    lambda shard: update_tiered_index(
+                        signature_filters_prefix(shard),
+                        month,
+                        filters.get(shard, []),
+                        days,
+                        merge_filters,
+                    ),
+                    range(SIGNATURE_INDEX_SHARDS),
+                )
+            )
+    drain_writes()
+
+
+def lookup_signature(signature, dates=None):
+    """Find the slot, day and output prefixes of a transaction signature
+
+    The filters of the signature's shard are read first, then only the day
+    segments whose filter may hold the signature, newest day first. dates
+    optionally narrows the search down. Returns None if it was not archived.
+    """
+    s3_io = get_s3_io()
+    sink = get_sink()
+    shard = signature_shard(signature)
+    # The year objects and the month objects of months still running
+    filter_keys = sorted(
+        obj["Key"]
+        for obj in s3_io.run(sink.list(signature_filters_prefix(shard) + "/"))
+    )
+    frames = [read_existing_csv(key, dtype={"date": str}) for key in filter_keys]
+    filters = merge_filters(None, [df for df in frames if df is not None], set())
+    if dates is not None:
+        wanted = {date.strftime("%Y%m%d") for date in dates}
+        filters = filters[filters["date"].isin(wanted)]
+    candidates = sorted(
+        (
+            date
+            for date, bits in zip(filters["date"], filters["bits"])
+            if filter_may_contain(bits, signature)
+        ),
+        reverse=True,
+    )
+    keys = [
+        signature_segment_path(shard, dt.datetime.strptime(date, "%Y%m%d"))
+        for date in candidates
+    ]
+
+    async def search(key):
+        body = await sink.get(key)
+        segment = await s3_io.to_thread(
+            lambda: pd.read_csv(io.BytesIO(decompress(body)), dtype={"date": str})
         )
-    elif event == "LiquidationRecord":
-        process_liquidation(
-            df_filtered[df_filtered["event_type"] == "LiquidationRecord"], date, logs
+        return find_in_segment(segment, signature)
+
+    async def search_all():
+        for batch in chunks(keys, 32):
+            for row in await asyncio.gather(*(search(key) for key in batch)):
+                if row is not None:
+                    return row.to_dict()
+        return None
+
+    return s3_io.run(search_all())
+
+
+def process_partition_file(event, partition_path, logs_path, date, shard=None):
+    """Worker process entry point, returns the worker's upload counts for the job
+
+    The partition and the day's raw logs are memory-mapped from Arrow IPC files,
+    and only the transactions of this partition are decoded.
+    """
+    uploads_before = get_upload_manifest().snapshot()
+    records = read_ipc(partition_path)
+    logs = filter_isin(read_ipc(logs_path), "signatures", pc.unique(records["tx_id"]))
+    events = decode_events(
+        logs["signatures"].to_pylist(), logs["log_messages"].to_pylist(), event
+    )
+    process_event_type(event, records, date, events, shard)
+    drain_writes()
+    return get_upload_manifest().snapshot() - uploads_before
+
+
+def parse_trades_file(partition_path, logs_path, rows, parsed_paths, shards, year):
+    """Worker process entry point of the first OrderActionRecord pass
+
+    Decodes and parses the partition rows in range(*rows) once, and writes every
+    trade to parsed_paths[i] for each shards[i] holding one of the objects it is
+    written to, as a pickled list.
+    """
+    records = read_ipc(partition_path).slice(rows[0], rows[1] - rows[0])
+    logs = filter_isin(read_ipc(logs_path), "signatures", pc.unique(records["tx_id"]))
+    events = decode_events(
+        logs["signatures"].to_pylist(),
+        logs["log_messages"].to_pylist(),
+        "OrderActionRecord",
+    )
+    routed = [[] for _ in shards]
+    for parsed in parse_trades(records, events):
+        userPrefixes, marketPrefix = trade_prefixes(parsed, year)
+        for trades, shard in zip(routed, shards):
+            if any(in_shard(prefix, shard) for prefix in [*userPrefixes, marketPrefix]):
+                trades.append(parsed)
+    for path, trades in zip(parsed_paths, routed):
+        with open(path, "wb") as file:
+            pickle.dump(trades, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def process_trades_file(partition_path, parsed_paths, date, shard):
+    """Worker process entry point of the second OrderActionRecord pass
+
+    Writes the objects of shard from the trades the first pass routed to it,
+    parsed_paths in row order. Returns the worker's upload counts.
+    """
+    uploads_before = get_upload_manifest().snapshot()
+
+    def parsed_trades(path):
+        with open(path, "rb") as file:
+            yield from pickle.load(file)
+
+    process_event_type(
+        "OrderActionRecord",
+        read_ipc(partition_path),
+        date,
+        None,
+        shard,
+        [parsed_trades(path) for path in parsed_paths],
+    )
+    drain_writes()
+    return get_upload_manifest().snapshot() - uploads_before
+
+
+def submit_trade_parsing(
+    submit, partition_path, logs_path, num_rows, estimate, tmp, year, shards
+):
+    """Submit the first OrderActionRecord pass, returns (futures, routed paths)
+
+    The partition is cut into one row range per shard, each decoded and parsed by
+    one job, so no trade is decoded or parsed more than once. paths[part][i] is
+    where the job of range part leaves the trades of shards[i]. submit(estimate,
+    fn, *args) submits a job with the memory it is estimated to need.
+    """
+    count = len(shards)
+    bounds = [num_rows * part // count for part in range(count + 1)]
+    paths = [
+        [os.path.join(tmp, f"trades-{part}-{i}.pickle") for i in range(count)]
+        for part in range(count)
+    ]
+    futures = [
+        submit(
+            estimate // count,
+            parse_trades_file,
+            partition_path,
+            logs_path,
+            (bounds[part], bounds[part + 1]),
+            paths[part],
+            shards,
+            year,
         )
-    elif event == "LPRecord":
-        process_lp(df_filtered[df_filtered["event_type"] == "LPRecord"], date, logs)
-    elif event == "FundingRateRecord":
-        process_funding_rate(
-            df_filtered[df_filtered["event_type"] == "FundingRateRecord"], date, logs
+        for part in range(count)
+    ]
+    return futures, paths
+
+
+def submit_trade_writing(submit, partition_path, paths, estimate, date, shards):
+    """Submit the second OrderActionRecord pass once the first is done"""
+    return [
+        submit(
+            estimate // len(shards),
+            process_trades_file,
+            partition_path,
+            [routed[i] for routed in paths],
+            date,
+            job_shard,
         )
-    elif event == "FundingPaymentRecord":
-        process_funding_payment(
-            df_filtered[df_filtered["event_type"] == "FundingPaymentRecord"], date, logs
+        for i, job_shard in enumerate(shards)
+    ]
+
+
+def process_day_in_pool(
+    partitions,
+    raw_logs,
+    date,
+    event_types,
+    workers,
+    trade_shards,
+    shard=None,
+    spilled=False,
+):
+    """Run the day's processors in worker processes, returns the failed event types
+
+    OrderActionRecord is decoded and parsed in trade_shards row ranges and then
+    written in trade_shards user/market key hash shards, so it does not run as a
+    single straggler, see submit_trade_parsing(). A job is only started once the
+    memory budget has room for the events it decodes. With spilled, the day is
+    over budget and the IPC files go to disk rather than shared memory.
+    """
+    from scripts.load_markets import PERP_MARKETS, SPOT_MARKETS
+
+    governor = get_memory_governor()
+    total_rows = max(sum(partitions[event].num_rows for event in event_types), 1)
+    failed = set()
+    with ipc_dir(governor.spill_dir if spilled else SHARED_MEMORY_DIR) as tmp:
+        logs_path = write_ipc(raw_logs, os.path.join(tmp, "logs.arrow"))
+        jobs = []
+        trades_job = None
+        for event in event_types:
+            partition_path = write_ipc(
+                partitions[event].select(PARTITION_COLUMNS),
+                os.path.join(tmp, f"{event}.arrow"),
+            )
+            # Decoded events and parsed rows of a partition, assuming logs
+            # spread evenly over rows
+            estimate = (
+                decoded_estimate(raw_logs.nbytes)
+                * partitions[event].num_rows
+                // total_rows
+            )
+            if event == "OrderActionRecord" and trade_shards > 1:
+                trades_job = (partition_path, partitions[event].num_rows, estimate)
+            else:
+                jobs.append((event, partition_path, estimate))
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=set_markets,
+            initargs=(PERP_MARKETS, SPOT_MARKETS),
+        ) as executor:
+
+            def submit(estimate, fn, *args):
+                try:
+                    governor.acquire(estimate)
+                except MemoryBudgetExceeded as e:
+                    # Reported as the job's failure
+                    future = Future()
+                    future.set_exception(e)
+                    return future
+                future = executor.submit(fn, *args)
+                future.add_done_callback(lambda _: governor.release(estimate))
+                return future
+
+            if trades_job is not None:
+                trade_partition, trade_rows, trade_estimate = trades_job
+                trade_shard_list = [
+                    sub_shard(shard, i, trade_shards) for i in range(trade_shards)
+                ]
+                parse_futures, routed_paths = submit_trade_parsing(
+                    submit,
+                    trade_partition,
+                    logs_path,
+                    trade_rows,
+                    trade_estimate,
+                    tmp,
+                    date.year,
+                    trade_shard_list,
+                )
+            future_to_event = {}
+            for event, path, estimate in jobs:
+                future = submit(
+                    estimate,
+                    process_partition_file,
+                    event,
+                    path,
+                    logs_path,
+                    date,
+                    shard,
+                )
+                future_to_event[future] = event
+            if trades_job is not None:
+                try:
+                    for future in parse_futures:
+                        future.result()
+                except Exception as e:
+                    print(f"Failed parsing OrderActionRecord on {date}. Error: {e}")
+                    failed.add("OrderActionRecord")
+                else:
+                    for future in submit_trade_writing(
+                        submit,
+                        trade_partition,
+                        routed_paths,
+                        trade_estimate,
+                        date,
+                        trade_shard_list,
+                    ):
+                        future_to_event[future] = "OrderActionRecord"
+            for future in as_completed(future_to_event):
+                event = future_to_event[future]
+                try:
+                    get_upload_manifest().add_counts(future.result())
+                except Exception as e:
+                    print(f"Failed processing event {event} on {date}. Error: {e}")
+                    failed.add(event)
+
+    return failed
+
+
+def process_batched_events(event, records, raw_logs, date, shard=None):
+    """process_event_type decoding the events of records a batch at a time"""
+    events = BatchedEvents(records, raw_logs, event, get_memory_governor())
+    try:
+        process_event_type(event, records, date, events, shard)
+    finally:
+        events.close()
+
+
+def process_day_in_threads(
+    partitions, raw_logs, date, event_types, workers, shard=None
+):
+    """Run the day's processors on a thread pool, returns the failed event types
+
+    Every processor decodes the events of its partition from raw_logs in batches
+    of rows, each reserved in the memory budget while it is parsed.
+    """
+    failed = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        future_to_event = {
+            pool.submit(
+                process_batched_events,
+                event,
+                partitions[event],
+                raw_logs,
+                date,
+                shard,
+            ): event
+            for event in event_types
+        }
+        for future in as_completed(future_to_event):
+            event = future_to_event[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed processing event {event} on {date}. Error: {e}")
+                failed.add(event)
+
+    try:
+        drain_writes()
+    except Exception as e:
+        print(f"Failed writing outputs for {date}. Error: {e}")
+        failed.update(event_types)
+
+    return failed
+
+
+def events_of_signatures(partitions, event_types, signatures):
+    """The event types whose partition has rows of signatures"""
+    value_set = pa.array(sorted(signatures), pa.string())
+    return {
+        event
+        for event in event_types
+        if pc.any(pc.is_in(partitions[event]["tx_id"], value_set=value_set)).as_py()
+    }
+
+
+def record_unfetched(date, signatures):
+    """Keep the signatures of date whose logs could not be fetched in ./out
+
+    The file is removed once a run of the day fetches them all.
+    """
+    path = RPC_UNFETCHED_PATH.format(date.strftime("%Y%m%d"))
+    if len(signatures) == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write("".join(f"{signature}\n" for signature in sorted(signatures)))
+
+
+def archive_day(
+    date,
+    events_files,
+    txns_files,
+    event_types,
+    executor="thread",
+    workers=5,
+    trade_shards=4,
+    shard=None,
+    checkpoint=True,
+):
+    """Read, decode and process one day of events
+
+    With checkpoint set, every event type that succeeded is recorded in ./out,
+    shard restricts the written objects to one user-hash partition. Event types
+    with transactions whose logs the RPC fallback failed to fetch count as
+    failed, the signatures are listed in RPC_UNFETCHED_PATH.
+    """
+    print(f"Events Files to process: {events_files}")
+    print(f"Txns Files to process: {txns_files}")
+    s3_io = get_s3_io()
+    uploads_before = get_upload_manifest().snapshot()
+    # Everything the day keeps in memory is charged to the budget until its
+    # objects are written, or spilled to disk when it does not fit
+    with get_memory_governor().holding() as holding:
+        daily_tables = [
+            daily_table
+            for daily_table in s3_io.run(
+                read_event_files(events_files, event_types, holding)
+            )
+            if daily_table.num_rows > 0
+        ]
+        print("Read files")
+        if len(daily_tables) == 0:
+            return
+        events_table = pa.concat_tables(daily_tables, promote_options="default")
+        tx_ids = pc.unique(events_table["tx_id"]).to_pylist()
+        slots = pc.unique(events_table["block_slot"]).to_numpy(zero_copy_only=False)
+        print("Number of unique txs: {}".format(len(tx_ids)))
+        partitions = {
+            event: holding.keep(partition)
+            for event, partition in partition_by_event_type(events_table).items()
+        }
+        empty_partition = events_table.slice(0, 0)
+        for event in EVENT_TYPES:
+            partitions.setdefault(event, empty_partition)
+        del events_table, daily_tables
+
+        fetcher = get_rpc_fetcher()
+        raw_logs = s3_io.run(
+            fetch_raw_logs(
+                tx_ids,
+                get_source(),
+                txns_files,
+                holding,
+                slots,
+                get_slot_index(),
+                fetcher,
+            )
         )
+        print(f"Logs not found for {len(tx_ids) - len(raw_logs)} signatures")
+        # failed is left from an earlier day when none were missing today
+        unfetched = set() if fetcher is None else fetcher.failed.intersection(tx_ids)
+        if executor == "process":
+            failed = process_day_in_pool(
+                partitions,
+                raw_logs,
+                date,
+                event_types,
+                workers,
+                trade_shards,
+                shard,
+                spilled=holding.spilled,
+            )
+        else:
+            failed = process_day_in_threads(
+                partitions, raw_logs, date, event_types, workers, shard
+            )
+        del raw_logs
+        if len(unfetched) > 0:
+            # Left unmarked so a rerun asks for their logs again
+            unfetched_events = events_of_signatures(partitions, event_types, unfetched)
+            print(
+                f"Logs of {len(unfetched)} signatures could not be fetched over "
+                f"rpc, missing from {sorted(unfetched_events)}"
+            )
+            failed.update(unfetched_events)
+    record_unfetched(date, unfetched)
+    uploads = get_upload_manifest().snapshot() - uploads_before
+    print(f"Objects for {date}: {format_counts(uploads)}")
 
-    with open(f"./out/{event}.txt", "w") as file:
-        file.write(date.strftime("%Y%m%d"))
+    if checkpoint:
+        for event in event_types:
+            if event not in failed:
+                mark_processed(event, date)
+    if len(failed) > 0:
+        raise RuntimeError(f"Failed processing {sorted(failed)} on {date}")
 
 
-def archive(start_date, end_date):
+def get_read_credentials():
     frozen_credentials = session_default.get_credentials().get_frozen_credentials()
-    read_credentials = {
+    return {
         "access_key": frozen_credentials.access_key,
         "secret_key": frozen_credentials.secret_key,
+        "token": frozen_credentials.token,
     }
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=read_credentials["access_key"],
-        aws_secret_access_key=read_credentials["secret_key"],
+
+
+S3_IO: S3IO | None = None
+S3_MAX_CONCURRENCY = MAX_S3_CONCURRENCY
+
+
+def get_s3_io():
+    """The process wide async S3 layer, created on first use"""
+    global S3_IO
+    if S3_IO is None:
+        S3_IO = S3IO(
+            get_read_credentials,
+            DESTINATION_ENDPOINT_URL,
+            max_concurrency=S3_MAX_CONCURRENCY,
+        )
+    return S3_IO
+
+
+def _reset_s3_io():
+    # The event loop thread does not survive a fork, workers open their own
+    global S3_IO
+    S3_IO = None
+
+
+os.register_at_fork(after_in_child=_reset_s3_io)
+
+
+# Where outputs go, "s3", "memory" or "local:<directory>", see scripts/sinks.py
+SINK_SPEC = "s3"
+SINK = None
+
+
+def get_sink():
+    """The process wide output sink, created on first use"""
+    global SINK
+    if SINK is None:
+        SINK = make_sink(
+            SINK_SPEC, get_s3_io, DESTINATION_BUCKET_NAME, DESTINATION_ENDPOINT_URL
+        )
+    return SINK
+
+
+def _reset_sink():
+    # Sinks are bound to the S3 layer and the pending writes of the parent
+    global SINK
+    SINK = None
+
+
+os.register_at_fork(after_in_child=_reset_sink)
+
+
+# Approximate bytes the stages of a run may hold at once, None for half of the
+# physical memory
+MEMORY_BUDGET = None
+MEMORY_GOVERNOR: MemoryGovernor | None = None
+
+
+def get_memory_governor():
+    global MEMORY_GOVERNOR
+    if MEMORY_GOVERNOR is None:
+        MEMORY_GOVERNOR = MemoryGovernor(MEMORY_BUDGET or default_memory_budget())
+    return MEMORY_GOVERNOR
+
+
+# Where topledger files are read from, "s3" or "local:<directory>", see
+# scripts/sources.py
+SOURCE_SPEC = "s3"
+SOURCE = None
+
+
+def get_source():
+    """The process wide source of events and txns files, created on first use"""
+    global SOURCE
+    if SOURCE is None:
+        SOURCE = make_source(SOURCE_SPEC, get_s3_io, SOURCE_BUCKET_NAME)
+    return SOURCE
+
+
+def _reset_source():
+    global SOURCE
+    SOURCE = None
+
+
+os.register_at_fork(after_in_child=_reset_source)
+
+
+# Slot ranges of txns row groups, log reads skip those holding none of the
+# slots they look for
+SLOT_INDEX: SlotIndex | None = None
+
+
+def get_slot_index():
+    global SLOT_INDEX
+    if SLOT_INDEX is None:
+        SLOT_INDEX = SlotIndex()
+    return SLOT_INDEX
+
+
+def _reset_slot_index():
+    # sqlite connections must not be shared with a forked child
+    global SLOT_INDEX
+    SLOT_INDEX = None
+
+
+os.register_at_fork(after_in_child=_reset_slot_index)
+
+
+# Signatures missing from the txns files are fetched from RPC_URL, when set
+RPC_FALLBACK = True
+RPC_MAX_BATCH_SIZE = RPC_BATCH_SIZE
+RPC_MAX_CONCURRENCY = RPC_CONCURRENCY
+RPC_FETCHER: RpcLogFetcher | None = None
+# Signatures of a day whose logs the fallback failed to fetch, one per line
+RPC_UNFETCHED_PATH = "./out/rpc_unfetched/{}.txt"
+
+
+def get_rpc_fetcher():
+    """The process wide RPC fallback for missing logs, None when it is off"""
+    global RPC_FETCHER
+    if not RPC_FALLBACK or not RPC_URL:
+        return None
+    if RPC_FETCHER is None:
+        RPC_FETCHER = RpcLogFetcher(
+            RPC_URL,
+            RpcLogCache(),
+            batch_size=RPC_MAX_BATCH_SIZE,
+            concurrency=RPC_MAX_CONCURRENCY,
+        )
+    return RPC_FETCHER
+
+
+def _reset_rpc_fetcher():
+    # Its cache's sqlite connection must not be shared with a forked child
+    global RPC_FETCHER
+    RPC_FETCHER = None
+
+
+os.register_at_fork(after_in_child=_reset_rpc_fetcher)
+
+
+def drain_writes():
+    """Wait for every submitted write and for the sink to make them durable"""
+    s3_io = get_s3_io()
+    s3_io.drain()
+    s3_io.run(get_sink().flush())
+
+
+def list_source_objects(start_date, end_date):
+    """List the events and txns objects, {"Key", "Size"}, per date in the range"""
+    source = get_source()
+
+    async def list_files(prefix, suffix=""):
+        files = {}
+        objects = await source.list(
+            prefix,
+            start_after="{}/{}/*".format(
+                prefix, (start_date - dt.timedelta(days=7)).strftime("%Y-%m-%d")
+            ),
+        )
+        for obj in objects:
+            if not obj["Key"] or not obj["Key"].endswith(suffix):
+                continue
+            date = pd.to_datetime(obj["Key"].split("/")[2]).date()
+            if start_date <= date <= end_date:
+                files.setdefault(date, []).append(obj)
+        return files
+
+    async def list_all():
+        return await asyncio.gather(
+            list_files("drift/events"), list_files("drift/txns", ".parquet")
+        )
+
+    return tuple(get_s3_io().run(list_all()))
+
+
+def list_source_files(start_date, end_date):
+    """List the events and txns file keys per date between start_date and end_date"""
+    return tuple(
+        {date: [obj["Key"] for obj in objects] for date, objects in listed.items()}
+        for listed in list_source_objects(start_date, end_date)
     )
 
-    bucket_name = "drift-topledger"
-    response = s3.list_objects_v2(
-        Bucket=bucket_name,
-        StartAfter="drift/events/{}/*".format(
-            (start_date - dt.timedelta(days=7)).strftime("%Y-%m-%d")
-        ),
-        Prefix="drift/events",
+
+def plan_archive(start_date, end_date, event_types=EVENT_TYPES, checkpoint=True):
+    """The backfill plan for a date range, see plan_backfill
+
+    With checkpoint, event types already processed for a date per ./out are left
+    out of it. Each checkpoint is read once.
+    """
+    events_objects, txns_objects = list_source_objects(start_date, end_date)
+    checkpoints = {}
+    if checkpoint:
+        checkpoints = {event: read_checkpoint(event) for event in event_types}
+    return plan_backfill(events_objects, txns_objects, event_types, checkpoints)
+
+
+def archive(
+    start_date,
+    end_date,
+    event_types=EVENT_TYPES,
+    executor="thread",
+    workers=5,
+    trade_shards=4,
+    force=False,
+):
+    """Process every date in the range for event_types
+
+    Dates an event type was already processed for are skipped unless force is
+    set, checkpoints of other event types are left alone either way.
+    """
+    plan = plan_archive(start_date, end_date, event_types, checkpoint=not force)
+    print(format_plan(plan, EVENT_TYPES))
+
+    for day in plan:
+        print(f"Processing date {day.date}")
+        archive_day(
+            day.date,
+            day.events_files,
+            day.txns_files,
+            day.event_types,
+            executor=executor,
+            workers=workers,
+            trade_shards=trade_shards,
+        )
+        merge_activity_index([day.date])
+        merge_signature_index([day.date])
+
+    print("All done!")
+
+
+def archive_sharded(
+    start_date,
+    end_date,
+    shard,
+    shard_by="date",
+    event_types=EVENT_TYPES,
+    executor="thread",
+    workers=5,
+    trade_shards=4,
+):
+    """Work through a backfill together with other nodes
+
+    Units are claimed through the lease manifest in the sink, local
+    ./out checkpoints are neither read nor written.
+    """
+    plan = {
+        day.date: day
+        for day in plan_archive(start_date, end_date, event_types, checkpoint=False)
+    }
+    print(format_plan(plan.values(), EVENT_TYPES))
+    dates = set(plan)
+
+    manifest = LeaseManifest(get_s3_io(), get_sink())
+    units = build_units(
+        dates, shard, shard_by, sizes={date: day.size for date, day in plan.items()}
     )
+    print(f"Shard {shard[0]}/{shard[1]} as {manifest.owner}, {len(units)} units")
+
+    while True:
+        remaining = [unit for unit in units if not manifest.is_done(unit)]
+        if len(remaining) == 0:
+            break
+        claimed = 0
+        for unit in remaining:
+            if not manifest.try_claim(unit):
+                continue
+            claimed += 1
+            print(f"Processing unit {unit.key}")
+            try:
+                with manifest.heartbeat(unit):
+                    archive_day(
+                        unit.date,
+                        plan[unit.date].events_files,
+                        plan[unit.date].txns_files,
+                        plan[unit.date].event_types,
+                        executor=executor,
+                        workers=workers,
+                        trade_shards=trade_shards,
+                        shard=unit.partition,
+                        checkpoint=False,
+                    )
+            except Exception:
+                manifest.release(unit)
+                raise
+            manifest.complete(unit)
+        if claimed == 0:
+            # Everything left is leased by other nodes, wait for them or for
+            # their leases to expire
+            time.sleep(manifest.ttl / 4)
+
+    # Every node merges once all units are done, the last one to finish leaves
+    # the complete indexes
+    merge_activity_index(dates)
+    merge_signature_index(dates)
+    print("All done!")
 
-    txns_response = s3.list_objects_v2(
-        Bucket=bucket_name,
-        StartAfter="drift/txns/{}/*".format(
-            (start_date - dt.timedelta(days=7)).strftime("%Y-%m-%d")
-        ),
-        Prefix="drift/txns",
+
+def follow_step(state: FollowState, events_files, txns_files, workers):
+    """Process the events files of state.date that have not been seen yet
+
+    New events rows are matched against every txns file seen so far, rows still
+    waiting for their logs only against the new txns files.
+    """
+    new_events_files = [f for f in events_files if f not in state.events_files]
+    new_txns_files = [f for f in txns_files if f not in state.txns_files]
+    if len(new_events_files) == 0 and len(new_txns_files) == 0:
+        return
+
+    s3_io = get_s3_io()
+    new_tables = [
+        table
+        for table in s3_io.run(read_event_files(new_events_files, EVENT_TYPES))
+        if table.num_rows > 0
+    ]
+    new_rows = (
+        pa.concat_tables(new_tables, promote_options="default") if new_tables else None
     )
 
-    files_to_process = {}
-    for obj in response["Contents"]:
-        date = pd.to_datetime(obj["Key"].split("/")[2]).date()
-        if (date >= start_date) and (date <= end_date):
-            for event in EVENT_TYPES:
-                try:
-                    with open("./out/{}.txt".format(event), "r") as file:
-                        last_processed_date = pd.to_datetime(file.read()).date()
-                        if date > last_processed_date:
-                            if date not in files_to_process:
-                                files_to_process[date] = []
-                            files_to_process[date].append(obj["Key"])
-                            break
-                except FileNotFoundError:
-                    if date not in files_to_process:
-                        files_to_process[date] = []
-                    files_to_process[date].append(obj["Key"])
-                    break
-
-    txn_files_to_process = {}
-    for obj in txns_response["Contents"]:
-        if not obj["Key"] or not obj["Key"].endswith(".parquet"):
-            continue
-        date = pd.to_datetime(obj["Key"].split("/")[2]).date()
-        if (date >= start_date) and (date <= end_date):
-            for event in EVENT_TYPES:
-                try:
-                    with open("./out/{}.txt".format(event), "r") as file:
-                        last_processed_date = pd.to_datetime(file.read()).date()
-                        if date > last_processed_date:
-                            if date not in txn_files_to_process:
-                                txn_files_to_process[date] = []
-                            txn_files_to_process[date].append(obj["Key"])
-                            break
-                except FileNotFoundError:
-                    if date not in txn_files_to_process:
-                        txn_files_to_process[date] = []
-                    txn_files_to_process[date].append(obj["Key"])
-                    break
-
-    for (events_date, events_files), (txns_date, txns_files) in zip(
-        files_to_process.items(), txn_files_to_process.items()
-    ):
-        if str(events_date) != str(txns_date):
-            print(
-                f"Events date {events_date} and txns date {txns_date} do not match"
-            )
-            raise ValueError("Events date and txns date do not match")
-
-        print(f"Processing events date {events_date}")
-        print(f"Processing txs date {txns_date}")
-        print(f"Events Files to process: {events_files}")
-        print(f"Txns Files to process: {txns_files}")
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            future_to_file = {
-                executor.submit(
-                    read_and_filter_file, file, read_credentials, events_date
-                ): file
-                for file in events_files
-            }
-            daily_dfs = []
-            for future in as_completed(future_to_file):
-                daily_df = future.result()
-                if not daily_df.empty:
-                    daily_dfs.append(daily_df)
-        print("Read files")
-        if len(daily_dfs) == 0:
-            continue
-        df_filtered = pd.concat(daily_dfs, ignore_index=True)
-        condition = (df_filtered["event_type"] == "OrderActionRecord") & (
-            df_filtered["args"].apply(
-                lambda x: x.get("action") if isinstance(x, dict) else None
+    raw_logs = []
+    if new_rows is not None and len(state.txns_files) > 0:
+        raw_logs.append(
+            s3_io.run(
+                fetch_raw_logs(
+                    pc.unique(new_rows["tx_id"]).to_pylist(),
+                    get_source(),
+                    sorted(state.txns_files),
+                    slots=pc.unique(new_rows["block_slot"]).to_numpy(
+                        zero_copy_only=False
+                    ),
+                    slot_index=get_slot_index(),
+                )
             )
-            != "Fill"
         )
-        df_filtered.drop(df_filtered[condition].index, inplace=True)
-        if df_filtered.empty:
-            continue
-        print("Number of unique txs: {}".format(df_filtered["tx_id"].nunique()))
-        logs = asyncio.run(
-            get_logs_from_topledger(
-                df_filtered["tx_id"].unique().tolist(), read_credentials, txns_files
+    waiting = [table for table in (state.pending, new_rows) if table is not None]
+    if len(waiting) == 0:
+        pending = pa.table({column: [] for column in PARTITION_COLUMNS})
+    else:
+        pending = pa.concat_tables(waiting, promote_options="default")
+    if pending.num_rows > 0 and len(new_txns_files) > 0:
+        raw_logs.append(
+            s3_io.run(
+                fetch_raw_logs(
+                    pc.unique(pending["tx_id"]).to_pylist(),
+                    get_source(),
+                    new_txns_files,
+                    slots=pc.unique(pending["block_slot"]).to_numpy(
+                        zero_copy_only=False
+                    ),
+                    slot_index=get_slot_index(),
+                )
             )
         )
 
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            futures = [
-                executor.submit(
-                    process_event_type, event, df_filtered, events_date, logs
+    matched = pending.slice(0, 0)
+    logs_table = RAW_LOGS_SCHEMA.empty_table()
+    if len(raw_logs) > 0:
+        logs_table = pa.concat_tables(raw_logs)
+        found = pc.is_in(pending["tx_id"], value_set=logs_table["signatures"])
+        matched, pending = pending.filter(found), pending.filter(pc.invert(found))
+
+    if matched.num_rows > 0:
+        # A signature found in both fetches gets the events of the second
+        partitions = partition_by_event_type(matched)
+        for event in EVENT_TYPES:
+            partitions.setdefault(event, matched.slice(0, 0))
+        failed = process_day_in_threads(
+            partitions, logs_table, state.date, EVENT_TYPES, workers
+        )
+        if len(failed) > 0:
+            raise RuntimeError(f"Failed processing {sorted(failed)} on {state.date}")
+
+    state.pending = pending
+    state.events_files.update(new_events_files)
+    state.txns_files.update(new_txns_files)
+    state.save()
+    print(
+        f"Followed {len(new_events_files)} events and {len(new_txns_files)} txns "
+        f"files for {state.date}: {len(matched)} rows, {len(pending)} waiting for logs"
+    )
+
+
+def follow(poll_interval=60, flush_interval=15 * 60, workers=5):
+    """Keep processing new source files for today and yesterday as they land
+
+    Merged objects are flushed at most every flush_interval seconds. Once a day is
+    past FOLLOW_GRACE it is finalized with a regular batch run, so the end of day
+    objects are the batch output.
+    """
+    global OUTPUT_MERGER
+
+    OUTPUT_MERGER = OutputMerger(read_existing_csv, put_csv)
+    states = {}
+    last_flush = time.time()
+
+    while True:
+        now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+        today = now.date()
+        for date in (today - dt.timedelta(days=1), today):
+            if date not in states and not all(
+                is_processed(event, date) for event in EVENT_TYPES
+            ):
+                states[date] = FollowState.load(date)
+
+        if len(states) > 0:
+            files_to_process, txn_files_to_process = list_source_files(
+                min(states), today
+            )
+            for date, state in states.items():
+                follow_step(
+                    state,
+                    files_to_process.get(date, []),
+                    txn_files_to_process.get(date, []),
+                    workers,
                 )
-                for event in EVENT_TYPES
-            ]
 
-        for future in futures:
-            future.result()
+        if time.time() - last_flush >= flush_interval:
+            print(f"Flushed {OUTPUT_MERGER.flush()} objects")
+            drain_writes()
+            last_flush = time.time()
+
+        for date in sorted(states):
+            if (
+                now
+                < dt.datetime.combine(date + dt.timedelta(days=1), dt.time())
+                + FOLLOW_GRACE
+            ):
+                continue
+            print(f"Finalizing {date}")
+            OUTPUT_MERGER.flush()
+            drain_writes()
+            merger, OUTPUT_MERGER = OUTPUT_MERGER, None
+            archive(date, date, workers=workers)
+            OUTPUT_MERGER = merger
+            states.pop(date).remove()
 
-    print("All done!")
+        time.sleep(poll_interval)
 
 
 if __name__ == "__main__":
@@ -888,7 +2015,213 @@ if __name__ == "__main__":
         help="End date in YYYY-MM-DD format",
         default=dt.date.today() - dt.timedelta(days=1),
     )
+    parser.add_argument(
+        "--executor",
+        choices=["thread", "process"],
+        help="Run event processors in threads or in worker processes",
+        default="thread",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processor workers",
+        default=5,
+    )
+    parser.add_argument(
+        "--trade-shards",
+        type=int,
+        help="Number of worker jobs OrderActionRecord is split into in process mode",
+        default=4,
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Run as shard i/n of a backfill coordinated through the destination bucket",
+        default=None,
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=["date", "user"],
+        help="Split the backfill into whole dates or into user-hash partitions of each date",
+        default="date",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Keep running and process new source files for today as they land",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=int,
+        help="Seconds between listings of new source files in follow mode",
+        default=60,
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=int,
+        help="Minimum seconds between rewrites of an object in follow mode",
+        default=15 * 60,
+    )
+    parser.add_argument(
+        "--max-s3-concurrency",
+        type=int,
+        help="Upper bound for the adaptive number of concurrent S3 requests",
+        default=MAX_S3_CONCURRENCY,
+    )
+    parser.add_argument(
+        "--rewrite-unchanged",
+        action="store_true",
+        help="Upload every object even if it is identical to the last upload",
+    )
+    parser.add_argument(
+        "--codec",
+        type=parse_codec,
+        action="append",
+        help="Output codec for one record type, e.g. tradeRecords=zstd:3 or "
+        "depositRecords=gzip:6. Repeatable, the default is gzip:9",
+    )
+    parser.add_argument(
+        "--liquidation-layout",
+        choices=LIQUIDATION_LAYOUTS,
+        help="Write only the columns of each liquidation's type, or the columns "
+        "of all six liquidation sub-structs as before",
+        default="compact",
+    )
+    parser.add_argument(
+        "--fixed-point",
+        action="store_true",
+        help="Write amounts as exact integers instead of floats, the decimal "
+        "exponent of each such column is stored in the object metadata",
+    )
+    parser.add_argument(
+        "--no-rpc-fallback",
+        action="store_true",
+        help="Drop the events of signatures missing from the txns files instead "
+        "of fetching their logs from RPC_URL",
+    )
+    parser.add_argument(
+        "--rpc-batch-size",
+        type=int,
+        help="getTransaction calls per JSON-RPC batch request of the fallback",
+        default=RPC_BATCH_SIZE,
+    )
+    parser.add_argument(
+        "--rpc-concurrency",
+        type=int,
+        help="Batch requests the fallback keeps in flight at once",
+        default=RPC_CONCURRENCY,
+    )
+    parser.add_argument(
+        "--source",
+        type=parse_source,
+        help="Where topledger files are read from: s3 (the source bucket) or "
+        "local:<directory> mirroring drift/events/<date>/ and drift/txns/<date>/",
+        default="s3",
+    )
+    parser.add_argument(
+        "--sink",
+        type=parse_sink,
+        help="Where outputs are written: s3 (the destination bucket), "
+        "local:<directory> with the bucket's key layout, or memory to measure "
+        "processing without storage",
+        default="s3",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        help="GiB the run may hold in memory at once, reads and decodes wait and "
+        "day buffers spill to disk beyond it. Defaults to half of the physical "
+        "memory",
+        default=None,
+    )
+    parser.add_argument(
+        "--event-types",
+        nargs="+",
+        choices=EVENT_TYPES,
+        metavar="EVENT_TYPE",
+        help="Only read, decode and process these event types, e.g. after fixing "
+        "one parser. Checkpoints of the other event types are left alone",
+        default=EVENT_TYPES,
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Reprocess dates the selected event types were already processed for",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the backfill plan with its size and cost estimate and exit",
+    )
+    parser.add_argument(
+        "--lookup-signature",
+        help="Print the slot, day and output prefixes of a tx signature and exit",
+        default=None,
+    )
+    parser.add_argument(
+        "--lookup-user",
+        help="Print the activity index rows of a user in the year of --end-date "
+        "and exit",
+        default=None,
+    )
     args = parser.parse_args()
+    if args.sink == "memory" and args.executor == "process":
+        parser.error("--sink memory only works with the thread executor")
+    if args.fixed_point and args.follow:
+        # Merged objects would mix rows with and without their exponents
+        parser.error("--fixed-point does not work with --follow")
+    OUTPUT_CODECS.update(args.codec or [])
+    S3_MAX_CONCURRENCY = args.max_s3_concurrency
+    SKIP_UNCHANGED = not args.rewrite_unchanged
+    LIQUIDATION_LAYOUT = args.liquidation_layout
+    FIXED_POINT = args.fixed_point
+    SOURCE_SPEC = args.source
+    RPC_FALLBACK = not args.no_rpc_fallback
+    RPC_MAX_BATCH_SIZE = args.rpc_batch_size
+    RPC_MAX_CONCURRENCY = args.rpc_concurrency
+    if args.memory_budget is not None:
+        MEMORY_BUDGET = int(args.memory_budget * 2**30)
+    SINK_SPEC = args.sink
+    if args.lookup_signature is not None:
+        print(lookup_signature(args.lookup_signature))
+        raise SystemExit
+    if args.lookup_user is not None:
+        print(lookup_activity(args.lookup_user, args.end_date.year).to_string())
+        raise SystemExit
+    if args.dry_run:
+        plan = plan_archive(
+            args.start_date,
+            args.end_date,
+            args.event_types,
+            checkpoint=args.shard is None and not args.force,
+        )
+        print(format_plan(plan, EVENT_TYPES))
+        raise SystemExit
     loop = asyncio.get_event_loop()
     loop.run_until_complete(initialize_state())
-    archive(args.start_date, args.end_date)
+    if args.follow:
+        follow(args.poll_interval, args.flush_interval, workers=args.workers)
+    elif args.shard is not None:
+        archive_sharded(
+            args.start_date,
+            args.end_date,
+            args.shard,
+            shard_by=args.shard_by,
+            event_types=args.event_types,
+            executor=args.executor,
+            workers=args.workers,
+            trade_shards=args.trade_shards,
+        )
+    else:
+        archive(
+            args.start_date,
+            args.end_date,
+            args.event_types,
+            executor=args.executor,
+            workers=args.workers,
+            trade_shards=args.trade_shards,
+            force=args.force,
+        )
+    if isinstance(SINK, MemorySink):
+        print(f"Memory sink holds {len(SINK.objects)} objects, {SINK.size} bytes")
+    print(format_memory_report(get_memory_governor()))
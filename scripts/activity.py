@@ -0,0 +1,103 @@
+import threading
+import zlib
+from contextlib import contextmanager
+
+import pandas as pd
+
+ACTIVITY_INDEX_PREFIX = "index/userActivity"
+ACTIVITY_PARTS_PREFIX = "index/userActivityParts"
+# Users are spread over this many index shards by crc32, a user's rows are only
+# ever read and rewritten with those of the other users of the shard
+ACTIVITY_INDEX_SHARDS = 64
+ACTIVITY_COLUMNS = [
+    "user",
+    "date",
+    "recordType",
+    "rows",
+    "volume",
+    "firstSlot",
+    "lastSlot",
+]
+# volume is the sum of the absolute values of this column, record types not
+# listed have no volume
+VOLUME_COLUMNS = {
+    "tradeRecords": "quoteAssetAmountFilled",
+    "settlePnlRecords": "pnl",
+    "depositRecords": "amount",
+    "lpRecord": "deltaQuoteAssetAmount",
+    "fundingPaymentRecords": "fundingPayment",
+}
+
+_local = threading.local()
+
+
+@contextmanager
+def collect_activity():
+    """Collect a summary row for every user object written on this thread"""
+    rows = []
+    _local.rows = rows
+    try:
+        yield rows
+    finally:
+        _local.rows = None
+
+
+def record_activity(object_path, df):
+    rows = getattr(_local, "rows", None)
+    if rows is None:
+        return
+    # program/<id>/user/<pubkey>/<recordType>/<year>/<yyyymmdd>
+    parts = object_path.split("/")
+    if len(parts) != 7 or parts[2] != "user" or df.empty:
+        return
+    record_type = parts[4]
+    column = VOLUME_COLUMNS.get(record_type)
+    volume = None
+    if column in df:
+        volume = df[column].abs().sum()
+        # The index is in units either way, fixed-point amounts are scaled back
+        exponent = df.attrs.get("exponents", {}).get(column, 0)
+        if exponent != 0:
+            volume = volume / 10**exponent
+    rows.append(
+        {
+            "user": parts[3],
+            "date": parts[6],
+            "recordType": record_type,
+            "rows": len(df),
+            "volume": volume,
+            "firstSlot": int(df["slot"].min()),
+            "lastSlot": int(df["slot"].max()),
+        }
+    )
+
+
+def activity_shard(user):
+    return zlib.crc32(user.encode()) % ACTIVITY_INDEX_SHARDS
+
+
+def split_activity(parts):
+    """{shard: [rows of the shard from every part]}, parts kept in order"""
+    shards = {}
+    for part in parts:
+        for shard, rows in part.groupby(part["user"].map(activity_shard), sort=False):
+            shards.setdefault(shard, []).append(rows)
+    return shards
+
+
+def merge_activity(index, parts, dates):
+    """Replace the rows of dates in an index object with the given day parts
+
+    parts are ordered oldest first, a user and record type left over in a stale
+    part from an earlier run with a different sharding is overridden by the
+    newer one.
+    """
+    frames = [] if index is None else [index[~index["date"].isin(dates)]]
+    frames.extend(parts)
+    if len(frames) == 0:
+        return pd.DataFrame(columns=ACTIVITY_COLUMNS)
+    return (
+        pd.concat(frames, ignore_index=True)
+        .drop_duplicates(subset=["user", "date", "recordType"], keep="last")
+        .sort_values(["user", "date", "recordType"])[ACTIVITY_COLUMNS]
+    )
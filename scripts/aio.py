@@ -0,0 +1,497 @@
+import asyncio
+import io
+import random
+import threading
+import time
+from contextlib import AsyncExitStack
+
+import aiohttp
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from botocore.exceptions import (
+    ClientError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
+
+MIN_S3_CONCURRENCY = 2
+INITIAL_S3_CONCURRENCY = 8
+MAX_S3_CONCURRENCY = 64
+# Requests whose time to first byte is above this count as congestion. Uploads
+# are judged by their time per S3_LATENCY_UNIT_BYTES instead, the time to send
+# a large body says nothing about congestion
+S3_LATENCY_CEILING_SECONDS = 2.0
+S3_LATENCY_UNIT_BYTES = 1024 * 1024
+S3_MAX_ATTEMPTS = 8
+S3_BACKOFF_BASE_SECONDS = 0.5
+S3_BACKOFF_MAX_SECONDS = 30
+# Uploads submitted without waiting, writers block once this many are in flight
+MAX_PENDING_WRITES = 256
+
+# Objects larger than one part are uploaded as multipart uploads
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+MAX_PARALLEL_PARTS = 4
+# Parts a writer may get ahead of the upload before it blocks
+MAX_QUEUED_PARTS = 2
+
+THROTTLING_CODES = {"SlowDown", "503", "ServiceUnavailable", "Throttling"}
+RETRYABLE_CODES = THROTTLING_CODES | {"500", "InternalError", "RequestTimeout"}
+
+
+def is_congestion(e):
+    if isinstance(e, ClientError):
+        return e.response["Error"]["Code"] in THROTTLING_CODES
+    return isinstance(
+        e,
+        (
+            asyncio.TimeoutError,
+            aiohttp.ServerTimeoutError,
+            ReadTimeoutError,
+            ConnectTimeoutError,
+        ),
+    )
+
+
+def upload_latency(elapsed, body):
+    """Latency of an upload for the limiter, its time per S3_LATENCY_UNIT_BYTES
+
+    Uploads up to that size are judged by their whole time.
+    """
+    return elapsed / max(1.0, len(body) / S3_LATENCY_UNIT_BYTES)
+
+
+def is_retryable(e):
+    if isinstance(e, ClientError):
+        return e.response["Error"]["Code"] in RETRYABLE_CODES
+    return is_congestion(e) or isinstance(
+        e, (aiohttp.ClientError, EndpointConnectionError)
+    )
+
+
+class AIMDLimiter:
+    """Additive increase / multiplicative decrease cap on concurrent S3 requests
+
+    Every healthy request grows the limit by about one per limit's worth of
+    requests, a throttled, timed out or slow request halves it, at most once per
+    cooldown so a burst of failures only counts once.
+    """
+
+    def __init__(
+        self,
+        initial=INITIAL_S3_CONCURRENCY,
+        min_limit=MIN_S3_CONCURRENCY,
+        max_limit=MAX_S3_CONCURRENCY,
+        latency_ceiling=S3_LATENCY_CEILING_SECONDS,
+        decrease_factor=0.5,
+        cooldown=1.0,
+    ):
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_ceiling = latency_ceiling
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.inflight = 0
+        self.last_decrease = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+
+    async def release(self, latency, congested=False):
+        async with self.condition:
+            self.inflight -= 1
+            now = time.monotonic()
+            if congested or latency > self.latency_ceiling:
+                if now - self.last_decrease > self.cooldown:
+                    old_limit = self.limit
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+                    print(
+                        f"S3 congested, concurrency {int(old_limit)} -> {int(self.limit)}"
+                    )
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class PartWriter(io.RawIOBase):
+    """Binary file object handing what is written to S3IO.put_stream() in parts
+
+    Written from a worker thread while put_stream() consumes the parts on the
+    loop. A writer blocks once max_queued parts wait for upload, so only a few
+    parts of an object are held in memory at a time.
+    """
+
+    ABORTED = object()
+
+    def __init__(
+        self, loop, part_size=MULTIPART_PART_SIZE, max_queued=MAX_QUEUED_PARTS
+    ):
+        super().__init__()
+        self.loop = loop
+        self.part_size = part_size
+        self.queue = asyncio.Queue(max_queued)
+        self.buffer = bytearray()
+        self.sent = 0
+        self.stopped = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._send(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+        return len(data)
+
+    def _send(self, part):
+        asyncio.run_coroutine_threadsafe(self._put(part), self.loop).result()
+        self.sent += 1
+
+    async def _put(self, part):
+        # Once the consumer has stopped nothing reads the queue anymore
+        if not self.stopped:
+            await self.queue.put(part)
+
+    def close(self):
+        """End the stream, a short last part is sent first"""
+        if not self.closed:
+            if self.buffer or self.sent == 0:
+                self._send(bytes(self.buffer))
+                self.buffer.clear()
+            self._send(None)
+        super().close()
+
+    def abort(self):
+        """End the stream without uploading it"""
+        if not self.closed:
+            self._send(self.ABORTED)
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    async def get(self):
+        part = await self.queue.get()
+        if part is self.ABORTED:
+            raise RuntimeError("Upload aborted by its writer")
+        return part
+
+    async def discard(self):
+        """Stop consuming, unblocking a writer waiting on a full queue"""
+        self.stopped = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class S3IO:
+    """Async S3 reads and writes on one shared event loop
+
+    The loop runs in a background thread so synchronous code (processors, the
+    follow loop) can hand it coroutines with run() or fire and forget uploads with
+    put_nowait(). CPU work started from coroutines goes through to_thread().
+    Every request goes through one AIMDLimiter and is retried with jittered
+    exponential backoff, a request that keeps failing raises.
+    """
+
+    def __init__(
+        self,
+        get_credentials,
+        destination_endpoint_url=None,
+        max_concurrency=MAX_S3_CONCURRENCY,
+        max_pending_writes=MAX_PENDING_WRITES,
+    ):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.pending_writes = threading.BoundedSemaphore(max_pending_writes)
+        self.inflight = set()
+        self.inflight_lock = threading.Lock()
+        self.retries = 0
+        # The clients are opened by the first request, runs writing to a local
+        # or memory sink from a local source use the loop only and need no
+        # credentials
+        self.get_credentials = get_credentials
+        self.destination_endpoint_url = destination_endpoint_url
+        self.max_concurrency = max_concurrency
+        self.clients = None
+        self.run(self._start())
+
+    async def _start(self):
+        self.limiter = AIMDLimiter(max_limit=self.max_concurrency)
+        self.exit_stack = AsyncExitStack()
+        self.open_lock = asyncio.Lock()
+
+    async def _client(self, source=False):
+        """The source or the destination client, opened on first use"""
+        async with self.open_lock:
+            if self.clients is None:
+                self.clients = await self._open()
+        return self.clients[0] if source else self.clients[1]
+
+    async def _open(self):
+        credentials = await self.to_thread(self.get_credentials)
+        session = get_session()
+        client_args = {
+            "aws_access_key_id": credentials["access_key"],
+            "aws_secret_access_key": credentials["secret_key"],
+            "aws_session_token": credentials.get("token"),
+            # Retries are ours, see _request
+            "config": AioConfig(
+                max_pool_connections=self.max_concurrency,
+                connect_timeout=10,
+                read_timeout=60,
+                retries={"total_max_attempts": 1},
+            ),
+        }
+        source = await self.exit_stack.enter_async_context(
+            session.create_client("s3", **client_args)
+        )
+        destination = await self.exit_stack.enter_async_context(
+            session.create_client(
+                "s3", endpoint_url=self.destination_endpoint_url, **client_args
+            )
+        )
+        return source, destination
+
+    def run(self, coro):
+        """Run coro on the shared loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def to_thread(self, fn, *args):
+        return await self.loop.run_in_executor(None, fn, *args)
+
+    async def _request(self, request):
+        """Run request under the limiter, retrying retryable failures
+
+        request returns (result, latency), where latency is what the limiter
+        judges the request by: the time to first byte, see upload_latency() for
+        uploads.
+        """
+        attempt = 0
+        while True:
+            await self.limiter.acquire()
+            try:
+                result, latency = await request()
+            except Exception as e:
+                # A failure is judged by its kind, its time may be an upload's
+                await self.limiter.release(0.0, is_congestion(e))
+                attempt += 1
+                if not is_retryable(e) or attempt >= S3_MAX_ATTEMPTS:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(
+                    random.uniform(
+                        0,
+                        min(
+                            S3_BACKOFF_MAX_SECONDS,
+                            S3_BACKOFF_BASE_SECONDS * 2**attempt,
+                        ),
+                    )
+                )
+                continue
+            await self.limiter.release(latency)
+            return result
+
+    async def get(self, bucket, key, source=True, byte_range=None):
+        """The object's body, or the part of it in byte_range, e.g. bytes=-1024"""
+        client = await self._client(source)
+        kwargs = {} if byte_range is None else {"Range": byte_range}
+
+        async def request():
+            start = time.monotonic()
+            response = await client.get_object(Bucket=bucket, Key=key, **kwargs)
+            latency = time.monotonic() - start
+            async with response["Body"] as stream:
+                return await stream.read(), latency
+
+        return await self._request(request)
+
+    async def get_if_exists(self, bucket, key, source=False):
+        try:
+            return await self.get(bucket, key, source=source)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    async def head_if_exists(self, bucket, key):
+        destination = await self._client()
+
+        async def request():
+            start = time.monotonic()
+            response = await destination.head_object(Bucket=bucket, Key=key)
+            return response, time.monotonic() - start
+
+        try:
+            return await self._request(request)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    async def put(self, bucket, key, body, **kwargs):
+        destination = await self._client()
+
+        async def request():
+            start = time.monotonic()
+            response = await destination.put_object(
+                Bucket=bucket, Key=key, Body=body, **kwargs
+            )
+            return response, upload_latency(time.monotonic() - start, body)
+
+        return await self._request(request)
+
+    def open_stream(self, part_size=MULTIPART_PART_SIZE):
+        """A PartWriter to serialize an object into, see put_stream()"""
+        return PartWriter(self.loop, part_size)
+
+    async def put_stream(self, bucket, key, parts, **kwargs):
+        """Upload what is written to parts, a PartWriter
+
+        Objects that fit in one part go up with a single put, larger ones as a
+        multipart upload whose parts are uploaded while the writer produces more.
+        """
+        try:
+            first = await parts.get()
+            second = await parts.get()
+            if second is None:
+                return await self.put(bucket, key, first, **kwargs)
+            return await self._put_multipart(
+                bucket, key, parts, [first, second], **kwargs
+            )
+        finally:
+            await parts.discard()
+
+    async def _put_multipart(self, bucket, key, parts, received, **kwargs):
+        destination = await self._client()
+
+        async def create():
+            start = time.monotonic()
+            response = await destination.create_multipart_upload(
+                Bucket=bucket, Key=key, **kwargs
+            )
+            return response, time.monotonic() - start
+
+        upload_id = (await self._request(create))["UploadId"]
+        slots = asyncio.Semaphore(MAX_PARALLEL_PARTS)
+
+        async def upload_part(number, body):
+            async def request():
+                start = time.monotonic()
+                response = await destination.upload_part(
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=number,
+                    Body=body,
+                )
+                return (
+                    {"ETag": response["ETag"], "PartNumber": number},
+                    upload_latency(time.monotonic() - start, body),
+                )
+
+            try:
+                return await self._request(request)
+            finally:
+                slots.release()
+
+        tasks = []
+        try:
+            while True:
+                body = received.pop(0) if received else await parts.get()
+                if body is None:
+                    break
+                await slots.acquire()
+                tasks.append(asyncio.create_task(upload_part(len(tasks) + 1, body)))
+            completed = await asyncio.gather(*tasks)
+
+            async def complete():
+                start = time.monotonic()
+                response = await destination.complete_multipart_upload(
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    MultipartUpload={"Parts": completed},
+                )
+                return response, time.monotonic() - start
+
+            return await self._request(complete)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                await destination.abort_multipart_upload(
+                    Bucket=bucket, Key=key, UploadId=upload_id
+                )
+            except Exception as e:
+                print(f"Failed to abort multipart upload of {key}. Error: {e}")
+            raise
+
+    async def delete(self, bucket, key):
+        destination = await self._client()
+
+        async def request():
+            start = time.monotonic()
+            response = await destination.delete_object(Bucket=bucket, Key=key)
+            return response, time.monotonic() - start
+
+        return await self._request(request)
+
+    async def list(self, bucket, prefix, start_after="", source=True):
+        client = await self._client(source)
+        objects = []
+        kwargs = {"Bucket": bucket, "Prefix": prefix, "StartAfter": start_after}
+        while True:
+
+            async def request():
+                start = time.monotonic()
+                page = await client.list_objects_v2(**kwargs)
+                return page, time.monotonic() - start
+
+            page = await self._request(request)
+            objects.extend(page.get("Contents", []))
+            if not page.get("IsTruncated"):
+                return objects
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+    def put_nowait(self, bucket, key, body, **kwargs):
+        """Submit an upload without waiting for it, see drain()"""
+        return self.submit(self.put(bucket, key, body, **kwargs))
+
+    def submit(self, coro):
+        """Schedule a write coroutine without waiting for it, see drain()"""
+        self.pending_writes.acquire()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        with self.inflight_lock:
+            self.inflight.add(future)
+        future.add_done_callback(self._write_done)
+        return future
+
+    def _write_done(self, future):
+        self.pending_writes.release()
+        if future.exception() is None:
+            with self.inflight_lock:
+                self.inflight.discard(future)
+
+    def drain(self):
+        """Wait for every submitted upload, raising the first failure"""
+        with self.inflight_lock:
+            futures, self.inflight = self.inflight, set()
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.drain()
+        self.run(self.exit_stack.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
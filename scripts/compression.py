@@ -0,0 +1,283 @@
+import asyncio
+import io
+import os
+import struct
+import threading
+import zlib
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import zstandard
+
+# Uncompressed bytes per independently compressed gzip block, the blocks of one
+# object are compressed in parallel. Smaller objects are compressed whole, many
+# objects in parallel
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+COMPRESSION_WORKERS = os.cpu_count() or 1
+# Each block is primed with the tail of the previous one, so splitting costs
+# next to nothing in compression ratio
+DEFLATE_WINDOW = 32 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+# No file name, mtime 0 so identical content gives identical bytes
+GZIP_HEADER = GZIP_MAGIC + b"\x08\x00" + struct.pack("<I", 0) + b"\x00\xff"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+COMPRESSION_POOL: ThreadPoolExecutor | None = None
+_local = threading.local()
+
+
+def get_compression_pool():
+    global COMPRESSION_POOL
+    if COMPRESSION_POOL is None:
+        COMPRESSION_POOL = ThreadPoolExecutor(
+            COMPRESSION_WORKERS, thread_name_prefix="compress"
+        )
+    return COMPRESSION_POOL
+
+
+def _reset_compression_pool():
+    # Pool threads do not survive a fork
+    global COMPRESSION_POOL
+    COMPRESSION_POOL = None
+
+
+os.register_at_fork(after_in_child=_reset_compression_pool)
+
+
+@dataclass(frozen=True)
+class Codec:
+    name: str  # "gzip" or "zstd"
+    level: int
+
+    @property
+    def content_encoding(self):
+        return self.name
+
+    def writer(self, raw):
+        """A binary file object compressing into raw, which it does not close"""
+        if self.name == "gzip":
+            return GzipBlockWriter(raw, self.level)
+        return ZstdWriter(raw, self.level)
+
+    def compress(self, data):
+        """data compressed in one go on the calling thread, for small objects
+
+        zstd contexts are reused across objects. zlib offers no way to reset a
+        context from Python, creating one takes under 1% of compressing a 15 KiB
+        object at level 9.
+        """
+        if self.name == "gzip":
+            return (
+                GZIP_HEADER
+                + deflate_block(data, self.level, b"", last=True)
+                + struct.pack("<II", zlib.crc32(data), len(data) & 0xFFFFFFFF)
+            )
+        return zstd_compressor(self.level, threads=0).compress(data)
+
+
+# The level of pandas' compression="gzip", which objects were written with before
+DEFAULT_CODEC = Codec("gzip", 9)
+
+
+def parse_codec(value):
+    """Parse a record type codec argument like tradeRecords=zstd:3"""
+    try:
+        record_type, spec = value.split("=")
+        name, level = spec.split(":")
+        codec = Codec(name, int(level))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Codec must look like recordType=codec:level, got {value}"
+        )
+    if codec.name == "gzip" and not 0 <= codec.level <= 9:
+        raise argparse.ArgumentTypeError(f"gzip level must be in [0, 9], got {value}")
+    if codec.name == "zstd" and not 1 <= codec.level <= 22:
+        raise argparse.ArgumentTypeError(f"zstd level must be in [1, 22], got {value}")
+    if codec.name not in ("gzip", "zstd"):
+        raise argparse.ArgumentTypeError(f"Unknown codec {codec.name}")
+    return record_type, codec
+
+
+def decompress(body):
+    """Decompress an object written by any codec, detected by its magic bytes"""
+    if body[:4] == ZSTD_MAGIC:
+        return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)).read()
+    if body[:2] == GZIP_MAGIC:
+        return zlib.decompress(body, wbits=47)
+    return body
+
+
+def deflate_block(block, level, zdict, last):
+    """Raw deflate one block, ending on a byte boundary unless it is the last"""
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+class GzipBlockWriter(io.RawIOBase):
+    """Single member gzip stream whose deflate blocks are compressed in parallel
+
+    The same layout pigz writes: every block but the last ends with a sync flush,
+    so the compressed blocks concatenate into one ordinary deflate stream. Objects
+    smaller than a block are compressed inline without touching the pool.
+    """
+
+    def __init__(self, raw, level, block_size=COMPRESSION_BLOCK_SIZE):
+        super().__init__()
+        self.raw = raw
+        self.level = level
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.tail = b""
+        self.crc = 0
+        self.size = 0
+        self.pending = deque()
+        self.started = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._compress(bytes(self.buffer[: self.block_size]), last=False)
+            del self.buffer[: self.block_size]
+        return len(data)
+
+    def _compress(self, block, last):
+        if not self.started:
+            self.raw.write(GZIP_HEADER)
+            self.started = True
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        zdict, self.tail = self.tail, block[-DEFLATE_WINDOW:]
+        if last and not self.pending:
+            self.raw.write(deflate_block(block, self.level, zdict, last))
+            return
+        self.pending.append(
+            get_compression_pool().submit(deflate_block, block, self.level, zdict, last)
+        )
+        while len(self.pending) > (0 if last else 2 * COMPRESSION_WORKERS):
+            self.raw.write(self.pending.popleft().result())
+
+    def close(self):
+        if not self.closed:
+            self._compress(bytes(self.buffer), last=True)
+            self.buffer.clear()
+            self.raw.write(struct.pack("<II", self.crc, self.size & 0xFFFFFFFF))
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for future in self.pending:
+                future.cancel()
+            super().close()
+
+
+def zstd_compressor(level, threads):
+    """This thread's ZstdCompressor of level, reused across objects"""
+    compressors = getattr(_local, "zstd", None)
+    if compressors is None:
+        compressors = _local.zstd = {}
+    if (level, threads) not in compressors:
+        compressors[level, threads] = zstandard.ZstdCompressor(
+            level=level, threads=threads
+        )
+    return compressors[level, threads]
+
+
+class ZstdWriter(io.RawIOBase):
+    """zstd frame compressed with zstd's own worker threads"""
+
+    def __init__(self, raw, level):
+        super().__init__()
+        self.raw = raw
+        self.compressor = zstd_compressor(
+            level, COMPRESSION_WORKERS if COMPRESSION_WORKERS > 1 else 0
+        ).compressobj()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.raw.write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.raw.write(self.compressor.flush())
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            super().close()
+
+
+class BufferedCompressor(io.RawIOBase):
+    """Keeps what is written uncompressed while it is smaller than a block
+
+    Small objects, like most per-user ones, are then compressed whole with
+    Codec.compress, see compress_on_pool(). Once a block has been written the
+    rest streams through codec.writer(raw).
+    """
+
+    def __init__(self, codec, raw, block_size=COMPRESSION_BLOCK_SIZE):
+        super().__init__()
+        self.codec = codec
+        self.raw = raw
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.writer = None
+
+    @property
+    def small(self):
+        """Whether everything written is still uncompressed in buffer"""
+        return self.writer is None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.writer is not None:
+            return self.writer.write(data)
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            self.writer = self.codec.writer(self.raw)
+            self.writer.write(bytes(self.buffer))
+            self.buffer = bytearray()
+        return len(data)
+
+    def close(self):
+        if not self.closed and self.writer is not None:
+            self.writer.close()
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            if self.writer is not None:
+                self.writer.__exit__(exc_type, exc, tb)
+            super().close()
+
+
+async def compress_on_pool(codec, data):
+    """Codec.compress of a small object on the compression pool
+
+    Many small objects are compressed at once this way, while the threads that
+    serialize them move on to the next ones.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        get_compression_pool(), codec.compress, data
+    )
@@ -1,3 +1,6 @@
+import functools
+import math
+
 import anchorpy.program.common as anchorpy
 from driftpy.constants import (
     QUOTE_PRECISION,
@@ -12,6 +15,8 @@ from driftpy.types import OrderActionExplanation, MarketType, PositionDirection
 from typing import TypedDict
 import re
 
+from scripts.tables import FixedPoint
+
 
 class EventMetadata(TypedDict):
     tx_sig: str
@@ -30,9 +35,33 @@ def to_camel_case(type) -> str:
     return words[0].lower() + "".join(word.capitalize() for word in words[1:])
 
 
-def parse_event(event: anchorpy.Event, metadata: EventMetadata):
+def to_float(value, precision):
+    return value / precision
+
+
+@functools.lru_cache(maxsize=None)
+def precision_exponent(precision):
+    return round(math.log10(precision))
+
+
+def to_fixed_point(value, precision):
+    return FixedPoint(value, precision_exponent(precision))
+
+
+def parse_event(
+    event: anchorpy.Event,
+    metadata: EventMetadata,
+    liquidation_layout="compact",
+    fixed_point=False,
+):
+    """Flatten a decoded event into a dict of output columns
+
+    Amounts are divided by their precision into floats, or with fixed_point kept
+    as the exact integers with their decimal exponent, see FixedPoint.
+    """
     from scripts.load_markets import SPOT_MARKETS
 
+    scale = to_fixed_point if fixed_point else to_float
     raw_data = event.data
     data = vars(raw_data)
     match event.name:
@@ -49,47 +78,49 @@ def parse_event(event: anchorpy.Event, metadata: EventMetadata):
                 base_precision = BASE_PRECISION
 
             return {
-                "fillerReward": (data.get("filler_reward", 0) or 0) / QUOTE_PRECISION,
-                "baseAssetAmountFilled": (data.get("base_asset_amount_filled", 0) or 0)
-                / base_precision,
-                "quoteAssetAmountFilled": (
-                    data.get("quote_asset_amount_filled", 0) or 0
-                )
-                / QUOTE_PRECISION,
-                "takerFee": (data.get("taker_fee", 0) or 0) / QUOTE_PRECISION,
-                "makerRebate": (data.get("maker_fee", 0) or 0) / QUOTE_PRECISION,
-                "referrerReward": (data.get("referrer_reward", 0) or 0)
-                / QUOTE_PRECISION,
-                "quoteAssetAmountSurplus": (
-                    data.get("quote_asset_amount_surplus", 0) or 0
-                )
-                / QUOTE_PRECISION,
-                "takerOrderBaseAssetAmount": (
-                    data.get("taker_order_base_asset_amount", 0) or 0
-                )
-                / base_precision,
-                "takerOrderCumulativeBaseAssetAmountFilled": (
-                    data.get("taker_order_cumulative_base_asset_amount_filled", 0) or 0
-                )
-                / base_precision,
-                "takerOrderCumulativeQuoteAssetAmountFilled": (
-                    data.get("taker_order_cumulative_quote_asset_amount_filled", 0) or 0
-                )
-                / QUOTE_PRECISION,
-                "makerOrderBaseAssetAmount": (
-                    data.get("maker_order_base_asset_amount", 0) or 0
-                )
-                / base_precision,
-                "makerOrderCumulativeBaseAssetAmountFilled": (
-                    data.get("maker_order_cumulative_base_asset_amount_filled", 0) or 0
-                )
-                / base_precision,
-                "makerOrderCumulativeQuoteAssetAmountFilled": (
-                    data.get("maker_order_cumulative_quote_asset_amount_filled", 0) or 0
-                )
-                / QUOTE_PRECISION,
-                "oraclePrice": (data.get("oracle_price", 0) or 0) / PRICE_PRECISION,
-                "makerFee": (data.get("maker_fee", 0) or 0) / QUOTE_PRECISION,
+                "fillerReward": scale(
+                    data.get("filler_reward", 0) or 0, QUOTE_PRECISION
+                ),
+                "baseAssetAmountFilled": scale(
+                    data.get("base_asset_amount_filled", 0) or 0, base_precision
+                ),
+                "quoteAssetAmountFilled": scale(
+                    data.get("quote_asset_amount_filled", 0) or 0, QUOTE_PRECISION
+                ),
+                "takerFee": scale(data.get("taker_fee", 0) or 0, QUOTE_PRECISION),
+                "makerRebate": scale(data.get("maker_fee", 0) or 0, QUOTE_PRECISION),
+                "referrerReward": scale(
+                    data.get("referrer_reward", 0) or 0, QUOTE_PRECISION
+                ),
+                "quoteAssetAmountSurplus": scale(
+                    data.get("quote_asset_amount_surplus", 0) or 0, QUOTE_PRECISION
+                ),
+                "takerOrderBaseAssetAmount": scale(
+                    data.get("taker_order_base_asset_amount", 0) or 0, base_precision
+                ),
+                "takerOrderCumulativeBaseAssetAmountFilled": scale(
+                    data.get("taker_order_cumulative_base_asset_amount_filled", 0) or 0,
+                    base_precision,
+                ),
+                "takerOrderCumulativeQuoteAssetAmountFilled": scale(
+                    data.get("taker_order_cumulative_quote_asset_amount_filled", 0)
+                    or 0,
+                    QUOTE_PRECISION,
+                ),
+                "makerOrderBaseAssetAmount": scale(
+                    data.get("maker_order_base_asset_amount", 0) or 0, base_precision
+                ),
+                "makerOrderCumulativeBaseAssetAmountFilled": scale(
+                    data.get("maker_order_cumulative_base_asset_amount_filled", 0) or 0,
+                    base_precision,
+                ),
+                "makerOrderCumulativeQuoteAssetAmountFilled": scale(
+                    data.get("maker_order_cumulative_quote_asset_amount_filled", 0)
+                    or 0,
+                    QUOTE_PRECISION,
+                ),
+                "oraclePrice": scale(data.get("oracle_price", 0) or 0, PRICE_PRECISION),
+                "makerFee": scale(data.get("maker_fee", 0) or 0, QUOTE_PRECISION),
                 "txSig": metadata["tx_sig"],
                 "slot": metadata["slot"],
                 "ts": data["ts"],
@@ -109,22 +140,24 @@ def parse_event(event: anchorpy.Event, metadata: EventMetadata):
                 "makerOrderDirection": to_camel_case(
                     data.get("maker_order_direction", "")
                 ),
-                "spotFulfillmentMethodFee": (
-                    data.get("spot_fulfillment_method_fee", 0) or 0
-                )
-                / QUOTE_PRECISION,
+                "spotFulfillmentMethodFee": scale(
+                    data.get("spot_fulfillment_method_fee", 0) or 0, QUOTE_PRECISION
+                ),
             }
         case "SettlePnlRecord":
             return {
-                "pnl": (data.get("pnl", 0) or 0) / PRICE_PRECISION,
+                "pnl": scale(data.get("pnl", 0) or 0, PRICE_PRECISION),
                 "user": data["user"],
-                "baseAssetAmount": (data.get("base_asset_amount", 0) or 0)
-                / BASE_PRECISION,
-                "quoteAssetAmountAfter": (data.get("quote_asset_amount_after", 0) or 0)
-                / QUOTE_PRECISION,
-                "quoteEntryAmount": (data.get("quote_entry_amount", 0) or 0)
-                / QUOTE_PRECISION,
-                "settlePrice": (data.get("settle_price", 0) or 0) / QUOTE_PRECISION,
+                "baseAssetAmount": scale(
+                    data.get("base_asset_amount", 0) or 0, BASE_PRECISION
+                ),
+                "quoteAssetAmountAfter": scale(
+                    data.get("quote_asset_amount_after", 0) or 0, QUOTE_PRECISION
+                ),
+                "quoteEntryAmount": scale(
+                    data.get("quote_entry_amount", 0) or 0, QUOTE_PRECISION
+                ),
+                "settlePrice": scale(data.get("settle_price", 0) or 0, QUOTE_PRECISION),
                 "txSig": metadata["tx_sig"],
                 "slot": metadata["slot"],
                 "ts": data["ts"],
@@ -139,24 +172,28 @@ def parse_event(event: anchorpy.Event, metadata: EventMetadata):
                 None,
             ).mintPrecision
             return {
-                "amount": (data.get("amount", 0) or 0) / 10**token_precision,
-                "oraclePrice": (data.get("oracle_price", 0) or 0) / PRICE_PRECISION,
-                "marketDepositBalance": (data.get("market_deposit_balance", 0) or 0)
-                / SPOT_BALANCE_PRECISION,
-                "marketWithdrawBalance": (data.get("market_withdraw_balance", 0) or 0)
-                / SPOT_BALANCE_PRECISION,
-                "marketCumulativeDepositInterest": (
-                    data.get("market_cumulative_deposit_interest", 0) or 0
-                )
-                / SPOT_CUMULATIVE_INTEREST_PRECISION,
-                "marketCumulativeBorrowInterest": (
-                    data.get("market_cumulative_borrow_interest", 0) or 0
-                )
-                / SPOT_CUMULATIVE_INTEREST_PRECISION,
-                "totalDepositsAfter": (data.get("total_deposits_after", 0) or 0)
-                / QUOTE_PRECISION,
-                "totalWithdrawsAfter": (data.get("total_withdraws_after", 0) or 0)
-                / QUOTE_PRECISION,
+                "amount": scale(data.get("amount", 0) or 0, 10**token_precision),
+                "oraclePrice": scale(data.get("oracle_price", 0) or 0, PRICE_PRECISION),
+                "marketDepositBalance": scale(
+                    data.get("market_deposit_balance", 0) or 0, SPOT_BALANCE_PRECISION
+                ),
+                "marketWithdrawBalance": scale(
+                    data.get("market_withdraw_balance", 0) or 0, SPOT_BALANCE_PRECISION
+                ),
+                "marketCumulativeDepositInterest": scale(
+                    data.get("market_cumulative_deposit_interest", 0) or 0,
+                    SPOT_CUMULATIVE_INTEREST_PRECISION,
+                ),
+                "marketCumulativeBorrowInterest": scale(
+                    data.get("market_cumulative_borrow_interest", 0) or 0,
+                    SPOT_CUMULATIVE_INTEREST_PRECISION,
+                ),
+                "totalDepositsAfter": scale(
+                    data.get("total_deposits_after", 0) or 0, QUOTE_PRECISION
+                ),
+                "totalWithdrawsAfter": scale(
+                    data.get("total_withdraws_after", 0) or 0, QUOTE_PRECISION
+                ),
                 "txSig": metadata["tx_sig"],
                 "slot": metadata["slot"],
                 "ts": data["ts"],
@@ -176,17 +213,20 @@ def parse_event(event: anchorpy.Event, metadata: EventMetadata):
                 None,
             ).mintPrecision
             return {
-                "vaultAmountBefore": (data.get("vault_amount_before", 0) or 0)
-                / 10**token_precision,
-                "insuranceVaultAmountBefore": (
-                    data.get("insurance_vault_amount_before", 0) or 0
-                )
-                / 10**token_precision,
-                "totalIfSharesBefore": (data.get("total_if_shares_before", 0) or 0)
-                / QUOTE_PRECISION,
-                "totalIfSharesAfter": (data.get("total_if_shares_after", 0) or 0)
-                / QUOTE_PRECISION,
-                "amount": (data.get("amount", 0) or 0) / 10**token_precision,
+                "vaultAmountBefore": scale(
+                    data.get("vault_amount_before", 0) or 0, 10**token_precision
+                ),
+                "insuranceVaultAmountBefore": scale(
+                    data.get("insurance_vault_amount_before", 0) or 0,
+                    10**token_precision,
+                ),
+                "totalIfSharesBefore": scale(
+                    data.get("total_if_shares_before", 0) or 0, QUOTE_PRECISION
+                ),
+                "totalIfSharesAfter": scale(
+                    data.get("total_if_shares_after", 0) or 0, QUOTE_PRECISION
+                ),
+                "amount": scale(data.get("amount", 0) or 0, 10**token_precision),
                 "ts": data["ts"],
                 "txSig": metadata["tx_sig"],
                 "slot": metadata["slot"],
@@ -203,179 +243,38 @@ def parse_event(event: anchorpy.Event, metadata: EventMetadata):
                 None,
             ).mintPrecision
             return {
-                "amount": (data.get("amount", 0) or 0) / 10**token_precision,
+                "amount": scale(data.get("amount", 0) or 0, 10**token_precision),
                 "userAuthority": data["user_authority"],
                 "action": to_camel_case(data.get("action", "")),
                 "ts": data["ts"],
                 "txSig": metadata["tx_sig"],
                 "slot": metadata["slot"],
                 "marketIndex": data["market_index"],
-                "ifSharesBefore": (data.get("if_shares_before", 0) or 0)
-                / QUOTE_PRECISION,
-                "userIfSharesBefore": (data.get("user_if_shares_before", 0) or 0)
-                / QUOTE_PRECISION,
-                "totalIfSharesBefore": (data.get("total_if_shares_before", 0) or 0)
-                / QUOTE_PRECISION,
-                "ifSharesAfter": (data.get("if_shares_after", 0) or 0)
-                / QUOTE_PRECISION,
-                "userIfSharesAfter": (data.get("user_if_shares_after", 0) or 0)
-                / QUOTE_PRECISION,
-                "totalIfSharesAfter": (data.get("total_if_shares_after", 0) or 0)
-                / QUOTE_PRECISION,
-                "insuranceVaultAmountBefore": (
-                    data.get("insurance_vault_amount_before", 0) or 0
-                )
-                / 10**token_precision,
-            }
-        case "LiquidationRecord":
-            liquidatePerp = vars(raw_data.liquidate_perp)
-            liquidateSpot = vars(raw_data.liquidate_spot)
-            liquidateBorrowForPerpPnl = vars(raw_data.liquidate_borrow_for_perp_pnl)
-            liquidatePerpPnlForDeposit = vars(raw_data.liquidate_perp_pnl_for_deposit)
-            perpBankruptcy = vars(raw_data.perp_bankruptcy)
-            spotBankruptcy = vars(raw_data.spot_bankruptcy)
-
-            token_precision = next(
-                filter(
-                    lambda x: x.marketIndex
-                    == int(liquidateSpot["liability_market_index"]),
-                    SPOT_MARKETS,
+                "ifSharesBefore": scale(
+                    data.get("if_shares_before", 0) or 0, QUOTE_PRECISION
                 ),
-                None,
-            ).mintPrecision
-            spot_token_precision = next(
-                filter(
-                    lambda x: x.marketIndex == int(spotBankruptcy["market_index"]),
-                    SPOT_MARKETS,
+                "userIfSharesBefore": scale(
+                    data.get("user_if_shares_before", 0) or 0, QUOTE_PRECISION
+                ),
+                "totalIfSharesBefore": scale(
+                    data.get("total_if_shares_before", 0) or 0, QUOTE_PRECISION
+                ),
+                "ifSharesAfter": scale(
+                    data.get("if_shares_after", 0) or 0, QUOTE_PRECISION
+                ),
+                "userIfSharesAfter": scale(
+                    data.get("user_if_shares_after", 0) or 0, QUOTE_PRECISION
+                ),
+                "totalIfSharesAfter": scale(
+                    data.get("total_if_shares_after", 0) or 0, QUOTE_PRECISION
+                ),
+                "insuranceVaultAmountBefore": scale(
+                    data.get("insurance_vault_amount_before", 0) or 0,
+                    10**token_precision,
                 ),
-                None,
-            ).mintPrecision
-            return {
-                "ts": data["ts"],
-                "txSig": metadata["tx_sig"],
-                "slot": metadata["slot"],
-                "liquidationType": to_camel_case(data.get("liquidation_type", "")),
-                "user": data["user"],
-                "liquidator": data["liquidator"],
-                "marginRequirement": (data["margin_requirement"] or 0)
-                / QUOTE_PRECISION,
-                "totalCollateral": (data["total_collateral"] or 0) / QUOTE_PRECISION,
-                "marginFreed": (data["margin_freed"] or 0) / QUOTE_PRECISION,
-                "liquidationId": data["liquidation_id"],
-                "bankrupt": data["bankrupt"],
-                "canceledOrderIds": data["canceled_order_ids"],
-                "liquidatePerp_marketIndex": liquidatePerp["market_index"],
-                "liquidatePerp_oraclePrice": (liquidatePerp.get("oracle_price", 0) or 0)
-                / PRICE_PRECISION,
-                "liquidatePerp_baseAssetAmount": (
-                    liquidatePerp.get("base_asset_amount", 0) or 0
-                )
-                / BASE_PRECISION,
-                "liquidatePerp_quoteAssetAmount": (
-                    liquidatePerp.get("quote_asset_amount", 0) or 0
-                )
-                / QUOTE_PRECISION,
-                "liquidatePerp_lpShares": (liquidatePerp.get("lp_shares", 0) or 0)
-                / AMM_RESERVE_PRECISION,
-                "liquidatePerp_fillRecordId": liquidatePerp["fill_record_id"],
-                "liquidatePerp_userOrderId": liquidatePerp["user_order_id"],
-                "liquidatePerp_liquidatorOrderId": liquidatePerp["liquidator_order_id"],
-                "liquidatePerp_liquidatorFee": (
-                    liquidatePerp.get("liquidator_fee", 0) or 0
-                )
-                / QUOTE_PRECISION,
-                "liquidatePerp_ifFee": (liquidatePerp.get("if_fee", 0) or 0)
-                / QUOTE_PRECISION,
-                "liquidateSpot_assetMarketIndex": liquidateSpot["asset_market_index"],
-                "liquidateSpot_assetPrice": (liquidateSpot.get("asset_price", 0) or 0)
-                / PRICE_PRECISION,
-                "liquidateSpot_assetTransfer": (
-                    liquidateSpot.get("asset_transfer", 0) or 0
-                )
-                / 10**spot_token_precision,
-                "liquidateSpot_liabilityMarketIndex": liquidateSpot[
-                    "liability_market_index"
-                ],
-                "liquidateSpot_liabilityPrice": (
-                    liquidateSpot.get("liability_price", 0) or 0
-                )
-                / PRICE_PRECISION,
-                "liquidateSpot_liabilityTransfer": (
-                    liquidateSpot.get("liability_transfer", 0) or 0
-                )
-                / 10**token_precision,
-                "liquidateSpot_ifFee": (liquidateSpot["if_fee"] or 0)
-                / 10**token_precision,
-                "liquidateBorrowForPerpPnl_perpMarketIndex": liquidateBorrowForPerpPnl[
-                    "perp_market_index"
-                ],
-                "liquidateBorrowForPerpPnl_marketOraclePrice": (
-                    liquidateBorrowForPerpPnl.get("market_oracle_price", 0) or 0
-                )
-                / PRICE_PRECISION,
-                "liquidateBorrowForPerpPnl_pnlTransfer": (
-                    liquidateBorrowForPerpPnl.get("pnl_transfer", 0) or 0
-                )
-                / QUOTE_PRECISION,
-                "liquidateBorrowForPerpPnl_liabilityMarketIndex": liquidateBorrowForPerpPnl[
-                    "liability_market_index"
-                ],
-                "liquidateBorrowForPerpPnl_liabilityPrice": (
-                    liquidateBorrowForPerpPnl.get("liability_price", 0) or 0
-                )
-                / PRICE_PRECISION,
-                "liquidateBorrowForPerpPnl_liabilityTransfer": (
-                    liquidateBorrowForPerpPnl.get("liability_transfer", 0) or 0
-                )
-                / QUOTE_PRECISION,
-                "liquidatePerpPnlForDeposit_perpMarketIndex": liquidatePerpPnlForDeposit[
-                    "perp_market_index"
-                ],
-                "liquidatePerpPnlForDeposit_marketOraclePrice": (
-                    liquidatePerpPnlForDeposit.get("market_oracle_price", 0) or 0
-                )
-                / PRICE_PRECISION,
-                "liquidatePerpPnlForDeposit_pnlTransfer": (
-                    liquidatePerpPnlForDeposit.get("pnl_transfer", 0) or 0
-                )
-                / QUOTE_PRECISION,
-                "liquidatePerpPnlForDeposit_assetMarketIndex": liquidatePerpPnlForDeposit[
-                    "asset_market_index"
-                ],
-                "liquidatePerpPnlForDeposit_assetPrice": (
-                    liquidatePerpPnlForDeposit.get("asset_price", 0) or 0
-                )
-                / PRICE_PRECISION,
-                "liquidatePerpPnlForDeposit_assetTransfer": (
-                    liquidatePerpPnlForDeposit.get("asset_transfer", 0) or 0
-                )
-                / BASE_PRECISION,
-                "perpBankruptcy_marketIndex": perpBankruptcy["market_index"],
-                "perpBankruptcy_pnl": (perpBankruptcy.get("pnl", 0) or 0)
-                / QUOTE_PRECISION,
-                "perpBankruptcy_ifPayment": (perpBankruptcy.get("if_payment", 0) or 0)
-                / QUOTE_PRECISION,
-                "perpBankruptcy_clawbackUser": perpBankruptcy["clawback_user"],
-                "perpBankruptcy_clawbackUserPayment": (
-                    perpBankruptcy.get("clawback_user_payment", 0) or 0
-                )
-                / QUOTE_PRECISION,
-                "perpBankruptcy_cumulativeFundingRateDelta": (
-                    perpBankruptcy.get("cumulative_funding_rate_delta", 0) or 0
-                )
-                / PRICE_PRECISION,
-                "spotBankruptcy_marketIndex": spotBankruptcy["market_index"],
-                "spotBankruptcy_borrowAmount": (
-                    spotBankruptcy.get("borrow_amount", 0) or 0
-                )
-                / 10**spot_token_precision,
-                "spotBankruptcy_ifPayment": (spotBankruptcy.get("if_payment", 0) or 0)
-                / 10**spot_token_precision,
-                "spotBankruptcy_cumulativeDepositInterestDelta": (
-                    spotBankruptcy.get("cumulative_deposit_interest_delta", 0) or 0
-                )
-                / SPOT_CUMULATIVE_INTEREST_PRECISION,
             }
+        case "LiquidationRecord":
+            return parse_liquidation(raw_data, metadata, liquidation_layout, scale)
         case "LPRecord":
             return {
                 "ts": data["ts"],
@@ -383,13 +282,15 @@ def parse_event(event: anchorpy.Event, metadata: EventMetadata):
                 "slot": metadata["slot"],
                 "user": data["user"],
                 "action": to_camel_case(data.get("action", "")),
-                "nShares": (data["n_shares"] or 0) / AMM_RESERVE_PRECISION,
+                "nShares": scale(data["n_shares"] or 0, AMM_RESERVE_PRECISION),
                 "marketIndex": data["market_index"],
-                "deltaBaseAssetAmount": (data["delta_base_asset_amount"] or 0)
-                / BASE_PRECISION,
-                "deltaQuoteAssetAmount": (data["delta_quote_asset_amount"] or 0)
-                / QUOTE_PRECISION,
-                "pnl": (data["pnl"] or 0) / QUOTE_PRECISION,
+                "deltaBaseAssetAmount": scale(
+                    data["delta_base_asset_amount"] or 0, BASE_PRECISION
+                ),
+                "deltaQuoteAssetAmount": scale(
+                    data["delta_quote_asset_amount"] or 0, QUOTE_PRECISION
+                ),
+                "pnl": scale(data["pnl"] or 0, QUOTE_PRECISION),
             }
         case "FundingRateRecord":
             return {
@@ -398,24 +299,26 @@ def parse_event(event: anchorpy.Event, metadata: EventMetadata):
                 "recordId": data["record_id"],
                 "slot": metadata["slot"],
                 "marketIndex": data["market_index"],
-                "fundingRate": (data["funding_rate"] or 0) / 1e9,
-                "fundingRateLong": (data["funding_rate_long"] or 0) / 1e9,
-                "fundingRateShort": (data["funding_rate_short"] or 0) / 1e9,
-                "cumulativeFundingRateLong": (data["cumulative_funding_rate_long"] or 0)
-                / 1e9,
-                "cumulativeFundingRateShort": (
-                    data["cumulative_funding_rate_short"] or 0
-                )
-                / 1e9,
-                "oraclePriceTwap": (data["oracle_price_twap"] or 0) / PRICE_PRECISION,
-                "markPriceTwap": (data["mark_price_twap"] or 0) / PRICE_PRECISION,
-                "periodRevenue": (data["period_revenue"] or 0) / QUOTE_PRECISION,
-                "baseAssetAmountWithAmm": (data["base_asset_amount_with_amm"] or 0)
-                / BASE_PRECISION,
-                "baseAssetAmountWithUnsettledLp": (
-                    data["base_asset_amount_with_unsettled_lp"] or 0
-                )
-                / BASE_PRECISION,
+                "fundingRate": scale(data["funding_rate"] or 0, 1e9),
+                "fundingRateLong": scale(data["funding_rate_long"] or 0, 1e9),
+                "fundingRateShort": scale(data["funding_rate_short"] or 0, 1e9),
+                "cumulativeFundingRateLong": scale(
+                    data["cumulative_funding_rate_long"] or 0, 1e9
+                ),
+                "cumulativeFundingRateShort": scale(
+                    data["cumulative_funding_rate_short"] or 0, 1e9
+                ),
+                "oraclePriceTwap": scale(
+                    data["oracle_price_twap"] or 0, PRICE_PRECISION
+                ),
+                "markPriceTwap": scale(data["mark_price_twap"] or 0, PRICE_PRECISION),
+                "periodRevenue": scale(data["period_revenue"] or 0, QUOTE_PRECISION),
+                "baseAssetAmountWithAmm": scale(
+                    data["base_asset_amount_with_amm"] or 0, BASE_PRECISION
+                ),
+                "baseAssetAmountWithUnsettledLp": scale(
+                    data["base_asset_amount_with_unsettled_lp"] or 0, BASE_PRECISION
+                ),
             }
         case "FundingPaymentRecord":
             return {
@@ -425,12 +328,210 @@ def parse_event(event: anchorpy.Event, metadata: EventMetadata):
                 "userAuthority": data["user_authority"],
                 "user": data["user"],
                 "marketIndex": data["market_index"],
-                "fundingPayment": (data["funding_payment"] or 0) / QUOTE_PRECISION,
-                "baseAssetAmount": (data["base_asset_amount"] or 0) / BASE_PRECISION,
-                "userLastCumulativeFunding": (data["user_last_cumulative_funding"] or 0)
-                / FUNDING_RATE_PRECISION,
-                "ammCumulativeFundingLong": (data["amm_cumulative_funding_long"] or 0)
-                / FUNDING_RATE_PRECISION,
-                "ammCumulativeFundingShort": (data["amm_cumulative_funding_short"] or 0)
-                / FUNDING_RATE_PRECISION,
+                "fundingPayment": scale(data["funding_payment"] or 0, QUOTE_PRECISION),
+                "baseAssetAmount": scale(
+                    data["base_asset_amount"] or 0, BASE_PRECISION
+                ),
+                "userLastCumulativeFunding": scale(
+                    data["user_last_cumulative_funding"] or 0, FUNDING_RATE_PRECISION
+                ),
+                "ammCumulativeFundingLong": scale(
+                    data["amm_cumulative_funding_long"] or 0, FUNDING_RATE_PRECISION
+                ),
+                "ammCumulativeFundingShort": scale(
+                    data["amm_cumulative_funding_short"] or 0, FUNDING_RATE_PRECISION
+                ),
             }
+
+
+def spot_mint_precision(market_index):
+    from scripts.load_markets import SPOT_MARKETS
+
+    return next(
+        filter(lambda x: x.marketIndex == int(market_index), SPOT_MARKETS),
+        None,
+    ).mintPrecision
+
+
+def parse_liquidate_perp(raw_data, scale=to_float):
+    liquidatePerp = vars(raw_data.liquidate_perp)
+    return {
+        "liquidatePerp_marketIndex": liquidatePerp["market_index"],
+        "liquidatePerp_oraclePrice": scale(
+            liquidatePerp.get("oracle_price", 0) or 0, PRICE_PRECISION
+        ),
+        "liquidatePerp_baseAssetAmount": scale(
+            liquidatePerp.get("base_asset_amount", 0) or 0, BASE_PRECISION
+        ),
+        "liquidatePerp_quoteAssetAmount": scale(
+            liquidatePerp.get("quote_asset_amount", 0) or 0, QUOTE_PRECISION
+        ),
+        "liquidatePerp_lpShares": scale(
+            liquidatePerp.get("lp_shares", 0) or 0, AMM_RESERVE_PRECISION
+        ),
+        "liquidatePerp_fillRecordId": liquidatePerp["fill_record_id"],
+        "liquidatePerp_userOrderId": liquidatePerp["user_order_id"],
+        "liquidatePerp_liquidatorOrderId": liquidatePerp["liquidator_order_id"],
+        "liquidatePerp_liquidatorFee": scale(
+            liquidatePerp.get("liquidator_fee", 0) or 0, QUOTE_PRECISION
+        ),
+        "liquidatePerp_ifFee": scale(
+            liquidatePerp.get("if_fee", 0) or 0, QUOTE_PRECISION
+        ),
+    }
+
+
+def parse_liquidate_spot(raw_data, scale=to_float):
+    liquidateSpot = vars(raw_data.liquidate_spot)
+    # The asset transfer has always been scaled by the spot bankruptcy market,
+    # kept so both layouts agree
+    token_precision = spot_mint_precision(liquidateSpot["liability_market_index"])
+    spot_token_precision = spot_mint_precision(raw_data.spot_bankruptcy.market_index)
+    return {
+        "liquidateSpot_assetMarketIndex": liquidateSpot["asset_market_index"],
+        "liquidateSpot_assetPrice": scale(
+            liquidateSpot.get("asset_price", 0) or 0, PRICE_PRECISION
+        ),
+        "liquidateSpot_assetTransfer": scale(
+            liquidateSpot.get("asset_transfer", 0) or 0, 10**spot_token_precision
+        ),
+        "liquidateSpot_liabilityMarketIndex": liquidateSpot["liability_market_index"],
+        "liquidateSpot_liabilityPrice": scale(
+            liquidateSpot.get("liability_price", 0) or 0, PRICE_PRECISION
+        ),
+        "liquidateSpot_liabilityTransfer": scale(
+            liquidateSpot.get("liability_transfer", 0) or 0, 10**token_precision
+        ),
+        "liquidateSpot_ifFee": scale(liquidateSpot["if_fee"] or 0, 10**token_precision),
+    }
+
+
+def parse_liquidate_borrow_for_perp_pnl(raw_data, scale=to_float):
+    liquidateBorrowForPerpPnl = vars(raw_data.liquidate_borrow_for_perp_pnl)
+    return {
+        "liquidateBorrowForPerpPnl_perpMarketIndex": liquidateBorrowForPerpPnl[
+            "perp_market_index"
+        ],
+        "liquidateBorrowForPerpPnl_marketOraclePrice": scale(
+            liquidateBorrowForPerpPnl.get("market_oracle_price", 0) or 0,
+            PRICE_PRECISION,
+        ),
+        "liquidateBorrowForPerpPnl_pnlTransfer": scale(
+            liquidateBorrowForPerpPnl.get("pnl_transfer", 0) or 0, QUOTE_PRECISION
+        ),
+        "liquidateBorrowForPerpPnl_liabilityMarketIndex": liquidateBorrowForPerpPnl[
+            "liability_market_index"
+        ],
+        "liquidateBorrowForPerpPnl_liabilityPrice": scale(
+            liquidateBorrowForPerpPnl.get("liability_price", 0) or 0, PRICE_PRECISION
+        ),
+        "liquidateBorrowForPerpPnl_liabilityTransfer": scale(
+            liquidateBorrowForPerpPnl.get("liability_transfer", 0) or 0, QUOTE_PRECISION
+        ),
+    }
+
+
+def parse_liquidate_perp_pnl_for_deposit(raw_data, scale=to_float):
+    liquidatePerpPnlForDeposit = vars(raw_data.liquidate_perp_pnl_for_deposit)
+    return {
+        "liquidatePerpPnlForDeposit_perpMarketIndex": liquidatePerpPnlForDeposit[
+            "perp_market_index"
+        ],
+        "liquidatePerpPnlForDeposit_marketOraclePrice": scale(
+            liquidatePerpPnlForDeposit.get("market_oracle_price", 0) or 0,
+            PRICE_PRECISION,
+        ),
+        "liquidatePerpPnlForDeposit_pnlTransfer": scale(
+            liquidatePerpPnlForDeposit.get("pnl_transfer", 0) or 0, QUOTE_PRECISION
+        ),
+        "liquidatePerpPnlForDeposit_assetMarketIndex": liquidatePerpPnlForDeposit[
+            "asset_market_index"
+        ],
+        "liquidatePerpPnlForDeposit_assetPrice": scale(
+            liquidatePerpPnlForDeposit.get("asset_price", 0) or 0, PRICE_PRECISION
+        ),
+        "liquidatePerpPnlForDeposit_assetTransfer": scale(
+            liquidatePerpPnlForDeposit.get("asset_transfer", 0) or 0, BASE_PRECISION
+        ),
+    }
+
+
+def parse_perp_bankruptcy(raw_data, scale=to_float):
+    perpBankruptcy = vars(raw_data.perp_bankruptcy)
+    return {
+        "perpBankruptcy_marketIndex": perpBankruptcy["market_index"],
+        "perpBankruptcy_pnl": scale(perpBankruptcy.get("pnl", 0) or 0, QUOTE_PRECISION),
+        "perpBankruptcy_ifPayment": scale(
+            perpBankruptcy.get("if_payment", 0) or 0, QUOTE_PRECISION
+        ),
+        "perpBankruptcy_clawbackUser": perpBankruptcy["clawback_user"],
+        "perpBankruptcy_clawbackUserPayment": scale(
+            perpBankruptcy.get("clawback_user_payment", 0) or 0, QUOTE_PRECISION
+        ),
+        "perpBankruptcy_cumulativeFundingRateDelta": scale(
+            perpBankruptcy.get("cumulative_funding_rate_delta", 0) or 0, PRICE_PRECISION
+        ),
+    }
+
+
+def parse_spot_bankruptcy(raw_data, scale=to_float):
+    spotBankruptcy = vars(raw_data.spot_bankruptcy)
+    spot_token_precision = spot_mint_precision(spotBankruptcy["market_index"])
+    return {
+        "spotBankruptcy_marketIndex": spotBankruptcy["market_index"],
+        "spotBankruptcy_borrowAmount": scale(
+            spotBankruptcy.get("borrow_amount", 0) or 0, 10**spot_token_precision
+        ),
+        "spotBankruptcy_ifPayment": scale(
+            spotBankruptcy.get("if_payment", 0) or 0, 10**spot_token_precision
+        ),
+        "spotBankruptcy_cumulativeDepositInterestDelta": scale(
+            spotBankruptcy.get("cumulative_deposit_interest_delta", 0) or 0,
+            SPOT_CUMULATIVE_INTEREST_PRECISION,
+        ),
+    }
+
+
+# Column group of each liquidation type, in the order of the wide layout
+LIQUIDATION_PARSERS = {
+    "liquidatePerp": parse_liquidate_perp,
+    "liquidateSpot": parse_liquidate_spot,
+    "liquidateBorrowForPerpPnl": parse_liquidate_borrow_for_perp_pnl,
+    "liquidatePerpPnlForDeposit": parse_liquidate_perp_pnl_for_deposit,
+    "perpBankruptcy": parse_perp_bankruptcy,
+    "spotBankruptcy": parse_spot_bankruptcy,
+}
+LIQUIDATION_LAYOUTS = ["compact", "wide"]
+
+
+def parse_liquidation(
+    raw_data, metadata: EventMetadata, layout="compact", scale=to_float
+):
+    """Flatten a LiquidationRecord
+
+    The compact layout only has the columns of the record's liquidationType,
+    e.g. liquidatePerp_*, the others are left out rather than filled with the
+    zeroed sub-structs. The wide layout has all six column groups.
+    """
+    data = vars(raw_data)
+    liquidation_type = to_camel_case(data.get("liquidation_type", ""))
+    parsed = {
+        "ts": data["ts"],
+        "txSig": metadata["tx_sig"],
+        "slot": metadata["slot"],
+        "liquidationType": liquidation_type,
+        "user": data["user"],
+        "liquidator": data["liquidator"],
+        "marginRequirement": scale(data["margin_requirement"] or 0, QUOTE_PRECISION),
+        "totalCollateral": scale(data["total_collateral"] or 0, QUOTE_PRECISION),
+        "marginFreed": scale(data["margin_freed"] or 0, QUOTE_PRECISION),
+        "liquidationId": data["liquidation_id"],
+        "bankrupt": data["bankrupt"],
+        "canceledOrderIds": data["canceled_order_ids"],
+    }
+    if layout == "wide":
+        for parse_group in LIQUIDATION_PARSERS.values():
+            parsed.update(parse_group(raw_data, scale))
+    elif liquidation_type in LIQUIDATION_PARSERS:
+        parsed.update(LIQUIDATION_PARSERS[liquidation_type](raw_data, scale))
+    return parsed
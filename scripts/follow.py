@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import datetime as dt
+from dataclasses import dataclass, field
+from typing import Optional
+
+import pandas as pd
+import pyarrow as pa
+
+FOLLOW_STATE_DIR = "./out/follow"
+
+
+@dataclass
+class FollowState:
+    """Source files already consumed for one day while following"""
+
+    date: dt.date
+    events_files: set = field(default_factory=set)
+    txns_files: set = field(default_factory=set)
+    # Events rows whose transaction logs have not shown up yet, kept in memory
+    # only. Rows lost on a restart are picked up when the day is finalized.
+    pending: Optional[pa.Table] = None
+
+    @property
+    def path(self):
+        return os.path.join(FOLLOW_STATE_DIR, self.date.strftime("%Y%m%d") + ".json")
+
+    @classmethod
+    def load(cls, date):
+        state = cls(date)
+        try:
+            with open(state.path, "r") as file:
+                saved = json.load(file)
+            state.events_files = set(saved["events_files"])
+            state.txns_files = set(saved["txns_files"])
+        except FileNotFoundError:
+            pass
+        return state
+
+    def save(self):
+        os.makedirs(FOLLOW_STATE_DIR, exist_ok=True)
+        with open(self.path, "w") as file:
+            json.dump(
+                {
+                    "events_files": sorted(self.events_files),
+                    "txns_files": sorted(self.txns_files),
+                },
+                file,
+            )
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def row_keys(df, columns):
+    """The csv text of every row's columns
+
+    Rows read back from an object and rows still in memory can hold the same
+    values in different dtypes, e.g. ints parsed from text against strings or
+    categoricals, or NaN against None. They are written alike, so their text is
+    the same.
+    """
+    if len(df) == 0:
+        return pd.Series([], index=df.index, dtype=object)
+    text = df[columns].to_csv(index=False, header=False, lineterminator="\n")
+    return pd.Series(text.splitlines(), index=df.index)
+
+
+class OutputMerger:
+    """Merges objects written while following into the day's existing objects
+
+    Writes are buffered per object and only merged and uploaded on flush, so each
+    object is rewritten at most once per flush interval however many polls touch
+    it. The existing object is read back from the sink on every flush rather than
+    kept, and merged rows are deduplicated on the csv text of the same keys as the
+    batch writer.
+    """
+
+    def __init__(self, read_csv, put_csv):
+        self.read_csv = read_csv
+        self.put_csv = put_csv
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def add(self, object_path, df, dedup_subset, sort_by=None):
+        with self.lock:
+            if object_path not in self.pending:
+                self.pending[object_path] = ([], dedup_subset, sort_by)
+            self.pending[object_path][0].append(df)
+
+    def flush(self):
+        """Merge and write every object added since the last flush
+
+        The writes must be durable before the next flush reads the objects back.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        for object_path, (dfs, dedup_subset, sort_by) in pending.items():
+            existing = self.read_csv(object_path)
+            if existing is not None:
+                dfs = [existing] + dfs
+            keys = pd.concat(
+                [row_keys(df, dedup_subset) for df in dfs], ignore_index=True
+            )
+            merged = pd.concat(dfs, ignore_index=True)[~keys.duplicated().to_numpy()]
+            if sort_by is not None:
+                merged = merged.sort_values(sort_by, kind="stable")
+            self.put_csv(object_path, merged)
+
+        return len(pending)
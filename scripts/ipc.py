@@ -0,0 +1,29 @@
+import os
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Partitions handed to worker processes are written here as Arrow IPC files and
+# memory-mapped by the workers, so nothing is pickled across the pool boundary
+SHARED_MEMORY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def ipc_dir(directory=SHARED_MEMORY_DIR):
+    return tempfile.TemporaryDirectory(prefix="archiver-", dir=directory)
+
+
+def write_ipc(table: pa.Table, path):
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return path
+
+
+def read_ipc(path) -> pa.Table:
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+def filter_isin(table: pa.Table, column, values) -> pa.Table:
+    if not isinstance(values, pa.Array):
+        values = pa.array(values)
+    return table.filter(pc.is_in(table[column], value_set=values))
@@ -98,3 +98,9 @@ async def initialize_state():
     PERP_MARKETS, SPOT_MARKETS = await load_markets()
     PERP_MARKETS.sort(key=lambda x: x.marketIndex)
     SPOT_MARKETS.sort(key=lambda x: x.marketIndex)
+
+
+def set_markets(perp_markets, spot_markets):
+    """Install already loaded markets, used to initialize worker processes"""
+    global PERP_MARKETS, SPOT_MARKETS
+    PERP_MARKETS, SPOT_MARKETS = perp_markets, spot_markets
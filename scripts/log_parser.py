@@ -1,7 +1,12 @@
+import asyncio
+import functools
 import traceback
+import types
 import time
 import datetime as dt
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 
 from anchorpy import Provider, Wallet
 from solders.keypair import Keypair  # type: ignore
@@ -11,6 +16,9 @@ from tqdm import tqdm
 from driftpy.constants.config import DRIFT_PROGRAM_ID
 from driftpy.events.parse import parse_logs
 
+from scripts.ipc import filter_isin
+from scripts.memory import decoded_estimate
+
 IDL_URL = "https://raw.githubusercontent.com/drift-labs/protocol-v2/944ad4e560ad3d2f6506b758e6c79bbd580b56b7/sdk/src/idl/drift.json"
 
 KP = Keypair()  # random wallet
@@ -19,53 +27,188 @@ CONNECTION = AsyncClient("https://api.mainnet-beta.solana.com")
 PROVIDER = Provider(CONNECTION, WALLET)
 CLIENT = drift_client.DriftClient(CONNECTION, WALLET)
 
-async def get_logs_from_topledger(sigs, read_credentials, files):
-    def parse_logs_wrapper(program, logs):
-        try:
-            return parse_logs(program, logs)
-        except Exception as e:
-            error_message = (
-                f"An error occurred with txSig: {sig} and {corresponding_logs}: {e}"
-            )
-            print(traceback.format_exc())
-            return []
 
+class SelectedEventCoder:
+    """Event coder that only decodes the selected event types
+
+    Events of other types are recognized by their 8 byte discriminator and
+    skipped without being deserialized.
+    """
+
+    def __init__(self, coder, event_names):
+        self.coder = coder
+        self.discriminators = {
+            discriminator
+            for discriminator, name in coder.discriminators.items()
+            if name in event_names
+        }
+
+    def parse(self, data):
+        if data[:8] not in self.discriminators:
+            return None
+        return self.coder.parse(data)
+
+
+@functools.lru_cache(maxsize=None)
+def selected_program(event_names):
+    """Stand-in for CLIENT.program in parse_logs decoding only event_names, a frozenset"""
+    coder = SelectedEventCoder(CLIENT.program.coder.events, event_names)
+    return types.SimpleNamespace(coder=types.SimpleNamespace(events=coder))
+
+
+def program_for(event_names=None):
+    if event_names is None:
+        return CLIENT.program
+    return selected_program(frozenset(event_names))
+
+
+def parse_logs_wrapper(program, logs):
+    try:
+        return parse_logs(program, logs)
+    except Exception as e:
+        print(f"An error occurred parsing logs {logs}: {e}")
+        print(traceback.format_exc())
+        return []
+
+
+TXNS_LOG_COLUMNS = ["signatures", "log_messages"]
+# Partition rows whose events are decoded at once on the thread path
+DECODE_BATCH_ROWS = 32 * 1024
+RAW_LOGS_SCHEMA = pa.schema(
+    [("signatures", pa.string()), ("log_messages", pa.list_(pa.string()))]
+)
+
+
+def filter_logs(logs, sigs):
+    signatures = pc.list_element(logs["signatures"], 0)
+    logs = pa.table(
+        [signatures, logs["log_messages"]], names=["signatures", "log_messages"]
+    )
+    return logs.filter(pc.is_in(signatures, value_set=sigs)).cast(RAW_LOGS_SCHEMA)
+
+
+async def fetch_raw_logs(
+    sigs, source, files, holding=None, slots=None, slot_index=None, fallback=None
+):
+    """Read the day's txns files from source into one Arrow table, keeping only sigs
+
+    With a memory Holding, reads wait while the budget is exhausted and each
+    file's logs are kept in it, spilled to disk if they do not fit. With the
+    slots of the wanted transactions and a SlotIndex, only the row groups whose
+    slot range holds one of them are read. With a fallback RpcLogFetcher, the
+    logs of sigs missing from every file are fetched from it and appended.
+    """
+    sigs = pa.array(list(set(sigs)), pa.string())
+    if slots is not None:
+        slots = np.sort(np.asarray(slots))
+
+    async def fetch_logs(file):
+        if holding is not None:
+            await holding.governor.wait_for_room()
+        if slots is None or slot_index is None:
+            logs = await source.read_table(file, columns=TXNS_LOG_COLUMNS)
+        else:
+            logs = await slot_index.read(source, file, slots, TXNS_LOG_COLUMNS)
+            if logs is None:
+                return RAW_LOGS_SCHEMA.empty_table()
+        logs = await asyncio.to_thread(filter_logs, logs, sigs)
+        if holding is None:
+            return logs
+        return await asyncio.to_thread(holding.keep, logs)
+
+    all_logs = list(await asyncio.gather(*(fetch_logs(file) for file in files)))
+    if fallback is not None:
+        all_logs.append(await fetch_missing_logs(sigs, all_logs, fallback, holding))
+    if len(all_logs) == 0:
+        return RAW_LOGS_SCHEMA.empty_table()
+    return pa.concat_tables(all_logs)
+
+
+async def fetch_missing_logs(sigs, all_logs, fallback, holding=None):
+    """Logs of the sigs none of all_logs holds, fetched through fallback"""
+    found = pa.chunked_array([logs["signatures"] for logs in all_logs], pa.string())
+    missing = sigs.filter(pc.invert(pc.is_in(sigs, value_set=found.combine_chunks())))
+    if len(missing) == 0:
+        return RAW_LOGS_SCHEMA.empty_table()
     start = time.time()
-
-    def fetch_and_parse_logs(file):
-        logs = pd.read_parquet(
-            f"s3://drift-topledger/{file}",
-            storage_options={
-                "key": read_credentials["access_key"],
-                "secret": read_credentials["secret_key"],
-            },
-        )
-        logs["signatures"] = logs["signatures"].str[0]
-
-        filtered_logs = logs[logs["signatures"].isin(sigs)]
-
-        filtered_logs["parsed_logs"] = filtered_logs["log_messages"].apply(
-            lambda x: parse_logs_wrapper(CLIENT.program, x)
+    fetched = await fallback.fetch(missing.to_pylist())
+    print(
+        f"fetched logs of {len(fetched)} of {len(missing)} missing signatures "
+        f"over rpc in: {time.time() - start}s"
+    )
+    logs = pa.table(
+        [list(fetched.keys()), list(fetched.values())], schema=RAW_LOGS_SCHEMA
+    )
+    if holding is None:
+        return logs
+    return await asyncio.to_thread(holding.keep, logs)
+
+
+def decode_events(signatures, log_messages, event_name):
+    """Decode raw log messages into {sig: [events]} keeping only event_name
+
+    A signature with several rows of logs gets the events of its last one.
+    """
+    program = program_for([event_name])
+    decoded = {}
+    for sig, messages in zip(signatures, log_messages):
+        events = [
+            event
+            for event in parse_logs_wrapper(program, messages)
+            if event.name == event_name
+        ]
+        if len(events) > 0:
+            decoded[sig] = events
+    return decoded
+
+
+class BatchedEvents:
+    """{tx_id: [events]} of a partition, decoded a batch of rows at a time
+
+    Stands in for the dict processors read with get(tx_id, default), which they
+    do in row order. Only the events of the current batch_rows rows are held,
+    under a reservation of governor released when the next batch is decoded or
+    on close(). A batch that cannot fit even when nothing else is reserved
+    raises MemoryBudgetExceeded.
+    """
+
+    def __init__(
+        self, records, raw_logs, event_name, governor, batch_rows=DECODE_BATCH_ROWS
+    ):
+        self.records = records
+        self.raw_logs = raw_logs
+        self.event_name = event_name
+        self.governor = governor
+        self.batch_rows = batch_rows
+        self.next_row = 0
+        self.tx_ids = set()
+        self.events = {}
+        self.reserved = None
+
+    def get(self, tx_id, default=None):
+        while tx_id not in self.tx_ids and self.next_row < self.records.num_rows:
+            self._decode_next_batch()
+        return self.events.get(tx_id, default)
+
+    def _decode_next_batch(self):
+        self.close()
+        batch = self.records.slice(self.next_row, self.batch_rows)
+        self.next_row += batch.num_rows
+        tx_ids = pc.unique(batch["tx_id"])
+        logs = filter_isin(self.raw_logs, "signatures", tx_ids)
+        self.reserved = decoded_estimate(logs.nbytes)
+        self.governor.acquire(self.reserved)
+        self.tx_ids = set(tx_ids.to_pylist())
+        self.events = decode_events(
+            logs["signatures"].to_pylist(),
+            logs["log_messages"].to_pylist(),
+            self.event_name,
         )
 
-        return filtered_logs
-
-    all_logs = [fetch_and_parse_logs(file) for file in files]
-
-    filtered_logs = pd.concat(all_logs)
-
-    logs_dict = filtered_logs.set_index("signatures")["parsed_logs"].to_dict()
-
-    print(f"fetched & parsed logs from topledger in: {time.time() - start}s")
-
-    parsed_logs = {}
-
-    for sig in sigs:
-        corresponding_logs = logs_dict.get(sig, None)
-        if corresponding_logs is None:
-            print(f"Logs not found for signature: {sig}")
-            continue
-        for event in corresponding_logs:
-            parsed_logs.setdefault(sig, []).append(event)
-
-    return parsed_logs
+    def close(self):
+        """Drop the current batch and release its reservation"""
+        self.tx_ids = set()
+        self.events = {}
+        if self.reserved is not None:
+            self.governor.release(self.reserved)
+            self.reserved = None
@@ -0,0 +1,229 @@
+import asyncio
+import os
+import resource
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pyarrow as pa
+
+from scripts.ipc import read_ipc, write_ipc
+
+# Tables that do not fit in the budget are written here and memory-mapped, the
+# page cache can then drop their pages under pressure instead of the OOM killer
+# dropping the process
+MEMORY_SPILL_DIR = "./out/spill"
+# Decoded events as Python objects take about this many times the bytes of the
+# raw log messages they were decoded from
+DECODE_EXPANSION = 8
+# The row dicts processors parse from them and keep in KeyedEvents until they
+# are written, again relative to the raw log messages
+PARSE_EXPANSION = 4
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """A reservation that cannot fit in the budget, even once all others end"""
+
+
+def decoded_estimate(log_bytes):
+    """Bytes needed to decode log_bytes of raw logs and process the events"""
+    return log_bytes * (DECODE_EXPANSION + PARSE_EXPANSION)
+
+
+def default_memory_budget():
+    """Half of the physical memory"""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+
+
+class MemoryGovernor:
+    """Approximate byte budget shared by the stages of a run
+
+    Stages about to allocate reserve an estimate first and block while it does
+    not fit. A reservation that does not fit once no other one is out never will,
+    it raises MemoryBudgetExceeded instead of running over the budget. Tables
+    kept across stages are charged through a Holding, or spilled to disk when
+    they do not fit.
+    """
+
+    def __init__(self, limit, spill_dir=MEMORY_SPILL_DIR):
+        self.limit = limit
+        self.spill_dir = spill_dir
+        self.used = 0
+        self.peak = 0
+        self.spilled = 0
+        # Reservations out, kept tables are charged to used but never waited on
+        self.reservations = 0
+        self.condition = threading.Condition()
+        # Futures of coroutines waiting for room, woken on their own loops
+        self.waiters = []
+
+    def _fits(self, size):
+        if self.used + size <= self.limit:
+            return True
+        if self.reservations == 0:
+            # Nothing will be released before the kept tables' scope ends
+            raise MemoryBudgetExceeded(
+                "Reserving {:.0f} MiB with {:.0f} MiB in use exceeds the memory "
+                "budget of {:.0f} MiB".format(
+                    size / 2**20, self.used / 2**20, self.limit / 2**20
+                )
+            )
+        return False
+
+    def _room(self):
+        return self.reservations == 0 or self.used < self.limit
+
+    def _charge(self, size):
+        self.used += size
+        self.peak = max(self.peak, self.used)
+
+    def acquire(self, size):
+        with self.condition:
+            while not self._fits(size):
+                self.condition.wait()
+            self._charge(size)
+            self.reservations += 1
+
+    async def acquire_async(self, size):
+        while True:
+            with self.condition:
+                if self._fits(size):
+                    self._charge(size)
+                    self.reservations += 1
+                    return
+                waiter = self._waiter()
+            await waiter
+
+    async def wait_for_room(self):
+        """Block a read until the budget is no longer exhausted"""
+        while True:
+            with self.condition:
+                if self._room():
+                    return
+                waiter = self._waiter()
+            await waiter
+
+    def _waiter(self):
+        # Called with the condition held, woken by the next release
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        return waiter
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.reservations -= 1
+            self._notify()
+
+    def _notify(self):
+        self.condition.notify_all()
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+
+    @contextmanager
+    def holding(self):
+        """Scope of tables kept across stages, see Holding.keep()"""
+        holding = Holding(self)
+        try:
+            yield holding
+        finally:
+            holding.close()
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Holding:
+    """Tables and reservations kept for the length of one scope, typically a day
+
+    Everything is released and the spill files removed when the scope ends, the
+    tables must not be used after that.
+    """
+
+    def __init__(self, governor):
+        self.governor = governor
+        self.kept = 0
+        self.reserved = []
+        self.directory = None
+        self.spill_files = 0
+
+    @property
+    def spilled(self):
+        return self.directory is not None
+
+    def acquire(self, size):
+        """Reserve size for the rest of the scope, blocking until it fits"""
+        self.governor.acquire(size)
+        with self.governor.condition:
+            self.reserved.append(size)
+
+    async def acquire_async(self, size):
+        await self.governor.acquire_async(size)
+        with self.governor.condition:
+            self.reserved.append(size)
+
+    def keep(self, table):
+        """Charge table to the budget, or spill it and return the mapped copy
+
+        A slice, whose buffers hold notably more than its own rows, is copied
+        first. Its parent's buffers could not be freed by spilling it while any
+        other slice of the parent is alive.
+        """
+        if table.get_total_buffer_size() - table.nbytes > table.nbytes // 8:
+            table = table.take(pa.array(np.arange(table.num_rows)))
+        size = table.nbytes
+        governor = self.governor
+        with governor.condition:
+            if governor.used + size <= governor.limit:
+                governor._charge(size)
+                self.kept += size
+                return table
+            governor.spilled += size
+            if self.directory is None:
+                os.makedirs(governor.spill_dir, exist_ok=True)
+                self.directory = tempfile.mkdtemp(dir=governor.spill_dir)
+            path = os.path.join(self.directory, f"{self.spill_files}.arrow")
+            self.spill_files += 1
+        # The spilled table's own buffers are freed once the caller drops it
+        return read_ipc(write_ipc(table, path))
+
+    def close(self):
+        governor = self.governor
+        with governor.condition:
+            governor.used -= self.kept + sum(self.reserved)
+            governor.reservations -= len(self.reserved)
+            governor._notify()
+        self.kept = 0
+        self.reserved = []
+        if self.directory is not None:
+            # Mapped files stay readable until unmapped, unlinking is safe
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+def peak_rss():
+    """Peak resident set size of this process and of its reaped children, in bytes"""
+    # ru_maxrss is in KiB on Linux
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    )
+
+
+def format_memory_report(governor):
+    own, children = peak_rss()
+    return (
+        "Peak RSS {:.0f} MiB, largest worker {:.0f} MiB, peak budgeted {:.0f} of "
+        "{:.0f} MiB, spilled {:.0f} MiB".format(
+            own / 2**20,
+            children / 2**20,
+            governor.peak / 2**20,
+            governor.limit / 2**20,
+            governor.spilled / 2**20,
+        )
+    )
@@ -0,0 +1,75 @@
+import numpy as np
+import pyarrow as pa
+
+# Rows the merge takes from the leading run per step, bounding each batch
+MERGE_BLOCK_ROWS = 16 * 1024
+
+
+def merge_runs(run_keys, block_rows=MERGE_BLOCK_ROWS):
+    """k-way merge of sorted runs, yields the (run, start, end) ranges of a batch
+
+    run_keys are the sorted keys of every run. Every step takes the rows up to
+    the smallest key a run reaches within its next block_rows, from all runs, so
+    the rows of one key always come in the same batch.
+    """
+    positions = [0] * len(run_keys)
+    while True:
+        live = [i for i in range(len(run_keys)) if positions[i] < len(run_keys[i])]
+        if len(live) == 0:
+            return
+        bound = min(
+            run_keys[i][min(positions[i] + block_rows, len(run_keys[i])) - 1]
+            for i in live
+        )
+        ranges = []
+        for i in live:
+            end = int(np.searchsorted(run_keys[i], bound, side="right"))
+            if end > positions[i]:
+                ranges.append((i, positions[i], end))
+            positions[i] = end
+        yield ranges
+
+
+def null_dtypes(runs):
+    """{column: dtype} of the integer and boolean columns holding nulls
+
+    Converted whole, such columns become float and object columns. Batches
+    without nulls are cast to the same dtypes so they serialize and hash alike.
+    """
+    dtypes: dict[str, np.dtype] = {}
+    for field in runs[0].schema:
+        if sum(run[field.name].null_count for run in runs) == 0:
+            continue
+        if pa.types.is_integer(field.type):
+            dtypes[field.name] = np.dtype("float64")
+        elif pa.types.is_boolean(field.type):
+            dtypes[field.name] = np.dtype("object")
+    return dtypes
+
+
+def merged_frames(runs, key, dedup_subset):
+    """The rows of runs sorted by key and de-duplicated, as a stream of DataFrames
+
+    runs are tables of one schema, each sorted by key, e.g. the memory-mapped
+    runs of a KeyedEvents. Equivalent to converting their concatenation,
+    dropping duplicates of dedup_subset (which must include key) and stably
+    sorting by key, but only one batch is converted at a time. Returns a
+    function starting the stream.
+    """
+    runs = [run for run in runs if run.num_rows > 0]
+    run_keys = [run[key].to_numpy() for run in runs]
+    dtypes = null_dtypes(runs) if len(runs) > 0 else {}
+
+    def frames():
+        for ranges in merge_runs(run_keys):
+            batch = pa.concat_tables(
+                [runs[i].slice(start, end - start) for i, start, end in ranges]
+            )
+            keys = np.concatenate([run_keys[i][start:end] for i, start, end in ranges])
+            # Stable, rows of equal keys stay in run order
+            order = np.argsort(keys, kind="stable")
+            df = batch.take(pa.array(order)).to_pandas()
+            df = df.astype({c: t for c, t in dtypes.items() if df[c].dtype != t})
+            yield df.drop_duplicates(subset=dedup_subset)
+
+    return frames
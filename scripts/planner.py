@@ -0,0 +1,102 @@
+import datetime as dt
+from dataclasses import dataclass, field
+from typing import List
+
+# S3 standard GET price in USD per 1000 requests, for dry-run estimates
+S3_GET_COST_PER_1000 = 0.0004
+# Rough source bytes one node reads, decodes and writes per second, to turn a
+# plan's size into a duration. Replace with a measured figure for real planning
+ESTIMATED_SOURCE_BYTES_PER_SECOND = 20 * 1024 * 1024
+
+
+@dataclass
+class DayPlan:
+    """The event types left to process for one date and the files they need"""
+
+    date: dt.date
+    event_types: List[str]
+    events_files: List[str] = field(default_factory=list)
+    txns_files: List[str] = field(default_factory=list)
+    size: int = 0  # bytes of the date's source files
+
+    @property
+    def files(self):
+        return len(self.events_files) + len(self.txns_files)
+
+
+def plan_backfill(events_objects, txns_objects, event_types, checkpoints=None):
+    """The dates to process and what to process on each, in date order
+
+    events_objects and txns_objects map dates to their listed {"Key", "Size"}
+    objects. checkpoints maps event types to the last date they were processed
+    for, those event types are left out of earlier dates and dates with nothing
+    left are dropped. Dates missing their events or txns files are skipped.
+
+    Dates stay in order because ./out checkpoints only hold the last processed
+    date, sharded runs schedule their units largest first from the sizes.
+    """
+    checkpoints = checkpoints or {}
+    plan = []
+    for date in sorted(set(events_objects) | set(txns_objects)):
+        if date not in events_objects or date not in txns_objects:
+            print(f"Skipping {date}, events or txns files are missing")
+            continue
+        todo = [
+            event
+            for event in event_types
+            if checkpoints.get(event) is None or date > checkpoints[event]
+        ]
+        if len(todo) == 0:
+            print(f"Skipping {date}, already processed")
+            continue
+        objects = events_objects[date] + txns_objects[date]
+        plan.append(
+            DayPlan(
+                date,
+                todo,
+                [obj["Key"] for obj in events_objects[date]],
+                [obj["Key"] for obj in txns_objects[date]],
+                sum(obj["Size"] for obj in objects),
+            )
+        )
+    return plan
+
+
+def estimate_cost(plan):
+    """Source files, bytes, S3 GET cost and a rough duration of a plan"""
+    files = sum(day.files for day in plan)
+    size = sum(day.size for day in plan)
+    return {
+        "days": len(plan),
+        "files": files,
+        "bytes": size,
+        "get_cost_usd": files * S3_GET_COST_PER_1000 / 1000,
+        "seconds": size / ESTIMATED_SOURCE_BYTES_PER_SECOND,
+    }
+
+
+def format_plan(plan, all_event_types):
+    """One line per date and a total line with the cost estimate"""
+    lines = []
+    for day in plan:
+        if len(day.event_types) == len(all_event_types):
+            event_types = "all event types"
+        else:
+            event_types = ", ".join(day.event_types)
+        lines.append(
+            "{}: {} files, {:.1f} MiB, {}".format(
+                day.date, day.files, day.size / 2**20, event_types
+            )
+        )
+    cost = estimate_cost(plan)
+    lines.append(
+        "Total: {} days, {} files, {:.1f} MiB, ${:.4f} in GET requests, "
+        "about {} at one node".format(
+            cost["days"],
+            cost["files"],
+            cost["bytes"] / 2**20,
+            cost["get_cost_usd"],
+            dt.timedelta(seconds=round(cost["seconds"])),
+        )
+    )
+    return "\n".join(lines)
@@ -0,0 +1,110 @@
+import pandas as pd
+
+# Rollup column -> the fills column it aggregates, rollups of fixed-point fills
+# keep that column's exponent
+ROLLUP_SOURCES = {
+    "oracleOpen": "oraclePrice",
+    "oracleHigh": "oraclePrice",
+    "oracleLow": "oraclePrice",
+    "oracleClose": "oraclePrice",
+    "baseVolume": "baseAssetAmountFilled",
+    "quoteVolume": "quoteAssetAmountFilled",
+    "takerFees": "takerFee",
+    "makerRebates": "makerRebate",
+    "fillerRewards": "fillerReward",
+}
+# Fills columns the rollups are computed from
+ROLLUP_COLUMNS = [
+    "ts",
+    "fillRecordId",
+    "oraclePrice",
+    "baseAssetAmountFilled",
+    "quoteAssetAmountFilled",
+    "takerFee",
+    "makerRebate",
+    "fillerReward",
+]
+# Candle record type -> bucket width in seconds
+ROLLUP_INTERVALS = {
+    "candles1m": 60,
+    "candles1h": 60 * 60,
+    "candles1d": 24 * 60 * 60,
+}
+
+
+def market_rollups(fills: pd.DataFrame):
+    """Candles and volume/fee totals per interval from one market's fills
+
+    fills are the market's de-duplicated fills sorted by fillRecordId, opens and
+    closes follow that order. Returns {record type: frame} with one row per
+    bucket, ts being the bucket start. Fill prices are floats either way.
+    """
+    exponents = fills.attrs.get("exponents", {})
+    fill_price = fills["quoteAssetAmountFilled"] / fills["baseAssetAmountFilled"]
+    shift = exponents.get("baseAssetAmountFilled", 0) - exponents.get(
+        "quoteAssetAmountFilled", 0
+    )
+    if shift != 0:
+        fill_price = fill_price * 10**shift
+    fills = fills.assign(fillPrice=fill_price)
+    rollups = {}
+    for record_type, seconds in ROLLUP_INTERVALS.items():
+        bucket = (fills["ts"] // seconds * seconds).rename("ts")
+        rollups[record_type] = (
+            fills.groupby(bucket, sort=True)
+            .agg(
+                oracleOpen=("oraclePrice", "first"),
+                oracleHigh=("oraclePrice", "max"),
+                oracleLow=("oraclePrice", "min"),
+                oracleClose=("oraclePrice", "last"),
+                fillOpen=("fillPrice", "first"),
+                fillHigh=("fillPrice", "max"),
+                fillLow=("fillPrice", "min"),
+                fillClose=("fillPrice", "last"),
+                baseVolume=("baseAssetAmountFilled", "sum"),
+                quoteVolume=("quoteAssetAmountFilled", "sum"),
+                takerFees=("takerFee", "sum"),
+                makerRebates=("makerRebate", "sum"),
+                fillerRewards=("fillerReward", "sum"),
+                fills=("fillRecordId", "size"),
+            )
+            .reset_index()
+        )
+        if len(exponents) > 0:
+            rollups[record_type].attrs["exponents"] = {
+                column: exponents[source]
+                for column, source in ROLLUP_SOURCES.items()
+                if source in exponents
+            }
+    return rollups
+
+
+def combine_with(column):
+    """How a rollup column of consecutive batches of fills combines"""
+    if column.endswith("Open"):
+        return "first"
+    if column.endswith("High"):
+        return "max"
+    if column.endswith("Low"):
+        return "min"
+    if column.endswith("Close"):
+        return "last"
+    return "sum"
+
+
+def merge_rollups(parts):
+    """market_rollups of consecutive batches of fills, combined into those of all
+
+    parts are the market_rollups() of every batch, in fill order.
+    """
+    rollups = {}
+    for record_type in ROLLUP_INTERVALS:
+        frames = [part[record_type] for part in parts]
+        combined = pd.concat(frames, ignore_index=True)
+        rollups[record_type] = (
+            combined.groupby("ts", sort=True)
+            .agg({column: combine_with(column) for column in combined.columns[1:]})
+            .reset_index()
+        )
+        rollups[record_type].attrs = frames[0].attrs
+    return rollups
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+
+import aiohttp
+
+from scripts.utils import chunks
+
+RPC_CACHE_PATH = "./out/rpc_logs.sqlite"
+# getTransaction calls per JSON-RPC batch request
+RPC_BATCH_SIZE = 100
+# Batch requests in flight at once, also the size of the connection pool
+RPC_CONCURRENCY = 4
+RPC_RETRIES = 5
+# Seconds before the first retry, doubled for every further one
+RPC_RETRY_DELAY = 1
+RPC_TIMEOUT = 60
+
+
+class RpcLogCache:
+    """Log messages of transactions fetched over RPC, cached in sqlite
+
+    Only transactions the node returned are kept, their logs never change once
+    finalized. Signatures it did not know are asked for again on the next run.
+    """
+
+    def __init__(self, path=RPC_CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS logs "
+                "(signature TEXT PRIMARY KEY, log_messages TEXT)"
+            )
+
+    def get(self, signatures):
+        """{signature: log messages} of the cached signatures"""
+        logs = {}
+        with self.lock:
+            for batch in chunks(signatures, 500):
+                rows = self.db.execute(
+                    "SELECT signature, log_messages FROM logs WHERE signature IN "
+                    f"({', '.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                logs.update((sig, json.loads(messages)) for sig, messages in rows)
+        return logs
+
+    def record(self, logs):
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO logs VALUES (?, ?)",
+                [(sig, json.dumps(messages)) for sig, messages in logs.items()],
+            )
+
+
+def get_transaction_request(request_id, signature):
+    return {
+        "jsonrpc": "2.0",
+        "id": request_id,
+        "method": "getTransaction",
+        "params": [
+            signature,
+            {
+                "encoding": "json",
+                "commitment": "finalized",
+                "maxSupportedTransactionVersion": 0,
+            },
+        ],
+    }
+
+
+class RpcLogFetcher:
+    """Log messages of transactions topledger does not have, from an RPC node
+
+    Signatures are sent as batches of getTransaction calls, a bounded number of
+    batches at a time over one pooled session. Batches failing as a whole, calls
+    answered with an error and calls missing from a reply are retried with
+    backoff, those still failing after RPC_RETRIES attempts are reported and
+    kept in failed.
+    """
+
+    def __init__(
+        self,
+        url,
+        cache=None,
+        batch_size=RPC_BATCH_SIZE,
+        concurrency=RPC_CONCURRENCY,
+    ):
+        self.url = url
+        self.cache = cache
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        # Signatures the last fetch() could not get an answer for
+        self.failed = set()
+
+    async def fetch(self, signatures):
+        """{signature: log messages} of the signatures the node returned"""
+        signatures = list(dict.fromkeys(signatures))
+        self.failed = set()
+        logs = {} if self.cache is None else self.cache.get(signatures)
+        wanted = [sig for sig in signatures if sig not in logs]
+        if len(wanted) == 0:
+            return logs
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=RPC_TIMEOUT),
+        ) as session:
+            fetched = await asyncio.gather(
+                *(
+                    self._fetch_batch(session, semaphore, batch)
+                    for batch in chunks(wanted, self.batch_size)
+                )
+            )
+        for batch_logs in fetched:
+            if self.cache is not None:
+                self.cache.record(batch_logs)
+            logs.update(batch_logs)
+        return logs
+
+    async def _fetch_batch(self, session, semaphore, signatures):
+        logs = {}
+        error = None
+        without_logs = 0
+        for attempt in range(RPC_RETRIES):
+            if attempt > 0:
+                await asyncio.sleep(RPC_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                async with semaphore:
+                    replies = await self._post(session, signatures)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+                continue
+            retry = []
+            # Signatures whose call is missing from the reply are asked again
+            missing = dict.fromkeys(signatures)
+            for reply in replies:
+                request_id = reply.get("id")
+                if not isinstance(request_id, int) or not (
+                    0 <= request_id < len(signatures)
+                ):
+                    continue
+                sig = signatures[request_id]
+                missing.pop(sig, None)
+                if "error" in reply:
+                    error = reply["error"]
+                    retry.append(sig)
+                    continue
+                result = reply.get("result")
+                if result is None or result.get("meta") is None:
+                    # Not a transaction the node knows
+                    continue
+                messages = result["meta"].get("logMessages")
+                if messages is None:
+                    # Recorded without logs, nothing to decode or cache
+                    without_logs += 1
+                    continue
+                logs[sig] = messages
+            if len(missing) > 0:
+                error = f"{len(missing)} calls missing from the reply"
+            signatures = retry + list(missing)
+            if len(signatures) == 0:
+                break
+        if without_logs > 0:
+            print(
+                f"getTransaction returned no log messages for {without_logs} signatures"
+            )
+        if len(signatures) > 0:
+            print(f"getTransaction failed for {len(signatures)} signatures: {error}")
+            self.failed.update(signatures)
+        return logs
+
+    async def _post(self, session, signatures):
+        payload = [get_transaction_request(i, sig) for i, sig in enumerate(signatures)]
+        async with session.post(self.url, json=payload) as response:
+            response.raise_for_status()
+            replies = await response.json(content_type=None)
+        if not isinstance(replies, list):
+            # A single error object, e.g. from a node that rejects batches
+            raise ValueError(f"Unexpected batch reply: {replies}")
+        return replies
@@ -0,0 +1,170 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+import argparse
+import datetime as dt
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+LEASE_PREFIX = "archiver/leases"
+LEASE_TTL_SECONDS = 15 * 60
+# How long a claimer waits before reading its claim back. S3 has no compare and
+# swap, so two nodes racing for the same lease both write and the last one wins
+CLAIM_SETTLE_SECONDS = 5
+
+
+def parse_shard(value) -> Tuple[int, int]:
+    """Parse an i/n shard argument"""
+    try:
+        index, count = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must look like i/n, got {value}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be in [0, n), got {value}")
+    return index, count
+
+
+@dataclass(frozen=True)
+class WorkUnit:
+    date: dt.date
+    partition: Optional[Tuple[int, int]] = None  # user-hash partition of the date
+
+    @property
+    def key(self):
+        if self.partition is None:
+            return self.date.strftime("%Y-%m-%d")
+        index, count = self.partition
+        return "{}/user-{}-of-{}".format(self.date.strftime("%Y-%m-%d"), index, count)
+
+
+def build_units(dates, shard, shard_by="date", sizes=None):
+    """All work units for dates, with the units owned by shard first
+
+    The rest follow so a node picks up the units of crashed nodes once their
+    leases expire. Units are ordered largest first by sizes, bytes per date, and
+    whole dates are dealt out so every shard gets about as many bytes.
+    """
+    index, count = shard
+    sizes = sizes or {}
+    dates = sorted(dates, key=lambda date: (-sizes.get(date, 0), date))
+    if shard_by == "date":
+        units = [WorkUnit(date) for date in dates]
+        # Each date goes to the least loaded shard, every node computes the same
+        # assignment from the same listing
+        loads = [(0, 0)] * count
+        own = []
+        for unit in units:
+            owner = min(range(count), key=lambda i: (loads[i], i))
+            size, assigned = loads[owner]
+            loads[owner] = (size + sizes.get(unit.date, 0), assigned + 1)
+            if owner == index:
+                own.append(unit)
+    else:
+        units = [WorkUnit(date, (i, count)) for date in dates for i in range(count)]
+        own = [unit for unit in units if unit.partition[0] == index]
+    return own + [unit for unit in units if unit not in own]
+
+
+@dataclass
+class Lease:
+    owner: str
+    expires_at: float
+
+
+class LeaseManifest:
+    """Claim/lease manifest kept next to the outputs in the sink
+
+    Every unit has a lease object while a node works on it and a done marker once
+    it has been written. Leases are renewed by a heartbeat and expire when a node
+    dies, after which any node can claim the unit again.
+    """
+
+    def __init__(self, s3_io, sink, prefix=LEASE_PREFIX, ttl=LEASE_TTL_SECONDS):
+        self.s3_io = s3_io
+        self.sink = sink
+        self.prefix = prefix
+        self.ttl = ttl
+        self.owner = "{}-{}-{}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]
+        )
+
+    def _read(self, key):
+        return self.s3_io.run(self.sink.get(key))
+
+    def _write(self, key, body):
+        self.s3_io.run(
+            self.sink.put(key, json.dumps(body), content_type="application/json")
+        )
+
+    def _lease_key(self, unit):
+        return f"{self.prefix}/{unit.key}.lease"
+
+    def _done_key(self, unit):
+        return f"{self.prefix}/{unit.key}.done"
+
+    def is_done(self, unit):
+        return self._read(self._done_key(unit)) is not None
+
+    def read_lease(self, unit) -> Optional[Lease]:
+        body = self._read(self._lease_key(unit))
+        if body is None:
+            return None
+        return Lease(**json.loads(body))
+
+    def _write_lease(self, unit):
+        lease = Lease(owner=self.owner, expires_at=time.time() + self.ttl)
+        self._write(self._lease_key(unit), vars(lease))
+
+    def try_claim(self, unit):
+        if self.is_done(unit):
+            return False
+        lease = self.read_lease(unit)
+        if lease is not None and lease.owner != self.owner:
+            if lease.expires_at > time.time():
+                return False
+            print(f"Lease of {lease.owner} on {unit.key} expired, reclaiming")
+        self._write_lease(unit)
+        time.sleep(CLAIM_SETTLE_SECONDS)
+        lease = self.read_lease(unit)
+        return lease is not None and lease.owner == self.owner
+
+    def renew(self, unit):
+        lease = self.read_lease(unit)
+        if lease is not None and lease.owner != self.owner:
+            print(f"Lease on {unit.key} was taken over by {lease.owner}")
+            return False
+        self._write_lease(unit)
+        return True
+
+    def release(self, unit):
+        self.s3_io.run(self.sink.delete(self._lease_key(unit)))
+
+    def complete(self, unit):
+        self._write(
+            self._done_key(unit), {"owner": self.owner, "completed_at": time.time()}
+        )
+        self.release(unit)
+
+    @contextmanager
+    def heartbeat(self, unit):
+        """Keep renewing the lease on unit while the block runs"""
+        stopped = threading.Event()
+
+        def renew_until_stopped():
+            while not stopped.wait(self.ttl / 3):
+                try:
+                    self.renew(unit)
+                except Exception as e:
+                    print(f"Failed to renew lease on {unit.key}. Error: {e}")
+
+        thread = threading.Thread(target=renew_until_stopped, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
@@ -0,0 +1,131 @@
+import base64
+import threading
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+SIGNATURE_INDEX_PREFIX = "index/signatures"
+SIGNATURE_PARTS_PREFIX = "index/signatureParts"
+# Bloom filters of the segments, one row per day in objects per shard and year,
+# so a lookup only reads the segments that may hold its signature
+SIGNATURE_FILTERS_PREFIX = "index/signatureFilters"
+# Signatures are spread over this many shards by crc32, one sorted segment per
+# shard and day
+SIGNATURE_INDEX_SHARDS = 256
+# Bits per signature and hash functions of a filter, about 1% false positives
+SIGNATURE_FILTER_BITS = 10
+SIGNATURE_FILTER_HASHES = 7
+# Keys of the two hashes the filter positions are derived from, 16 characters
+FILTER_HASH_KEYS = ("signaturebloom01", "signaturebloom02")
+
+_local = threading.local()
+
+
+def signature_shard(signature):
+    return zlib.crc32(signature.encode()) % SIGNATURE_INDEX_SHARDS
+
+
+@contextmanager
+def collect_signatures():
+    """Collect the signatures of every object written on this thread"""
+    frames = []
+    _local.frames = frames
+    try:
+        yield frames
+    finally:
+        _local.frames = None
+
+
+def record_signatures(object_path, df):
+    frames = getattr(_local, "frames", None)
+    if frames is None or "txSig" not in df or df.empty:
+        return
+    # program/<id>/<scope>/<key>/<recordType>/<year>/<yyyymmdd>, the object's
+    # day is kept in the index so only the prefix is stored
+    prefix = "/".join(object_path.split("/")[2:-2])
+    frames.append(
+        pd.DataFrame(
+            {
+                "signature": df["txSig"].to_numpy(),
+                "slot": df["slot"].values,
+                "prefix": prefix,
+            }
+        )
+    )
+
+
+def build_segments(parts, date):
+    """Sorted index segments for one day, {shard: frame}, from the day's parts"""
+    if len(parts) == 0:
+        return {}
+    day = pd.concat(parts, ignore_index=True).drop_duplicates(["signature", "prefix"])
+    day = (
+        day.sort_values(["signature", "prefix"])
+        .groupby("signature", sort=True)
+        .agg(slot=("slot", "min"), prefixes=("prefix", " ".join))
+        .reset_index()
+    )
+    day.insert(2, "date", date.strftime("%Y%m%d"))
+    shards = day["signature"].map(signature_shard)
+    return {shard: segment for shard, segment in day.groupby(shards, sort=False)}
+
+
+def find_in_segment(segment, signature):
+    """Binary search a segment sorted by signature, returns the row or None"""
+    signatures = segment["signature"].values
+    position = np.searchsorted(signatures, signature)
+    if position < len(signatures) and signatures[position] == signature:
+        return segment.iloc[position]
+    return None
+
+
+def filter_positions(signatures, size):
+    """Bit positions of signatures in a filter of size bits, one row each"""
+    values = np.asarray(signatures, dtype=object)
+    first, second = (
+        pd.util.hash_array(values, hash_key=key) for key in FILTER_HASH_KEYS
+    )
+    second |= np.uint64(1)
+    steps = np.arange(SIGNATURE_FILTER_HASHES, dtype=np.uint64)
+    return (first[:, None] + steps[None, :] * second[:, None]) % np.uint64(size)
+
+
+def build_filter(signatures):
+    """Base64 Bloom filter of signatures"""
+    size = max(64, -(-len(signatures) * SIGNATURE_FILTER_BITS // 8) * 8)
+    bits = np.zeros(size, dtype=bool)
+    bits[filter_positions(signatures, size).ravel()] = True
+    return base64.b64encode(np.packbits(bits).tobytes()).decode()
+
+
+def filter_may_contain(encoded, signature):
+    """False if signature is surely not in the filter"""
+    bits = np.unpackbits(np.frombuffer(base64.b64decode(encoded), dtype=np.uint8))
+    return bool(bits[filter_positions([signature], len(bits))].all())
+
+
+def day_filter(segment):
+    """The filter row of a day segment"""
+    return pd.DataFrame(
+        {
+            "date": [segment["date"].iloc[0]],
+            "signatures": [len(segment)],
+            "bits": [build_filter(segment["signature"].to_numpy())],
+        }
+    )
+
+
+def merge_filters(index, parts, dates):
+    """Replace the filter rows of dates in an index object with parts"""
+    frames = [] if index is None else [index[~index["date"].isin(dates)]]
+    frames.extend(parts)
+    if len(frames) == 0:
+        return pd.DataFrame(columns=["date", "signatures", "bits"])
+    return (
+        pd.concat(frames, ignore_index=True)
+        .drop_duplicates(subset=["date"], keep="last")
+        .sort_values("date")
+        .reset_index(drop=True)
+    )
@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import datetime as dt
+import json
+import os
+import uuid
+
+from scripts.uploads import upload_manifest_path
+
+# Files a local sink writes before it fsyncs them together
+LOCAL_FSYNC_BATCH = 256
+# Object metadata of a local sink lives under this directory of its root, out of
+# the way of the object keys
+LOCAL_METADATA_DIR = ".metadata"
+
+
+def parse_sink(value):
+    """Parse a sink argument: s3, memory or local:<directory>"""
+    if value in ("s3", "memory"):
+        return value
+    if value.startswith("local:") and len(value) > len("local:"):
+        return value
+    raise argparse.ArgumentTypeError(
+        f"Sink must be s3, memory or local:<directory>, got {value}"
+    )
+
+
+def make_sink(spec, get_s3_io, bucket_name, endpoint_url=None):
+    """The sink of spec, only an S3 sink asks get_s3_io for the S3 layer"""
+    if spec == "s3":
+        return S3Sink(get_s3_io(), bucket_name, endpoint_url)
+    if spec == "memory":
+        return MemorySink()
+    return LocalSink(spec[len("local:") :])
+
+
+class S3Sink:
+    """Objects in the destination bucket, written through the shared S3IO"""
+
+    def __init__(self, s3_io, bucket_name, endpoint_url=None):
+        self.s3_io = s3_io
+        self.bucket_name = bucket_name
+        # Content hashes of uploaded objects are remembered locally, per bucket
+        # and endpoint, a HEAD per unchanged object is what the manifest saves
+        self.manifest_path = upload_manifest_path(bucket_name, endpoint_url)
+
+    async def head(self, key):
+        """The object's metadata, None if it does not exist"""
+        head = await self.s3_io.head_if_exists(self.bucket_name, key)
+        return None if head is None else head["Metadata"]
+
+    async def get(self, key):
+        """The object's body, None if it does not exist"""
+        return await self.s3_io.get_if_exists(self.bucket_name, key)
+
+    async def put(self, key, body, content_type, content_encoding=None, metadata=None):
+        kwargs = {"ContentType": content_type, "Metadata": metadata or {}}
+        if content_encoding is not None:
+            kwargs["ContentEncoding"] = content_encoding
+        await self.s3_io.put(self.bucket_name, key, body, **kwargs)
+
+    async def put_stream(
+        self, key, parts, content_type, content_encoding=None, metadata=None
+    ):
+        """Write what is written to parts, a PartWriter"""
+        kwargs = {"ContentType": content_type, "Metadata": metadata or {}}
+        if content_encoding is not None:
+            kwargs["ContentEncoding"] = content_encoding
+        await self.s3_io.put_stream(self.bucket_name, key, parts, **kwargs)
+
+    async def delete(self, key):
+        await self.s3_io.delete(self.bucket_name, key)
+
+    async def list(self, prefix):
+        """Objects under prefix as {"Key", "LastModified"} dicts, in key order"""
+        return await self.s3_io.list(self.bucket_name, prefix, source=False)
+
+    async def flush(self):
+        pass
+
+
+class LocalSink:
+    """Objects as files under a local directory, with the bucket's key layout
+
+    Files are written under a temporary name and renamed into place, and fsynced
+    in batches of LOCAL_FSYNC_BATCH rather than one by one. An object's metadata
+    is only written once its file is durable, so after a crash an object can lose
+    its content hash and be rewritten, but never be skipped as unchanged while
+    torn. Object bodies are stored as written, compressed with their codec.
+    """
+
+    manifest_path = None
+
+    def __init__(self, root, fsync_batch=LOCAL_FSYNC_BATCH):
+        self.root = os.path.abspath(root)
+        self.fsync_batch = fsync_batch
+        # key -> metadata of objects renamed into place but not fsynced yet
+        self.unsynced = {}
+        self.syncing = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def metadata_path(self, key):
+        return os.path.join(self.root, LOCAL_METADATA_DIR, *key.split("/")) + ".json"
+
+    async def head(self, key):
+        for pending in (self.unsynced, self.syncing):
+            if key in pending:
+                return pending[key]
+        return await asyncio.to_thread(self._head, key)
+
+    def _head(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+        try:
+            with open(self.metadata_path(key), "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    async def get(self, key):
+        return await asyncio.to_thread(self._get, key)
+
+    def _get(self, key):
+        try:
+            with open(self.path(key), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    async def put(self, key, body, content_type, content_encoding=None, metadata=None):
+        if isinstance(body, str):
+            body = body.encode()
+        tmp_path = await asyncio.to_thread(self._open_tmp, key)
+        with open(tmp_path, "ab") as file:
+            await asyncio.to_thread(file.write, body)
+        await self._commit(key, tmp_path, metadata)
+
+    async def put_stream(
+        self, key, parts, content_type, content_encoding=None, metadata=None
+    ):
+        try:
+            tmp_path = await asyncio.to_thread(self._open_tmp, key)
+            try:
+                with open(tmp_path, "ab") as file:
+                    while (body := await parts.get()) is not None:
+                        await asyncio.to_thread(file.write, body)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        finally:
+            await parts.discard()
+        await self._commit(key, tmp_path, metadata)
+
+    def _open_tmp(self, key):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.tmp-{}".format(path, uuid.uuid4().hex)
+        open(tmp_path, "wb").close()
+        return tmp_path
+
+    async def _commit(self, key, tmp_path, metadata):
+        await asyncio.to_thread(self._replace, key, tmp_path)
+        self.unsynced[key] = dict(metadata or {})
+        if len(self.unsynced) >= self.fsync_batch:
+            await self.flush()
+
+    def _replace(self, key, tmp_path):
+        # The previous metadata must not vouch for the new file before it is synced
+        try:
+            os.remove(self.metadata_path(key))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, self.path(key))
+
+    async def flush(self):
+        """fsync the objects written since the last flush, then their metadata"""
+        if len(self.unsynced) == 0:
+            return
+        batch, self.unsynced = self.unsynced, {}
+        self.syncing.update(batch)
+        try:
+            await asyncio.to_thread(self._sync, batch)
+        finally:
+            for key in batch:
+                if self.syncing.get(key) is batch[key]:
+                    del self.syncing[key]
+
+    def _sync(self, batch):
+        fsync_paths([self.path(key) for key in batch])
+        metadata_paths = []
+        for key, metadata in batch.items():
+            path = self.metadata_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as file:
+                json.dump(metadata, file)
+            metadata_paths.append(path)
+        fsync_paths(metadata_paths)
+
+    async def delete(self, key):
+        self.unsynced.pop(key, None)
+        for path in (self.metadata_path(key), self.path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def list(self, prefix):
+        return await asyncio.to_thread(self._list, prefix)
+
+    def _list(self, prefix):
+        # Only the directory the prefix ends in and below can hold matches
+        directory = self.path(prefix.rsplit("/", 1)[0]) if "/" in prefix else self.root
+        objects = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            if dirpath == self.root and LOCAL_METADATA_DIR in dirnames:
+                dirnames.remove(LOCAL_METADATA_DIR)
+            for filename in filenames:
+                if ".tmp-" in filename:
+                    continue
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if not key.startswith(prefix):
+                    continue
+                objects.append(
+                    {
+                        "Key": key,
+                        "LastModified": dt.datetime.fromtimestamp(
+                            os.stat(path).st_mtime, dt.timezone.utc
+                        ),
+                    }
+                )
+        return sorted(objects, key=lambda obj: obj["Key"])
+
+
+def fsync_paths(paths):
+    """fsync files and then the directories their names were written to"""
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for directory in {os.path.dirname(path) for path in paths}:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class MemorySink:
+    """Objects kept in a dict, for benchmarks that leave storage out
+
+    Only usable with the thread executor, objects written in worker processes
+    would not be seen by the parent.
+    """
+
+    manifest_path = None
+
+    def __init__(self):
+        # key -> (body, metadata, last modified)
+        self.objects = {}
+
+    @property
+    def size(self):
+        return sum(len(body) for body, _, _ in self.objects.values())
+
+    async def head(self, key):
+        obj = self.objects.get(key)
+        return None if obj is None else obj[1]
+
+    async def get(self, key):
+        obj = self.objects.get(key)
+        return None if obj is None else obj[0]
+
+    async def put(self, key, body, content_type, content_encoding=None, metadata=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.objects[key] = (
+            body,
+            dict(metadata or {}),
+            dt.datetime.now(dt.timezone.utc),
+        )
+
+    async def put_stream(
+        self, key, parts, content_type, content_encoding=None, metadata=None
+    ):
+        chunks = []
+        try:
+            while (body := await parts.get()) is not None:
+                chunks.append(body)
+        finally:
+            await parts.discard()
+        await self.put(key, b"".join(chunks), content_type, content_encoding, metadata)
+
+    async def delete(self, key):
+        self.objects.pop(key, None)
+
+    async def list(self, prefix):
+        return [
+            {"Key": key, "LastModified": obj[2]}
+            for key, obj in sorted(self.objects.items())
+            if key.startswith(prefix)
+        ]
+
+    async def flush(self):
+        pass
@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+SLOT_INDEX_PATH = "./out/slot_index.sqlite"
+# Slot column of the txns files, row groups are pruned by its statistics
+TXNS_SLOT_COLUMN = "block_slot"
+
+
+def slot_ranges(metadata, column=TXNS_SLOT_COLUMN):
+    """(min, max) slot of every row group, None where the statistics are missing"""
+    leaves = [
+        i
+        for i in range(metadata.num_columns)
+        if metadata.schema.column(i).path == column
+    ]
+    ranges = []
+    for row_group in range(metadata.num_row_groups):
+        statistics = None
+        if len(leaves) > 0:
+            statistics = metadata.row_group(row_group).column(leaves[0]).statistics
+        if statistics is None or not statistics.has_min_max:
+            ranges.append(None)
+        else:
+            ranges.append((statistics.min, statistics.max))
+    return ranges
+
+
+def select_row_groups(ranges, slots):
+    """Row groups whose slot range holds any of slots, a sorted numpy array"""
+    selected = []
+    for row_group, slot_range in enumerate(ranges):
+        if slot_range is None:
+            selected.append(row_group)
+            continue
+        low, high = slot_range
+        position = np.searchsorted(slots, low)
+        if position < len(slots) and slots[position] <= high:
+            selected.append(row_group)
+    return selected
+
+
+class SlotIndex:
+    """Slot ranges of the row groups of txns files, cached in sqlite
+
+    Entries are keyed by file key and size, so a rewritten file is indexed
+    again. The raw footer is kept with them, reading the selected row groups
+    then needs no request for it.
+    """
+
+    def __init__(self, path=SLOT_INDEX_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS footers "
+                "(path TEXT, size INTEGER, footer BLOB, PRIMARY KEY (path, size))"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS slot_ranges (path TEXT, size INTEGER, "
+                "row_group INTEGER, min_slot INTEGER, max_slot INTEGER, "
+                "PRIMARY KEY (path, size, row_group))"
+            )
+
+    def get(self, key, size):
+        """(footer, slot ranges) of an indexed file, None if it is not"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT footer FROM footers WHERE path = ? AND size = ?", (key, size)
+            ).fetchone()
+            if row is None:
+                return None
+            ranges = self.db.execute(
+                "SELECT min_slot, max_slot FROM slot_ranges "
+                "WHERE path = ? AND size = ? ORDER BY row_group",
+                (key, size),
+            ).fetchall()
+        return row[0], [None if low is None else (low, high) for low, high in ranges]
+
+    def record(self, key, size, footer):
+        """Index a file from its raw footer, returns its slot ranges"""
+        ranges = slot_ranges(pq.read_metadata(pa.BufferReader(footer)))
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO footers VALUES (?, ?, ?)", (key, size, footer)
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO slot_ranges VALUES (?, ?, ?, ?, ?)",
+                [
+                    (key, size, row_group, *(slot_range or (None, None)))
+                    for row_group, slot_range in enumerate(ranges)
+                ],
+            )
+        return ranges
+
+    async def read(self, source, key, slots, columns):
+        """Read columns of the row groups of key that can hold slots
+
+        slots is a sorted numpy array. Returns None when no row group can, the
+        file is then not read at all.
+        """
+        size = source.size(key)
+        cached = None if size is None else self.get(key, size)
+        if cached is None:
+            footer = await source.read_footer(key)
+            if size is None:
+                ranges = slot_ranges(pq.read_metadata(pa.BufferReader(footer)))
+            else:
+                ranges = self.record(key, size, footer)
+        else:
+            footer, ranges = cached
+        row_groups = select_row_groups(ranges, slots)
+        if len(row_groups) == 0:
+            return None
+        return await source.read_row_groups(key, footer, row_groups, columns)
@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import functools
+import io
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Bytes read from the end of a parquet file in the hope they hold its footer,
+# larger footers take a second request
+FOOTER_READ_SIZE = 64 * 1024
+# Column chunks fewer bytes apart than this are fetched with one ranged GET, the
+# bytes in between cost less than another request
+RANGE_COALESCE_GAP = 1024 * 1024
+# When the selected column chunks make up at least this share of a file, the
+# whole object is fetched with a single GET instead
+WHOLE_OBJECT_SHARE = 0.5
+
+
+def parse_source(value):
+    """Parse a source argument: s3 or local:<directory>"""
+    if value == "s3":
+        return value
+    if value.startswith("local:") and len(value) > len("local:"):
+        return value
+    raise argparse.ArgumentTypeError(
+        f"Source must be s3 or local:<directory>, got {value}"
+    )
+
+
+def make_source(spec, get_s3_io, bucket_name):
+    """The source of spec, only an S3 source asks get_s3_io for the S3 layer"""
+    if spec == "s3":
+        return S3Source(get_s3_io(), bucket_name)
+    return LocalSource(spec[len("local:") :])
+
+
+def footer_length(tail):
+    """Length of the parquet footer tail ends with, the 8 trailing bytes included"""
+    if tail[-4:] != b"PAR1":
+        raise ValueError("Not a parquet file")
+    return int.from_bytes(tail[-8:-4], "little") + 8
+
+
+def column_chunk_ranges(metadata, row_groups, columns):
+    """(start, end) byte ranges of the column chunks of columns in row_groups"""
+    leaves = [
+        i
+        for i in range(metadata.num_columns)
+        if metadata.schema.column(i).path.split(".")[0] in columns
+    ]
+    ranges = []
+    for row_group in row_groups:
+        for i in leaves:
+            chunk = metadata.row_group(row_group).column(i)
+            start = chunk.data_page_offset
+            if chunk.has_dictionary_page and chunk.dictionary_page_offset:
+                start = min(start, chunk.dictionary_page_offset)
+            ranges.append((start, start + chunk.total_compressed_size))
+    return ranges
+
+
+def coalesce_ranges(ranges, gap=RANGE_COALESCE_GAP):
+    """Sorted (start, end) ranges, those less than gap bytes apart merged"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class RangeFile(io.RawIOBase):
+    """Read-only file over the byte ranges fetched from a remote object
+
+    Reads outside them go through fetch(start, end), which must not be called
+    from the event loop thread.
+    """
+
+    def __init__(self, size, chunks, fetch):
+        super().__init__()
+        self.size = size
+        self.chunks = sorted(chunks.items())  # [(start, bytes)]
+        self.fetch = fetch
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        for start, data in self.chunks:
+            if start <= self.position and end <= start + len(data):
+                data = data[self.position - start : end - start]
+                break
+        else:
+            data = self.fetch(self.position, end)
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class S3Source:
+    """topledger files in the source bucket, read through the shared S3IO"""
+
+    def __init__(self, s3_io, bucket_name):
+        self.s3_io = s3_io
+        self.bucket_name = bucket_name
+        # Object sizes seen by list(), so callers can key caches on them
+        self.sizes = {}
+
+    async def list(self, prefix, start_after=""):
+        """{"Key", "Size"} dicts of the files under prefix after start_after, in key order"""
+        objects = await self.s3_io.list(self.bucket_name, prefix, start_after)
+        self.sizes.update((obj["Key"], obj["Size"]) for obj in objects)
+        return objects
+
+    def size(self, key):
+        """The size of key as last listed, None if it was not"""
+        return self.sizes.get(key)
+
+    async def get(self, key):
+        return await self.s3_io.get(self.bucket_name, key)
+
+    async def read_table(self, key, columns=None, filters=None):
+        """Read a parquet file, only columns are materialized and filters applied"""
+        body = await self.get(key)
+        return await self.s3_io.to_thread(
+            functools.partial(
+                pq.read_table, pa.BufferReader(body), columns=columns, filters=filters
+            )
+        )
+
+    async def read_footer(self, key):
+        """The raw parquet footer of key, without reading the rest of the file"""
+        tail = await self.s3_io.get(
+            self.bucket_name, key, byte_range=f"bytes=-{FOOTER_READ_SIZE}"
+        )
+        length = footer_length(tail)
+        if length > len(tail):
+            tail = await self.s3_io.get(
+                self.bucket_name, key, byte_range=f"bytes=-{length}"
+            )
+        return tail[-length:]
+
+    async def read_row_groups(self, key, footer, row_groups, columns):
+        """Read columns of row_groups only, fetching just their column chunks
+
+        footer is the file's raw footer as returned by read_footer(). Nearby
+        chunks are fetched together, and a file whose chunks are mostly selected
+        is fetched whole.
+        """
+        metadata = pq.read_metadata(pa.BufferReader(footer))
+        ranges = column_chunk_ranges(metadata, row_groups, columns)
+        size = self.size(key)
+        if size is None:
+            size = max((end for _, end in ranges), default=0) + len(footer)
+
+        selected = sum(end - start for start, end in ranges)
+        if selected >= size * WHOLE_OBJECT_SHARE:
+            body = await self.get(key)
+            return await self.s3_io.to_thread(
+                lambda: pq.ParquetFile(
+                    pa.BufferReader(body), metadata=metadata
+                ).read_row_groups(row_groups, columns=columns)
+            )
+
+        async def fetch(start, end):
+            return start, await self.s3_io.get(
+                self.bucket_name, key, byte_range=f"bytes={start}-{end - 1}"
+            )
+
+        chunks = dict(
+            await asyncio.gather(*(fetch(*r) for r in coalesce_ranges(ranges)))
+        )
+
+        def read():
+            file = RangeFile(
+                size,
+                chunks,
+                lambda start, end: self.s3_io.run(fetch(start, end))[1],
+            )
+            return pq.ParquetFile(
+                file, metadata=metadata, pre_buffer=False
+            ).read_row_groups(row_groups, columns=columns)
+
+        return await self.s3_io.to_thread(read)
+
+
+class LocalSource:
+    """topledger files under a local directory with the bucket's layout
+
+    Mirrors drift/events/<date>/ and drift/txns/<date>/, e.g. synced with
+    aws s3 sync s3://drift-topledger/drift/events/2024-06-10 ... Parquet files
+    are memory-mapped and only the projected column chunks are read.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    async def list(self, prefix, start_after=""):
+        return await asyncio.to_thread(self._list, prefix, start_after)
+
+    def _list(self, prefix, start_after):
+        directory = self.path(prefix.rsplit("/", 1)[0]) if "/" in prefix else self.root
+        objects = []
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if key.startswith(prefix) and key > start_after:
+                    objects.append({"Key": key, "Size": os.stat(path).st_size})
+        return sorted(objects, key=lambda obj: obj["Key"])
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    async def get(self, key):
+        return await asyncio.to_thread(self._get, key)
+
+    def _get(self, key):
+        with open(self.path(key), "rb") as file:
+            return file.read()
+
+    async def read_table(self, key, columns=None, filters=None):
+        return await asyncio.to_thread(
+            functools.partial(
+                pq.read_table,
+                self.path(key),
+                columns=columns,
+                filters=filters,
+                memory_map=True,
+            )
+        )
+
+    async def read_footer(self, key):
+        return await asyncio.to_thread(self._read_footer, key)
+
+    def _read_footer(self, key):
+        with open(self.path(key), "rb") as file:
+            file.seek(-min(FOOTER_READ_SIZE, os.path.getsize(self.path(key))), 2)
+            tail = file.read()
+            length = footer_length(tail)
+            if length > len(tail):
+                file.seek(-length, 2)
+                tail = file.read()
+        return tail[-length:]
+
+    async def read_row_groups(self, key, footer, row_groups, columns):
+        metadata = pq.read_metadata(pa.BufferReader(footer))
+        return await asyncio.to_thread(
+            lambda: pq.ParquetFile(
+                self.path(key), metadata=metadata, memory_map=True
+            ).read_row_groups(row_groups, columns=columns)
+        )
@@ -0,0 +1,350 @@
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from solders.pubkey import Pubkey  # type: ignore
+
+from scripts.ipc import read_ipc, write_ipc
+
+# Pubkey and signature columns, dictionary encoded so every distinct value is
+# one string however many rows repeat it. Other columns holding Pubkeys are
+# encoded too
+DICTIONARY_COLUMNS = ("user", "maker", "taker", "filler", "userAuthority", "txSig")
+# Rows a KeyedEvents holds as dicts before converting them to a sorted run
+KEYED_RUN_ROWS = 64 * 1024
+# Column of a run holding the prefix of every row
+RUN_KEY_COLUMN = "__prefix"
+
+
+class StringDictionary:
+    """Run-wide string forms of pubkeys, each pubkey is base58 encoded once"""
+
+    def __init__(self):
+        self.strings = {}
+
+    def string(self, value):
+        if isinstance(value, str):
+            return value
+        string = self.strings.get(value)
+        if string is None:
+            string = self.strings[value] = str(value)
+        return string
+
+    def encode(self, values) -> pa.DictionaryArray:
+        """Dictionary array of values, pubkeys or strings, None for nulls
+
+        The dictionary is sorted, so sorting the pandas categorical it converts
+        to is the same as sorting the strings.
+        """
+        ids: dict[str, int] = {}
+        indices: list[int | None] = []
+        for value in values:
+            if value is None:
+                indices.append(None)
+                continue
+            string = self.string(value)
+            index = ids.get(string)
+            if index is None:
+                index = ids[string] = len(ids)
+            indices.append(index)
+        dictionary = pa.array(list(ids), pa.string())
+        order = pc.array_sort_indices(dictionary).to_numpy()
+        rank = np.empty(len(order), np.int32)
+        rank[order] = np.arange(len(order), dtype=np.int32)
+        return pa.DictionaryArray.from_arrays(
+            pa.array(rank).take(pa.array(indices, pa.int32())),
+            dictionary.take(order),
+        )
+
+
+PUBKEYS = StringDictionary()
+
+
+def pubkey_str(value):
+    """The string form of a pubkey, or of a string"""
+    return PUBKEYS.string(value)
+
+
+# Object metadata listing the decimal exponent of every fixed-point column, as
+# column=exponent pairs separated by commas
+EXPONENTS_METADATA_KEY = "fixed-point-exponents"
+
+
+class FixedPoint(int):
+    """An exact integer amount, the value is self / 10**exponent"""
+
+    def __new__(cls, value, exponent):
+        fixed = super().__new__(cls, value)
+        fixed.exponent = exponent
+        return fixed
+
+    def __reduce__(self):
+        # Parsed trades are pickled between the passes of the process pool
+        return FixedPoint, (int(self), self.exponent)
+
+
+def fixed_point_array(values):
+    """(array, exponent) of a column of FixedPoints
+
+    Values with a smaller exponent are scaled up to the column's largest one,
+    which is exact. Columns that do not fit int64 are kept as strings.
+    """
+    exponent = max(value.exponent for value in values if value is not None)
+    ints = [
+        (None if value is None else int(value) * 10 ** (exponent - value.exponent))
+        for value in values
+    ]
+    try:
+        return pa.array(ints, pa.int64()), exponent
+    except (pa.ArrowInvalid, OverflowError):
+        return (
+            pa.array([None if value is None else str(value) for value in ints]),
+            exponent,
+        )
+
+
+def column_exponents(schema: pa.Schema):
+    """{column: exponent} of the fixed-point columns of a rows_to_table schema"""
+    return {
+        field.name: int(field.metadata[b"exponent"])
+        for field in schema
+        if field.metadata is not None and b"exponent" in field.metadata
+    }
+
+
+def format_exponents(exponents):
+    return ",".join(f"{column}={exponent}" for column, exponent in exponents.items())
+
+
+def is_dictionary_column(column, values):
+    if column in DICTIONARY_COLUMNS:
+        return True
+    first = next((value for value in values if value is not None), None)
+    return isinstance(first, Pubkey)
+
+
+def rows_to_table(rows) -> pa.Table:
+    """Typed Arrow table from parse_event dicts, columns in first seen order
+
+    FixedPoint columns become integer columns with their exponent in the field
+    metadata, see column_exponents().
+    """
+    columns = dict.fromkeys(key for row in rows for key in row)
+    arrays = []
+    fields = []
+    for column in columns:
+        values = [row.get(column) for row in rows]
+        metadata = None
+        first = next((value for value in values if value is not None), None)
+        if is_dictionary_column(column, values):
+            array = PUBKEYS.encode(values)
+        elif isinstance(first, FixedPoint):
+            array, exponent = fixed_point_array(values)
+            metadata = {"exponent": str(exponent)}
+        else:
+            try:
+                array = pa.array(values)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+                array = None
+            if array is None or pa.types.is_nested(array.type):
+                # Pubkeys, u128s, lists and mixed columns are kept as their
+                # string form, which is what ends up in the csv anyway. Lists
+                # converted to pandas would be numpy arrays, written as [1 2 3]
+                array = pa.array(
+                    [None if value is None else str(value) for value in values],
+                    pa.string(),
+                )
+        arrays.append(array)
+        fields.append(pa.field(column, array.type, metadata=metadata))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def rescale_column(column, digits):
+    """Fixed-point column values times 10**digits, ints or their string forms"""
+    if pa.types.is_integer(column.type):
+        try:
+            return pc.multiply_checked(column, 10**digits)
+        except pa.ArrowInvalid:
+            column = column.cast(pa.string())
+    if pa.types.is_string(column.type):
+        # Appending zeros to the string form of an int multiplies it
+        scaled = pc.binary_join_element_wise(column, "0" * digits, "")
+        return pc.if_else(pc.equal(column, "0"), column, scaled)
+    return column
+
+
+def unify_tables(tables):
+    """tables of rows_to_table converted to one schema
+
+    Tables of the same rows' columns can differ where a column holds only nulls
+    in one of them, did not fit int64 in another, or holds fixed-point values of
+    a smaller exponent. Such columns become the type of the others, their string
+    form, or are scaled to the largest exponent.
+    """
+    exponents = {}
+    types = {}
+    for table in tables:
+        for name, exponent in column_exponents(table.schema).items():
+            exponents[name] = max(exponents.get(name, exponent), exponent)
+        for field in table.schema:
+            types.setdefault(field.name, set()).add(field.type)
+    strings = {
+        name
+        for name, column_types in types.items()
+        if pa.string() in column_types and len(column_types - {pa.null()}) > 1
+    }
+    converted = []
+    for table in tables:
+        own = column_exponents(table.schema)
+        arrays = []
+        fields = []
+        for field, column in zip(table.schema, table.columns):
+            metadata = field.metadata
+            if field.name in exponents:
+                exponent = exponents[field.name]
+                if own.get(field.name, exponent) != exponent:
+                    column = rescale_column(column, exponent - own[field.name])
+                metadata = {"exponent": str(exponent)}
+            if field.name in strings and column.type != pa.string():
+                column = column.cast(pa.string())
+            arrays.append(column)
+            fields.append(pa.field(field.name, column.type, metadata=metadata))
+        converted.append(pa.Table.from_arrays(arrays, schema=pa.schema(fields)))
+    schema = pa.unify_schemas(
+        [table.schema for table in converted], promote_options="permissive"
+    )
+    return [
+        pa.Table.from_arrays(
+            [
+                (
+                    table[field.name].cast(field.type)
+                    if field.name in table.column_names
+                    else pa.nulls(table.num_rows, field.type)
+                )
+                for field in schema
+            ],
+            schema=schema,
+        )
+        for table in converted
+    ]
+
+
+class KeyedEvents:
+    """Parsed events grouped under the object prefixes they are written to
+
+    Replaces a dict of prefix -> list of dicts. An event added under several
+    prefixes is stored once. Every run_rows rows the events are converted to a
+    typed Arrow run sorted by prefix, and within a prefix by sort_key, and the
+    dicts dropped. With spill_dir, runs are written there as Arrow IPC files and
+    memory-mapped, so the events are never all held in memory.
+
+    A prefix's tables only have the columns its own events have, as a DataFrame
+    of its dicts would, even where the events of other prefixes have more.
+    """
+
+    def __init__(self, sort_key=None, spill_dir=None, run_rows=KEYED_RUN_ROWS):
+        self.sort_key = sort_key
+        self.spill_dir = spill_dir
+        self.run_rows = run_rows
+        self.rows = []
+        self.row_of = {}
+        self.keys = []
+        self.indices = []
+        self.prefixes = set()
+        # {prefix: {column names of an event: None}}, in the order first added
+        self.layouts = {}
+        # [(run, {prefix: (offset, count)})]
+        self.sorted_runs = []
+
+    def add(self, key, parsed):
+        index = self.row_of.get(id(parsed))
+        if index is None:
+            if len(self.rows) >= self.run_rows:
+                self.cut_run()
+            index = self.row_of[id(parsed)] = len(self.rows)
+            self.rows.append(parsed)
+        self.keys.append(key)
+        self.indices.append(index)
+        self.prefixes.add(key)
+        self.layouts.setdefault(key, {}).setdefault(tuple(parsed), None)
+
+    def columns(self, key):
+        """The columns of the prefix's events, in first seen order"""
+        return list(dict.fromkeys(c for layout in self.layouts[key] for c in layout))
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def cut_run(self):
+        """Convert the rows added since the last run to a sorted run"""
+        if len(self.rows) == 0:
+            return
+        table = rows_to_table(self.rows).take(pa.array(self.indices))
+        table = table.append_column(RUN_KEY_COLUMN, pa.array(self.keys, pa.string()))
+        sort_keys = [(RUN_KEY_COLUMN, "ascending")]
+        if self.sort_key in table.column_names:
+            sort_keys.append((self.sort_key, "ascending"))
+        run = table.take(pc.sort_indices(table, sort_keys=sort_keys))  # stable
+        counts = pc.value_counts(run[RUN_KEY_COLUMN])
+        ranges = {}
+        offset = 0
+        for key, count in zip(
+            counts.field("values").to_pylist(), counts.field("counts").to_pylist()
+        ):
+            ranges[key] = (offset, count)
+            offset += count
+        run = run.drop_columns([RUN_KEY_COLUMN])
+        if self.spill_dir is not None:
+            path = os.path.join(
+                self.spill_dir, f"{id(self)}-{len(self.sorted_runs)}.arrow"
+            )
+            run = read_ipc(write_ipc(run, path))
+        self.sorted_runs.append((run, ranges))
+        self.rows = []
+        self.row_of = {}
+        self.keys = []
+        self.indices = []
+
+    def runs(self):
+        """Yield (prefix, runs) pairs, in prefix order
+
+        runs are the prefix's tables of every run in the order they were cut,
+        each sorted by sort_key, all of one schema.
+        """
+        self.cut_run()
+        for key in sorted(self.prefixes):
+            columns = self.columns(key)
+            tables = [
+                run.slice(*ranges[key]).select(
+                    [column for column in columns if column in run.column_names]
+                )
+                for run, ranges in self.sorted_runs
+                if key in ranges
+            ]
+            yield key, [table.select(columns) for table in unify_tables(tables)]
+
+    def tables(self):
+        """Yield (prefix, table) pairs, the prefix's runs concatenated
+
+        Without a sort_key the rows are in the order they were added.
+        """
+        for key, runs in self.runs():
+            yield key, pa.concat_tables(runs)
+
+    def frames(self):
+        """Yield (prefix, DataFrame) pairs, converted slice by slice
+
+        The exponents of fixed-point columns are kept in df.attrs["exponents"].
+        """
+        for key, table in self.tables():
+            df = table.to_pandas()
+            exponents = column_exponents(table.schema)
+            if len(exponents) > 0:
+                df.attrs["exponents"] = exponents
+            yield key, df
+
+
+def iter_transactions(records: pa.Table):
+    """(tx_id, block_slot) pairs of a partition"""
+    return zip(records["tx_id"].to_pylist(), records["block_slot"].to_pylist())
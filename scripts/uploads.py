@@ -0,0 +1,112 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+
+import pandas as pd
+
+# One manifest per destination, see upload_manifest_path()
+UPLOAD_MANIFEST_DIR = "./out"
+# Object metadata key holding the content hash, checked when the local manifest
+# has no entry for an object (e.g. it was written from another machine)
+CONTENT_HASH_METADATA_KEY = "content-sha256"
+
+
+def upload_manifest_path(bucket_name, endpoint_url=None):
+    """Manifest of the uploads to bucket_name at endpoint_url, None for AWS
+
+    An object uploaded to one destination (e.g. a local minio) must not be
+    skipped as unchanged when the same path is written to another.
+    """
+    endpoint = "aws" if endpoint_url is None else endpoint_url
+    return os.path.join(
+        UPLOAD_MANIFEST_DIR,
+        "uploads-{}-{}.sqlite".format(
+            bucket_name, re.sub(r"[^A-Za-z0-9.-]+", "_", endpoint).strip("_")
+        ),
+    )
+
+
+def content_hash(df: pd.DataFrame, *salt) -> str:
+    """Hash of a frame's columns and values, stable across runs and processes
+
+    salt is hashed in too, so a change of serialization format changes the hash.
+    """
+    return content_hash_frames(df.columns, [df], *salt)
+
+
+def content_hash_frames(columns, frames, *salt) -> str:
+    """content_hash of the concatenation of frames, which have the given columns"""
+    digest = hashlib.sha256()
+    for part in (*salt, *columns):
+        digest.update(str(part).encode() + b"\0")
+    for df in frames:
+        digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+class UploadManifest:
+    """Content hashes of the objects this machine uploaded, with per-run counts
+
+    Kept in sqlite so the threads and worker processes of a run can share it.
+    Counts are "written" for new objects, "changed" for objects that existed with
+    different content and "skipped" for identical ones. Without a path only the
+    counts are kept and every object is checked against the sink.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.db = None
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS uploads (path TEXT PRIMARY KEY, hash TEXT)"
+            )
+
+    def get(self, object_path):
+        if self.db is None:
+            return None
+        with self.lock:
+            row = self.db.execute(
+                "SELECT hash FROM uploads WHERE path = ?", (object_path,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def record(self, object_path, digest, status, remember=True):
+        with self.lock:
+            if remember and self.db is not None:
+                with self.db:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO uploads VALUES (?, ?)",
+                        (object_path, digest),
+                    )
+            self.counts[status] += 1
+
+    def forget(self, object_path):
+        """Drop the hash of a deleted object, writing it again is not skipped"""
+        if self.db is None:
+            return
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM uploads WHERE path = ?", (object_path,))
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.counts)
+
+    def add_counts(self, counts):
+        with self.lock:
+            self.counts.update(counts)
+
+
+def format_counts(counts):
+    return "{} written, {} changed, {} skipped".format(
+        counts["written"], counts["changed"], counts["skipped"]
+    )
@@ -1,3 +1,4 @@
+import zlib
 import requests
 from driftpy.constants import (
     QUOTE_PRECISION,
@@ -19,3 +20,17 @@ def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
         yield lst[i : i + n]
+
+
+def in_shard(key, shard):
+    """Whether key hashes into shard, an (index, count) pair. None matches every key"""
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(key.encode()) % count == index
+
+
+def sub_shard(shard, index, count):
+    """Split shard into count sub-shards, every key of the sub-shard is also in shard"""
+    parent_index, parent_count = shard if shard is not None else (0, 1)
+    return parent_index + parent_count * index, parent_count * count
@@ -0,0 +1,73 @@
+import datetime as dt
+from types import SimpleNamespace
+
+import pyarrow as pa
+import pytest
+
+import archive
+from scripts.log_parser import RAW_LOGS_SCHEMA
+
+DATE = dt.date(2024, 6, 10)
+EVENT_TYPES = ["DepositRecord", "FundingPaymentRecord"]
+
+
+@pytest.fixture
+def day(monkeypatch, tmp_path):
+    """archive_day reading deposits of a and b and a funding payment of c
+
+    Returns the event types it checkpoints, no event is processed.
+    """
+    events = pa.table(
+        {
+            "tx_id": ["a", "b", "c"],
+            "block_slot": [1, 2, 3],
+            "block_time": ["06/10/24 00:00"] * 3,
+            "event_type": ["DepositRecord", "DepositRecord", "FundingPaymentRecord"],
+        }
+    )
+
+    async def read_event_files(files, event_types, holding=None):
+        return [events]
+
+    async def fetch_raw_logs(sigs, *args):
+        return RAW_LOGS_SCHEMA.empty_table()
+
+    marked = []
+    monkeypatch.setattr(archive, "SINK_SPEC", "memory")
+    monkeypatch.setattr(archive, "SINK", None)
+    monkeypatch.setattr(archive, "UPLOAD_MANIFEST", None)
+    monkeypatch.setattr(archive, "read_event_files", read_event_files)
+    monkeypatch.setattr(archive, "fetch_raw_logs", fetch_raw_logs)
+    monkeypatch.setattr(archive, "get_source", lambda: None)
+    monkeypatch.setattr(archive, "get_slot_index", lambda: None)
+    monkeypatch.setattr(archive, "process_day_in_threads", lambda *args: set())
+    monkeypatch.setattr(
+        archive, "mark_processed", lambda event, date: marked.append(event)
+    )
+    monkeypatch.setattr(
+        archive, "RPC_UNFETCHED_PATH", str(tmp_path / "rpc_unfetched" / "{}.txt")
+    )
+    return marked
+
+
+def unfetched_path():
+    return archive.RPC_UNFETCHED_PATH.format("20240610")
+
+
+def test_unfetched_signatures_fail_their_event_types(day, monkeypatch):
+    # "z" failed on an earlier day
+    fetcher = SimpleNamespace(failed={"b", "z"})
+    monkeypatch.setattr(archive, "get_rpc_fetcher", lambda: fetcher)
+
+    with pytest.raises(RuntimeError, match="DepositRecord"):
+        archive.archive_day(DATE, ["events"], ["txns"], EVENT_TYPES)
+    assert day == ["FundingPaymentRecord"]
+    with open(unfetched_path()) as file:
+        assert file.read() == "b\n"
+
+    # A rerun fetching them all marks the day and forgets the signatures
+    fetcher.failed = set()
+    archive.archive_day(DATE, ["events"], ["txns"], ["DepositRecord"])
+    assert day == ["FundingPaymentRecord", "DepositRecord"]
+    with pytest.raises(FileNotFoundError):
+        open(unfetched_path())
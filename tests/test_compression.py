@@ -0,0 +1,44 @@
+import gzip
+import io
+
+from scripts.compression import BufferedCompressor, Codec, decompress
+
+DATA = b"".join(b"%d,sig%d,SOL-PERP,%d\n" % (i, i * 7, i % 13) for i in range(5000))
+
+
+def streamed(codec, data):
+    raw = io.BytesIO()
+    with codec.writer(raw) as writer:
+        writer.write(data)
+    return raw.getvalue()
+
+
+def test_small_gzip_objects_compress_as_the_writer_does():
+    codec = Codec("gzip", 9)
+    body = codec.compress(DATA)
+    assert body == streamed(codec, DATA)
+    assert gzip.decompress(body) == DATA
+
+
+def test_small_zstd_objects_round_trip():
+    codec = Codec("zstd", 3)
+    assert decompress(codec.compress(DATA)) == DATA
+    assert decompress(codec.compress(b"")) == b""
+
+
+def test_buffered_compressor_streams_once_a_block_is_written():
+    codec = Codec("gzip", 6)
+    block_size = len(DATA) // 3
+
+    raw = io.BytesIO()
+    with BufferedCompressor(codec, raw, block_size) as small:
+        small.write(DATA[: block_size - 1])
+    assert small.small and raw.getvalue() == b""
+    assert bytes(small.buffer) == DATA[: block_size - 1]
+
+    raw = io.BytesIO()
+    with BufferedCompressor(codec, raw, block_size) as large:
+        for start in range(0, len(DATA), 1000):
+            large.write(DATA[start : start + 1000])
+    assert not large.small
+    assert gzip.decompress(raw.getvalue()) == DATA
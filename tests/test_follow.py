@@ -0,0 +1,59 @@
+import io
+
+import pandas as pd
+
+from scripts.follow import OutputMerger
+
+PATH = "program/p/user/u/depositRecords/2024/20240610"
+DEDUP = ["txSig", "depositRecordId", "marketIndex"]
+
+
+class CsvObjects:
+    """A sink of csv objects, read back with pandas' default parsing"""
+
+    def __init__(self):
+        self.objects = {}
+        self.reads = 0
+
+    def read_csv(self, object_path):
+        self.reads += 1
+        body = self.objects.get(object_path)
+        if body is None:
+            return None
+        return pd.read_csv(io.StringIO(body))
+
+    def put_csv(self, object_path, df):
+        self.objects[object_path] = df.to_csv(index=False)
+
+
+def deposits(rows):
+    """Deposits as processors produce them
+
+    Signatures are categorical, and record ids strings as u128 columns are kept.
+    Read back, both are parsed like any other column.
+    """
+    df = pd.DataFrame(
+        rows, columns=["txSig", "depositRecordId", "marketIndex", "referrer"]
+    )
+    df["txSig"] = df["txSig"].astype("category")
+    df["depositRecordId"] = df["depositRecordId"].astype(str)
+    return df
+
+
+def test_rows_read_back_deduplicate_against_rows_in_memory():
+    sink = CsvObjects()
+    # Written by the batch run before following
+    sink.put_csv(PATH, deposits([("sig1", 1, 0, None), ("sig2", 2, 0, None)]))
+    merger = OutputMerger(sink.read_csv, sink.put_csv)
+
+    # A poll sees sig2 again next to a new deposit, the next one sig3 again
+    merger.add(PATH, deposits([("sig2", 2, 0, None), ("sig3", 3, 1, None)]), DEDUP)
+    assert merger.flush() == 1
+    merger.add(PATH, deposits([("sig3", 3, 1, None)]), DEDUP)
+    merger.flush()
+
+    written = pd.read_csv(io.StringIO(sink.objects[PATH]))
+    assert written["txSig"].tolist() == ["sig1", "sig2", "sig3"]
+    # Every flush reads the object back rather than keeping it
+    assert sink.reads == 2
+    assert merger.pending == {}
@@ -0,0 +1,60 @@
+import pyarrow as pa
+import pytest
+
+import scripts.log_parser as log_parser
+from scripts.log_parser import RAW_LOGS_SCHEMA, BatchedEvents
+from scripts.memory import MemoryBudgetExceeded, MemoryGovernor, decoded_estimate
+
+ROWS = 100
+BATCH_ROWS = 10
+
+
+def partition():
+    signatures = [f"sig{i}" for i in range(ROWS)]
+    records = pa.table({"tx_id": signatures})
+    raw_logs = pa.table(
+        [signatures, [[f"Program log: {sig}"] * 4 for sig in signatures]],
+        schema=RAW_LOGS_SCHEMA,
+    )
+    return records, raw_logs
+
+
+@pytest.fixture
+def decodes(monkeypatch):
+    """Row counts of every decode, the events of a signature are the signature"""
+    counts = []
+
+    def decode_events(signatures, log_messages, event_name):
+        counts.append(len(signatures))
+        return {sig: [sig] for sig in signatures}
+
+    monkeypatch.setattr(log_parser, "decode_events", decode_events)
+    return counts
+
+
+def test_batches_fit_a_budget_the_day_does_not(decodes):
+    records, raw_logs = partition()
+    batch_estimate = decoded_estimate(raw_logs.slice(0, BATCH_ROWS).nbytes)
+    governor = MemoryGovernor(2 * batch_estimate)
+    assert decoded_estimate(raw_logs.nbytes) > governor.limit
+
+    events = BatchedEvents(records, raw_logs, "DepositRecord", governor, BATCH_ROWS)
+    for tx_id in records["tx_id"].to_pylist():
+        assert events.get(tx_id, []) == [tx_id]
+    events.close()
+
+    assert decodes == [BATCH_ROWS] * (ROWS // BATCH_ROWS)
+    assert governor.peak <= governor.limit
+    assert governor.used == 0 and governor.reservations == 0
+
+
+def test_batch_that_cannot_fit_raises(decodes):
+    records, raw_logs = partition()
+    governor = MemoryGovernor(
+        decoded_estimate(raw_logs.slice(0, BATCH_ROWS).nbytes) // 2
+    )
+
+    events = BatchedEvents(records, raw_logs, "DepositRecord", governor, BATCH_ROWS)
+    with pytest.raises(MemoryBudgetExceeded):
+        events.get("sig0")
+    assert decodes == []
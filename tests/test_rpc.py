@@ -0,0 +1,150 @@
+import asyncio
+
+from aiohttp import web
+
+import scripts.rpc as rpc
+from scripts.rpc import RpcLogCache, RpcLogFetcher
+
+
+def logs_of(signature):
+    return [f"Program log: {signature}"]
+
+
+def transaction(signature):
+    return {"meta": {"logMessages": logs_of(signature)}}
+
+
+async def serve(handle, calls):
+    async def post(request):
+        payload = await request.json()
+        calls.append([call["params"][0] for call in payload])
+        return await handle(payload, len(calls))
+
+    app = web.Application()
+    app.router.add_post("/", post)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/"
+
+
+def fetch(handle, signatures, **kwargs):
+    """(logs, failed, calls) of fetching signatures from a stub node"""
+    calls = []
+
+    async def run():
+        runner, url = await serve(handle, calls)
+        try:
+            fetcher = RpcLogFetcher(url, **kwargs)
+            logs = await fetcher.fetch(signatures)
+            return logs, fetcher.failed
+        finally:
+            await runner.cleanup()
+
+    logs, failed = asyncio.run(run())
+    return logs, failed, calls
+
+
+def reply(call, result):
+    return {"jsonrpc": "2.0", "id": call["id"], "result": result}
+
+
+async def answer_all(payload, _):
+    return web.json_response(
+        [reply(call, transaction(call["params"][0])) for call in payload]
+    )
+
+
+def test_batches():
+    signatures = [f"sig{i}" for i in range(7)]
+    logs, failed, calls = fetch(answer_all, signatures, batch_size=3)
+    assert logs == {sig: logs_of(sig) for sig in signatures}
+    assert failed == set()
+    assert sorted(len(call) for call in calls) == [1, 3, 3]
+    assert sorted(sig for call in calls for sig in call) == sorted(signatures)
+
+
+def test_retries_failed_requests(monkeypatch):
+    monkeypatch.setattr(rpc, "RPC_RETRY_DELAY", 0)
+
+    async def handle(payload, n):
+        if n == 1:
+            return web.Response(status=429)
+        if n == 2:
+            return web.json_response({"error": {"code": -32600}})
+        return await answer_all(payload, n)
+
+    logs, failed, calls = fetch(handle, ["a", "b"])
+    assert logs == {"a": logs_of("a"), "b": logs_of("b")}
+    assert failed == set()
+    assert len(calls) == 3
+
+
+def test_retries_calls_answered_with_an_error(monkeypatch):
+    monkeypatch.setattr(rpc, "RPC_RETRY_DELAY", 0)
+
+    async def handle(payload, n):
+        return web.json_response(
+            [
+                (
+                    {"jsonrpc": "2.0", "id": call["id"], "error": {"code": 429}}
+                    if call["params"][0] == "b" and n == 1
+                    else reply(call, transaction(call["params"][0]))
+                )
+                for call in payload
+            ]
+        )
+
+    logs, failed, calls = fetch(handle, ["a", "b", "c"])
+    assert logs == {sig: logs_of(sig) for sig in "abc"}
+    assert failed == set()
+    assert calls == [["a", "b", "c"], ["b"]]
+
+
+def test_partial_replies(monkeypatch):
+    monkeypatch.setattr(rpc, "RPC_RETRY_DELAY", 0)
+
+    async def handle(payload, n):
+        # Drops the last call on the first reply, never answers "d"
+        answered = payload[:-1] if n == 1 else payload
+        return web.json_response(
+            [
+                reply(call, transaction(call["params"][0]))
+                for call in answered
+                if call["params"][0] != "d"
+            ]
+        )
+
+    logs, failed, calls = fetch(handle, ["a", "b", "c", "d"])
+    assert logs == {sig: logs_of(sig) for sig in "abc"}
+    assert failed == {"d"}
+    assert calls[:2] == [["a", "b", "c", "d"], ["d"]]
+    assert len(calls) == rpc.RPC_RETRIES
+
+
+def test_unknown_and_logless_transactions(tmp_path):
+    async def handle(payload, _):
+        results = {
+            "known": transaction("known"),
+            "unknown": None,
+            "no_logs": {"meta": {"logMessages": None}},
+            "no_meta": {"meta": None},
+        }
+        return web.json_response(
+            [reply(call, results[call["params"][0]]) for call in payload]
+        )
+
+    cache = RpcLogCache(str(tmp_path / "rpc_logs.sqlite"))
+    signatures = ["known", "unknown", "no_logs", "no_meta"]
+    logs, failed, calls = fetch(handle, signatures, cache=cache)
+    assert logs == {"known": logs_of("known")}
+    assert failed == set()
+    assert len(calls) == 1
+    assert cache.get(signatures) == {"known": logs_of("known")}
+
+    # Cached signatures are not asked again, the others are
+    logs, failed, calls = fetch(handle, signatures, cache=cache)
+    assert logs == {"known": logs_of("known")}
+    assert calls == [["unknown", "no_logs", "no_meta"]]
@@ -0,0 +1,130 @@
+import datetime as dt
+import functools
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import archive
+from scripts import sharding
+from scripts.aio import S3IO
+from scripts.sharding import LeaseManifest, WorkUnit
+from scripts.sinks import LocalSink, MemorySink
+
+UNIT = WorkUnit(dt.date(2024, 6, 10))
+
+
+@pytest.fixture
+def s3_io():
+    """The async layer alone, memory and local sinks need no credentials"""
+    s3_io = S3IO(get_credentials=None)
+    yield s3_io
+    s3_io.close()
+
+
+@pytest.fixture(autouse=True)
+def settle(monkeypatch):
+    monkeypatch.setattr(sharding, "CLAIM_SETTLE_SECONDS", 0.2)
+
+
+def test_claimed_unit_is_left_to_its_owner(s3_io):
+    sink = MemorySink()
+    a = LeaseManifest(s3_io, sink)
+    b = LeaseManifest(s3_io, sink)
+
+    assert a.try_claim(UNIT)
+    assert a.read_lease(UNIT).owner == a.owner
+    assert not b.try_claim(UNIT)
+    # The owner claiming again keeps its lease
+    assert a.try_claim(UNIT)
+
+    a.complete(UNIT)
+    assert a.read_lease(UNIT) is None
+    assert b.is_done(UNIT)
+    assert not b.try_claim(UNIT)
+
+
+def test_expired_lease_is_reclaimed(s3_io, tmp_path):
+    sink = LocalSink(str(tmp_path))
+    a = LeaseManifest(s3_io, sink, ttl=0.1)
+    b = LeaseManifest(s3_io, sink)
+
+    assert a.try_claim(UNIT)
+    time.sleep(0.15)
+    assert b.try_claim(UNIT)
+    assert b.read_lease(UNIT).owner == b.owner
+    # The heartbeat of the node that lost the lease finds out and stops renewing
+    assert not a.renew(UNIT)
+    assert b.read_lease(UNIT).owner == b.owner
+
+
+def test_racing_workers_claim_a_unit_once(s3_io):
+    sink = MemorySink()
+    workers = [LeaseManifest(s3_io, sink) for _ in range(2)]
+    units = [WorkUnit(dt.date(2024, 6, day)) for day in range(1, 6)]
+    start = threading.Barrier(len(workers))
+    claims = []
+
+    def claim_all(worker):
+        for unit in units:
+            start.wait()
+            if worker.try_claim(unit):
+                claims.append((unit, worker.owner))
+
+    threads = [threading.Thread(target=claim_all, args=(w,)) for w in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Each unit has a single winner, the one holding its lease
+    assert sorted(unit.key for unit, _ in claims) == [unit.key for unit in units]
+    for unit, owner in claims:
+        assert workers[0].read_lease(unit).owner == owner
+
+
+def test_sharded_nodes_archive_every_unit_once(s3_io, tmp_path, monkeypatch):
+    dates = [dt.date(2024, 6, day) for day in range(1, 5)]
+    plan = [
+        SimpleNamespace(
+            date=date,
+            size=day,
+            events_files=[],
+            txns_files=[],
+            event_types=["DepositRecord"],
+        )
+        for day, date in enumerate(dates, 1)
+    ]
+    archived = []
+    lock = threading.Lock()
+
+    def archive_day(date, *args, shard=None, **kwargs):
+        time.sleep(0.05)
+        with lock:
+            archived.append(date)
+
+    monkeypatch.setattr(archive, "SINK_SPEC", f"local:{tmp_path}")
+    monkeypatch.setattr(archive, "SINK", None)
+    monkeypatch.setattr(archive, "get_s3_io", lambda: s3_io)
+    monkeypatch.setattr(archive, "plan_archive", lambda *args, **kwargs: plan)
+    monkeypatch.setattr(archive, "format_plan", lambda *args: "")
+    monkeypatch.setattr(archive, "archive_day", archive_day)
+    monkeypatch.setattr(archive, "merge_activity_index", lambda dates: None)
+    monkeypatch.setattr(archive, "merge_signature_index", lambda dates: None)
+    monkeypatch.setattr(
+        archive, "LeaseManifest", functools.partial(LeaseManifest, ttl=0.6)
+    )
+
+    nodes = [
+        threading.Thread(
+            target=archive.archive_sharded, args=(dates[0], dates[-1], (i, 2))
+        )
+        for i in range(2)
+    ]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join()
+
+    assert sorted(archived) == dates
@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+
+import pandas as pd
+from driftpy.types import LiquidationType
+from solders.pubkey import Pubkey  # type: ignore
+
+from scripts.event_parser import parse_liquidation
+from scripts.tables import KeyedEvents, rows_to_table
+
+
+def liquidation(user, tx_sig, canceled_order_ids):
+    return {
+        "txSig": tx_sig,
+        "user": user,
+        "liquidationType": "liquidatePerp",
+        "canceledOrderIds": canceled_order_ids,
+        "marginRequirement": 1000,
+    }
+
+
+USER = Pubkey.new_unique()
+ROWS = [
+    liquidation(USER, "sig1", [1, 2, 3]),
+    liquidation(USER, "sig2", []),
+    liquidation(USER, "sig3", None),
+]
+
+
+def baseline_csv(rows):
+    """The csv the baseline wrote, from a DataFrame of the dicts"""
+    return pd.DataFrame(rows).to_csv(index=False)
+
+
+def test_list_fields_keep_their_csv_form():
+    assert rows_to_table(ROWS).to_pandas().to_csv(index=False) == baseline_csv(ROWS)
+
+
+def test_keyed_frames_match_baseline_csv():
+    events = KeyedEvents()
+    for row in ROWS:
+        events.add("user/a", row)
+    [(key, df)] = list(events.frames())
+    assert key == "user/a"
+    assert df.to_csv(index=False) == baseline_csv(ROWS)
+    assert '"[1, 2, 3]"' in df.to_csv(index=False)
+
+
+def liquidation_record(user, liquidation_type, **groups):
+    return SimpleNamespace(
+        ts=1700000000,
+        liquidation_type=liquidation_type,
+        user=user,
+        liquidator=Pubkey.new_unique(),
+        margin_requirement=5_000_000,
+        total_collateral=4_000_000,
+        margin_freed=1_000_000,
+        liquidation_id=1,
+        bankrupt=False,
+        canceled_order_ids=[7, 8],
+        **groups,
+    )
+
+
+def test_compact_liquidations_keep_their_own_columns():
+    perp_user = Pubkey.new_unique()
+    bankrupt_user = Pubkey.new_unique()
+    perp = liquidation_record(
+        perp_user,
+        LiquidationType.LiquidatePerp(),
+        liquidate_perp=SimpleNamespace(
+            market_index=0,
+            oracle_price=20_000_000,
+            base_asset_amount=1_000_000_000,
+            quote_asset_amount=20_000_000,
+            lp_shares=0,
+            fill_record_id=3,
+            user_order_id=4,
+            liquidator_order_id=5,
+            liquidator_fee=1_000,
+            if_fee=1_000,
+        ),
+    )
+    bankruptcy = liquidation_record(
+        bankrupt_user,
+        LiquidationType.PerpBankruptcy(),
+        perp_bankruptcy=SimpleNamespace(
+            market_index=1,
+            pnl=-1_000_000,
+            if_payment=1_000_000,
+            clawback_user=None,
+            clawback_user_payment=None,
+            cumulative_funding_rate_delta=0,
+        ),
+    )
+    rows = {
+        str(perp_user): parse_liquidation(perp, {"tx_sig": "sig1", "slot": 1}),
+        str(bankrupt_user): parse_liquidation(
+            bankruptcy, {"tx_sig": "sig2", "slot": 2}
+        ),
+    }
+    assert set(rows[str(perp_user)]) != set(rows[str(bankrupt_user)])
+
+    events = KeyedEvents()
+    for user, row in rows.items():
+        events.add(user, row)
+    frames = dict(events.frames())
+    assert frames.keys() == rows.keys()
+    for user, df in frames.items():
+        assert list(df.columns) == list(rows[user])
+        assert df.to_csv(index=False) == baseline_csv([rows[user]])